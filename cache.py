@@ -0,0 +1,90 @@
+# Ограниченный по размеру in-process кэш с вытеснением LRU и временем жизни записей (TTL)
+# Потокобезопасный. Считает попадания, промахи, вытеснения (по размеру) и истечения (по TTL).
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class TTLCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (время истечения, value)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _get(self, key, now):
+        entry = self.data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= now:
+            del self.data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _set(self, key, value, now):
+        self.data[key] = (now + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key):
+        """
+        Значение по ключу или None, если его нет или оно устарело
+        """
+        with self.lock:
+            return self._get(key, monotonic())
+
+    def get_many(self, keys) -> dict:
+        """
+        Словарь {key: value} только для найденных в кэше ключей
+        """
+        now = monotonic()
+        result = {}
+        with self.lock:
+            for key in keys:
+                value = self._get(key, now)
+                if value is not None:
+                    result[key] = value
+        return result
+
+    def set(self, key, value):
+        with self.lock:
+            self._set(key, value, monotonic())
+
+    def set_many(self, items: dict):
+        now = monotonic()
+        with self.lock:
+            for key, value in items.items():
+                self._set(key, value, now)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.data),
+                "maxSize": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -1,69 +1,1131 @@
 # Паттерн 'Circuit Breaker'
-# Если обратиться к url через метод CircuitBreaker.external_request,
-# то при NUMBER_OF_ATTEMPTS неудачных попытках доступа, дальнейшие будут заблокированы
-# на BREAK_TIME секунд.
+# Если обратиться к url через метод CircuitBreaker.external_request, то результаты и время
+# всех попыток доступа к сервису попадают в скользящее окно BREAKER_WINDOW секунд
+# (BREAKER_BUCKETS корзин по времени). Когда в окне хотя бы BREAKER_MIN_CALLS попыток и доля
+# неудачных больше BREAKER_FAILURE_RATE (или доля медленных, дольше BREAKER_SLOW_CALL_DURATION
+# секунд, больше BREAKER_SLOW_CALL_RATE), дальнейшие запросы блокируются на BREAK_TIME секунд.
+# После этого circuit breaker полуоткрыт: пропускает не больше BREAKER_HALF_OPEN_PROBES
+# пробных запросов одновременно; если все они успешны, закрывается, если хоть один
+# неудачный - снова открывается. Так восстановившийся сервис нагружается постепенно.
+# Пробный запрос, не вернувший результата за BREAKER_PROBE_TIMEOUT секунд (процесс убит посреди запроса),
+# считается потерянным, и его место освобождается.
 #
 # При этом выбрасывается исключение CircuitBreakerException, и выполнение метода апи,
 # который вызвал CircuitBreaker.external_request немедленно прекращается
+#
+# Повторные попытки - по RetryPolicy: экспоненциальная задержка со случайным разбросом
+# (full jitter: от 0 до min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2^попытка)), общий дедлайн
+# на вызов CALL_DEADLINE секунд и бюджет повторов на сервис (RetryBudget): повторов не больше
+# RETRY_BUDGET_RATIO от числа обычных запросов плюс RETRY_BUDGET_MIN_PER_SECOND в секунду.
+# Так медленный сервис не получает лавину повторов, а потоки не засыпают надолго.
+#
+# Запросы идут через долгоживущие requests.Session (отдельная на каждый сервис) с пулом
+# keep-alive соединений: до HTTP_POOL_MAXSIZE соединений на сервис, таймауты на подключение
+# и чтение HTTP_CONNECT_TIMEOUT/HTTP_READ_TIMEOUT секунд. Статистика пулов - CircuitBreaker.pool_stats()
+#
+# Для асинхронного (aiohttp) кода есть CircuitBreaker.async_external_request и
+# декоратор async_handles_circuit_break: то же самое, но ожидание между попытками
+# и сами запросы не блокируют event loop. Состояние circuit breaker'а у них общее.
+#
+# Запросы учитывают дедлайн входящего запроса (см. deadline.py): таймаут попыток не больше
+# оставшегося времени, в следующий сервис передается заголовок с оставшимся временем,
+# а когда время вышло, выбрасывается DeadlineExceededException (ответ 504 вместо 555)
+#
+# Хеджирование (external_request(..., hedge=True), только для идемпотентных запросов): если первая
+# попытка не ответила за HEDGE_PERCENTILE-й перцентиль недавних времен ответа сервиса, параллельно
+# отправляется вторая, и используется тот успешный ответ, что придет первым. В asyncio проигравший запрос
+# отменяется; в потоках обе попытки идут в пуле потоков сервиса, и проигравшая дорабатывает в фоне (не дольше
+# таймаута попытки), занимая свое место в bulkhead'е. Хеджей не больше HEDGE_MAX_RATE от числа запросов
+# к сервису, и хедж занимает место в bulkhead'е сервиса (если места нет, хедж не отправляется).
+# Статистика (отправлено/выиграно) - CircuitBreaker.hedge_stats()
+#
+# Изоляция сервисов (Bulkhead): к каждому сервису одновременно выполняется не больше
+# BULKHEAD_MAX_CONCURRENT попыток запроса, еще не больше BULKHEAD_MAX_WAITING ждут свободного места
+# (не дольше BULKHEAD_WAIT_TIMEOUT секунд), остальные сразу получают BulkheadFullException (ответ 555).
+# Так медленный сервис занимает не больше своей доли потоков. Загрузка - CircuitBreaker.bulkhead_stats()
+#
+# Попытки запросов (success/error/rejected), их время и переходы состояний пишутся в metrics.py,
+# а CircuitBreaker.export_metrics() добавляет в /manage/metrics статистику по сервисам.
+# Каждый external_request - span трассировки (tracing.py), в запрос передается traceparent
+#
+# Если задан CIRCUIT_BREAKER_SHARED_STATE=<путь к файлу>, состояние и окна circuit breaker'ов
+# хранятся в этом файле, отображенном в память (mmap), - общие для всех процессов на хосте,
+# которые его используют: воркеры вместе замечают недоступность сервиса и вместе восстанавливаются.
+# У каждого сервиса свой слот в файле (CIRCUIT_BREAKER_SHARED_SLOTS слотов). Проверка закрытого
+# circuit breaker'а читает слот без блокировок, изменения - под блокировкой только этого слота (lockf).
 
+import os
+import json
+import mmap
+import fcntl
+import random
+import struct
+import asyncio
+import hashlib
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
 from urllib.parse import urlparse
-from time import sleep, time
+from time import sleep, time, monotonic
 from functools import wraps
+from threading import Event, Lock, BoundedSemaphore
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 
+import deadline
+import metrics
+import tracing
+
+try:
+    import aiohttp
+except ImportError:  # нужен только асинхронному шлюзу
+    aiohttp = None
+
 NUMBER_OF_ATTEMPTS = 2
-TIME_BETWEEN_ATTEMPTS = 1
 BREAK_TIME = 30
 
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", 0.1))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", 1))
+RETRY_BUDGET_RATIO = float(os.environ.get("RETRY_BUDGET_RATIO", 0.2))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.environ.get("RETRY_BUDGET_MIN_PER_SECOND", 1))
+CALL_DEADLINE = float(os.environ.get("CALL_DEADLINE", 15))
+
+BREAKER_WINDOW = float(os.environ.get("BREAKER_WINDOW", 10))
+BREAKER_BUCKETS = int(os.environ.get("BREAKER_BUCKETS", 10))
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", NUMBER_OF_ATTEMPTS))
+BREAKER_FAILURE_RATE = float(os.environ.get("BREAKER_FAILURE_RATE", 0.5))
+BREAKER_SLOW_CALL_DURATION = float(os.environ.get("BREAKER_SLOW_CALL_DURATION", 5))
+BREAKER_SLOW_CALL_RATE = float(os.environ.get("BREAKER_SLOW_CALL_RATE", 0.8))
+BREAKER_HALF_OPEN_PROBES = int(os.environ.get("BREAKER_HALF_OPEN_PROBES", 3))
+BREAKER_PROBE_TIMEOUT = float(os.environ.get("BREAKER_PROBE_TIMEOUT", CALL_DEADLINE))
+
+CLOSED = "CLOSED"
+OPEN = "OPEN"
+HALF_OPEN = "HALF_OPEN"
+
+CIRCUIT_BREAKER_SHARED_STATE = os.environ.get("CIRCUIT_BREAKER_SHARED_STATE", "")
+CIRCUIT_BREAKER_SHARED_SLOTS = int(os.environ.get("CIRCUIT_BREAKER_SHARED_SLOTS", 64))
+if CIRCUIT_BREAKER_SHARED_STATE:
+    print(f"Circuit breaker shared state: {CIRCUIT_BREAKER_SHARED_STATE} ($CIRCUIT_BREAKER_SHARED_STATE)")
+
 CIRCUIT_BREAK_STATUS_CODE = 555
 
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 20))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 3))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 10))
+
+BULKHEAD_MAX_CONCURRENT = int(os.environ.get("BULKHEAD_MAX_CONCURRENT", HTTP_POOL_MAXSIZE))
+BULKHEAD_MAX_WAITING = int(os.environ.get("BULKHEAD_MAX_WAITING", HTTP_POOL_MAXSIZE))
+BULKHEAD_WAIT_TIMEOUT = float(os.environ.get("BULKHEAD_WAIT_TIMEOUT", 1))
+
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", 95))
+HEDGE_MAX_RATE = float(os.environ.get("HEDGE_MAX_RATE", 0.1))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", 20))
+HEDGE_WINDOW = int(os.environ.get("HEDGE_WINDOW", 200))
+
+
 class CircuitBreakerException(Exception):
     pass
 
 
+class DeadlineExceededException(CircuitBreakerException):
+    """
+    Время входящего запроса вышло - дальше выполнять его бессмысленно
+    """
+    pass
+
+
+class BulkheadFullException(CircuitBreakerException):
+    """
+    Слишком много одновременных запросов к сервису - запрос отклонен, не начавшись
+    """
+    pass
+
+
+class Bulkhead:
+    """
+    Ограничение одновременных запросов к одному сервису с ограниченной очередью ожидания.
+    Для потоков и для asyncio ограничения отдельные, счетчики общие
+    """
+    def __init__(self, service, max_concurrent=None, max_waiting=None, wait_timeout=None):
+        self.service = service
+        self.max_concurrent = BULKHEAD_MAX_CONCURRENT if max_concurrent is None else max_concurrent
+        self.max_waiting = BULKHEAD_MAX_WAITING if max_waiting is None else max_waiting
+        self.wait_timeout = BULKHEAD_WAIT_TIMEOUT if wait_timeout is None else wait_timeout
+        self.semaphore = BoundedSemaphore(self.max_concurrent)
+        self.async_semaphore = None
+        self.lock = Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def _reject(self, reason):
+        with self.lock:
+            self.rejected += 1
+        return BulkheadFullException(f"Too many concurrent requests to '{self.service}': {reason}")
+
+    def _start_waiting(self):
+        with self.lock:
+            full = self.waiting >= self.max_waiting
+            if not full:
+                self.waiting += 1
+        if full:
+            raise self._reject("wait queue is full")
+
+    def _stop_waiting(self):
+        with self.lock:
+            self.waiting -= 1
+
+    def _acquired(self, waited):
+        with self.lock:
+            if waited:
+                self.waiting -= 1
+            self.in_flight += 1
+
+    def acquire(self, timeout=None):
+        """
+        Занимает место. timeout - сколько можно ждать, если меньше wait_timeout
+        """
+        if self.semaphore.acquire(blocking=False):
+            self._acquired(False)
+            return
+        self._start_waiting()
+        wait_timeout = self.wait_timeout if timeout is None else max(min(self.wait_timeout, timeout), 0)
+        if not self.semaphore.acquire(timeout=wait_timeout):
+            self._stop_waiting()
+            raise self._reject(f"no free slot in {wait_timeout:.2f} seconds")
+        self._acquired(True)
+
+    def try_acquire(self) -> bool:
+        """
+        Занимает место, только если оно свободно сейчас: без ожидания и без учета в rejected (для хеджей)
+        """
+        if not self.semaphore.acquire(blocking=False):
+            return False
+        self._acquired(False)
+        return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.semaphore.release()
+
+    async def async_acquire(self, timeout=None):
+        if self.async_semaphore is None:
+            self.async_semaphore = asyncio.BoundedSemaphore(self.max_concurrent)
+        if not self.async_semaphore.locked():
+            await self.async_semaphore.acquire()
+            self._acquired(False)
+            return
+        self._start_waiting()
+        wait_timeout = self.wait_timeout if timeout is None else max(min(self.wait_timeout, timeout), 0)
+        try:
+            await asyncio.wait_for(self.async_semaphore.acquire(), wait_timeout)
+        except asyncio.TimeoutError:
+            self._stop_waiting()
+            raise self._reject(f"no free slot in {wait_timeout:.2f} seconds")
+        except BaseException:
+            # ожидающую задачу отменили (клиент отключился, проигравший hedge) - место в очереди освобождается
+            self._stop_waiting()
+            raise
+        self._acquired(True)
+
+    async def async_try_acquire(self) -> bool:
+        if self.async_semaphore is None or self.async_semaphore.locked():
+            return False
+        await self.async_semaphore.acquire()
+        self._acquired(False)
+        return True
+
+    def async_release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.async_semaphore.release()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "maxConcurrent": self.max_concurrent,
+                "inFlight": self.in_flight,
+                "waiting": self.waiting,
+                "rejected": self.rejected,
+            }
+
+
+class ServiceBreaker:
+    """
+    Состояние circuit breaker'а одного сервиса. Потокобезопасно
+    """
+    def __init__(self, service):
+        self.service = service
+        self.lock = Lock()
+        self.state = CLOSED
+        self.opened_at = 0
+        self.probes_in_flight = 0
+        self.probes_succeeded = 0
+        self.bucket_duration = BREAKER_WINDOW / BREAKER_BUCKETS
+        # корзина: [номер интервала времени, попыток, неудачных, медленных, суммарное время]
+        self.buckets = [[0, 0, 0, 0, 0.0] for _ in range(BREAKER_BUCKETS)]
+
+    def _bucket(self, now):
+        number = int(now / self.bucket_duration)
+        bucket = self.buckets[number % len(self.buckets)]
+        if bucket[0] != number:
+            bucket[:] = [number, 0, 0, 0, 0.0]
+        return bucket
+
+    def _window(self, now):
+        """
+        (попыток, неудачных, медленных, суммарное время) за окно
+        """
+        oldest = int(now / self.bucket_duration) - len(self.buckets) + 1
+        totals = [0, 0, 0, 0.0]
+        for bucket in self.buckets:
+            if bucket[0] >= oldest:
+                for i in range(4):
+                    totals[i] += bucket[i + 1]
+        return totals
+
+    def _reset_window(self):
+        for bucket in self.buckets:
+            bucket[:] = [0, 0, 0, 0, 0.0]
+
+    def _set_state(self, state):
+        if state != self.state:
+            metrics.breaker_transitions.inc(self.service, self.state, state)
+            self.state = state
+
+    def _open(self, now):
+        self._set_state(OPEN)
+        self.opened_at = now
+        self.probes_in_flight = 0
+        self.probes_succeeded = 0
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            yield
+
+    def peek_state(self) -> str:
+        """
+        Текущее состояние без блокировки
+        """
+        return self.state
+
+    def try_acquire(self) -> bool:
+        """
+        Можно ли сейчас сделать попытку запроса к сервису.
+        После True нужно обязательно вызвать record с результатом попытки
+        """
+        if self.peek_state() == CLOSED:
+            return True
+        with self.locked():
+            if self.state == OPEN:
+                if time() - self.opened_at < BREAK_TIME:
+                    return False
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                # в HALF_OPEN opened_at - время последнего выданного пробного запроса
+                now = time()
+                if self.probes_in_flight + self.probes_succeeded >= BREAKER_HALF_OPEN_PROBES:
+                    if not self.probes_in_flight or now - self.opened_at < BREAKER_PROBE_TIMEOUT:
+                        return False
+                    # пробные запросы давно не вернули результата - считаем их потерянными
+                    self.probes_in_flight = 0
+                self.probes_in_flight += 1
+                self.opened_at = now
+            return True
+
+    def acquire(self):
+        """
+        То же, что try_acquire, но выбрасывает CircuitBreakerException, если нельзя
+        """
+        if not self.try_acquire():
+            raise CircuitBreakerException(
+                f"Curcuit breaker to '{self.service}' still active, "
+                f"please wait {max(int(BREAK_TIME - (time() - self.opened_at)), 0)} seconds"
+            )
+
+    def cancel(self):
+        """
+        Попытка не дала результата (прервана по дедлайну вызывающего) - ничего не учитываем
+        """
+        with self.locked():
+            if self.state == HALF_OPEN:
+                self.probes_in_flight = max(self.probes_in_flight - 1, 0)
+
+    def record(self, success, duration):
+        with self.locked():
+            now = time()
+            if self.state == HALF_OPEN:
+                self.probes_in_flight = max(self.probes_in_flight - 1, 0)
+                if not success:
+                    self._open(now)
+                    return
+                self.probes_succeeded += 1
+                if self.probes_succeeded >= BREAKER_HALF_OPEN_PROBES:
+                    self._set_state(CLOSED)
+                    self._reset_window()
+                return
+            if self.state == OPEN:
+                return
+
+            bucket = self._bucket(now)
+            bucket[1] += 1
+            bucket[2] += not success
+            bucket[3] += duration >= BREAKER_SLOW_CALL_DURATION
+            bucket[4] += duration
+
+            calls, failures, slow, _ = self._window(now)
+            if calls >= BREAKER_MIN_CALLS and (
+                failures / calls > BREAKER_FAILURE_RATE or slow / calls > BREAKER_SLOW_CALL_RATE
+            ):
+                self._open(now)
+
+    def stats(self) -> dict:
+        with self.locked():
+            calls, failures, slow, total_duration = self._window(time())
+            return {
+                "state": self.state,
+                "calls": calls,
+                "failures": failures,
+                "slowCalls": slow,
+                "avgDuration": total_duration / calls if calls else 0,
+            }
+
+
+class SharedServiceBreaker(ServiceBreaker):
+    """
+    Circuit breaker сервиса, состояние которого хранится в слоте SharedBreakerState.
+    Под блокировкой слот читается в поля объекта, а после изменений записывается обратно
+    """
+    def __init__(self, service, shared, offset):
+        super().__init__(service)
+        self.shared = shared
+        self.offset = offset
+
+    @contextmanager
+    def locked(self):
+        # lockf не различает потоки одного процесса, поэтому еще и обычный Lock
+        with self.lock:
+            fcntl.lockf(self.shared.fd, fcntl.LOCK_EX, self.shared.slot_size, self.offset)
+            try:
+                self.shared.load(self)
+                yield
+                self.shared.store(self)
+            finally:
+                fcntl.lockf(self.shared.fd, fcntl.LOCK_UN, self.shared.slot_size, self.offset)
+
+    def peek_state(self) -> str:
+        return self.shared.peek_state(self.offset)
+
+
+class SharedBreakerState:
+    """
+    Файл с состояниями circuit breaker'ов, общий для процессов.
+    Все процессы должны использовать одинаковые BREAKER_BUCKETS и число слотов
+    """
+    MAGIC = b"CBS1"
+    HEADER = struct.Struct("<4sII")  # magic, число корзин, число слотов
+    SLOT = struct.Struct("<QBdII")  # хэш сервиса, состояние, opened_at, пробных в работе, успешных пробных
+    BUCKET = struct.Struct("<qIIId")  # номер интервала, попыток, неудачных, медленных, суммарное время
+    STATES = (CLOSED, OPEN, HALF_OPEN)
+
+    def __init__(self, path, slots=CIRCUIT_BREAKER_SHARED_SLOTS, buckets=BREAKER_BUCKETS):
+        self.slots = slots
+        self.buckets = buckets
+        self.slot_size = self.SLOT.size + buckets * self.BUCKET.size
+        size = self.HEADER.size + slots * self.slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, buckets, slots), 0)
+            header = self.HEADER.unpack(os.pread(self.fd, self.HEADER.size, 0))
+            if header != (self.MAGIC, buckets, slots):
+                raise ValueError(f"Circuit breaker shared state '{path}' has other layout: {header}")
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.memory = mmap.mmap(self.fd, size)
+        self.breakers = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def key_for(service) -> int:
+        # hash() у каждого процесса свой, поэтому стабильный хэш
+        return int.from_bytes(hashlib.blake2b(service.encode(), digest_size=8).digest(), "little") or 1
+
+    def slot_offset(self, service):
+        """
+        Смещение слота сервиса (слот занимается при первом обращении) или None, если слоты кончились
+        """
+        key = self.key_for(service)
+        for i in range(self.slots):
+            offset = self.HEADER.size + (key + i) % self.slots * self.slot_size
+            slot_key = struct.unpack_from("<Q", self.memory, offset)[0]
+            if slot_key == key:
+                return offset
+            if slot_key == 0:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX, self.slot_size, offset)
+                try:
+                    slot_key = struct.unpack_from("<Q", self.memory, offset)[0]
+                    if slot_key == 0:
+                        struct.pack_into("<Q", self.memory, offset, key)
+                        return offset
+                    if slot_key == key:
+                        return offset
+                finally:
+                    fcntl.lockf(self.fd, fcntl.LOCK_UN, self.slot_size, offset)
+        return None
+
+    def breaker(self, service) -> ServiceBreaker:
+        """
+        Один объект на сервис в процессе (иначе потоки не будут исключать друг друга)
+        """
+        with self.lock:
+            breaker = self.breakers.get(service)
+            if breaker is None:
+                offset = self.slot_offset(service)
+                if offset is None:
+                    print(f"No free circuit breaker shared state slot for '{service}', using local state")
+                    breaker = ServiceBreaker(service)
+                else:
+                    breaker = SharedServiceBreaker(service, self, offset)
+                self.breakers[service] = breaker
+            return breaker
+
+    def peek_state(self, offset) -> str:
+        return self.STATES[self.memory[offset + 8]]
+
+    def load(self, breaker: ServiceBreaker):
+        _, state, breaker.opened_at, breaker.probes_in_flight, breaker.probes_succeeded = \
+            self.SLOT.unpack_from(self.memory, breaker.offset)
+        breaker.state = self.STATES[state]
+        for i, bucket in enumerate(breaker.buckets):
+            bucket[:] = self.BUCKET.unpack_from(self.memory, breaker.offset + self.SLOT.size + i * self.BUCKET.size)
+
+    def store(self, breaker: ServiceBreaker):
+        self.SLOT.pack_into(self.memory, breaker.offset, self.key_for(breaker.service),
+                            self.STATES.index(breaker.state), breaker.opened_at,
+                            breaker.probes_in_flight, breaker.probes_succeeded)
+        for i, bucket in enumerate(breaker.buckets):
+            self.BUCKET.pack_into(self.memory, breaker.offset + self.SLOT.size + i * self.BUCKET.size, *bucket)
+
+    def close(self):
+        self.memory.close()
+        os.close(self.fd)
+
+
+shared_state = SharedBreakerState(CIRCUIT_BREAKER_SHARED_STATE) if CIRCUIT_BREAKER_SHARED_STATE else None
+
+
+class RetryBudget:
+    """
+    Бюджет повторов одного сервиса: каждый запрос добавляет ratio повтора,
+    каждую секунду добавляется min_per_second повторов, каждый повтор тратит один
+    """
+    def __init__(self, ratio=None, min_per_second=None, max_balance=10):
+        self.ratio = RETRY_BUDGET_RATIO if ratio is None else ratio
+        self.min_per_second = RETRY_BUDGET_MIN_PER_SECOND if min_per_second is None else min_per_second
+        self.max_balance = max_balance
+        self.balance = self.min_per_second
+        self.updated_at = monotonic()
+        self.lock = Lock()
+        self.retries = 0
+        self.denied = 0
+
+    def _refill(self, amount):
+        now = monotonic()
+        self.balance = min(
+            self.balance + amount + (now - self.updated_at) * self.min_per_second,
+            self.max_balance,
+        )
+        self.updated_at = now
+
+    def deposit(self):
+        with self.lock:
+            self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        with self.lock:
+            self._refill(0)
+            if self.balance < 1:
+                self.denied += 1
+                return False
+            self.balance -= 1
+            self.retries += 1
+            return True
+
+
+class ServiceLatency:
+    """
+    Времена последних HEDGE_WINDOW успешных ответов сервиса и статистика хеджирования
+    """
+    def __init__(self, window=HEDGE_WINDOW, max_rate=None):
+        self.samples = deque(maxlen=window)
+        self.lock = Lock()
+        # хедж тратит единицу бюджета, каждый запрос добавляет max_rate
+        self.budget = RetryBudget(ratio=HEDGE_MAX_RATE if max_rate is None else max_rate, min_per_second=0)
+        self.sent = 0
+        self.won = 0
+
+    def add(self, duration):
+        with self.lock:
+            self.samples.append(duration)
+
+    def percentile(self, p):
+        """
+        p-й перцентиль времени ответа или None, если ответов пока мало
+        """
+        with self.lock:
+            if len(self.samples) < HEDGE_MIN_SAMPLES:
+                return None
+            samples = sorted(self.samples)
+        return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+    def hedge_delay(self):
+        """
+        Через сколько секунд без ответа отправлять хедж, или None, если хеджировать нельзя
+        """
+        self.budget.deposit()
+        return self.percentile(HEDGE_PERCENTILE)
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "won": self.won, "threshold": self.percentile(HEDGE_PERCENTILE)}
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=None, base_delay=None, max_delay=None, deadline=None):
+        self.max_attempts = NUMBER_OF_ATTEMPTS if max_attempts is None else max_attempts
+        self.base_delay = RETRY_BASE_DELAY if base_delay is None else base_delay
+        self.max_delay = RETRY_MAX_DELAY if max_delay is None else max_delay
+        self.deadline = CALL_DEADLINE if deadline is None else deadline
+
+    def backoff(self, retry) -> float:
+        """
+        Задержка перед повтором номер retry (с нуля): full jitter
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+    def attempts(self, budget: RetryBudget, remaining=None):
+        """
+        Генератор попыток вызова: (задержка перед попыткой, сколько секунд останется до дедлайна).
+        Заканчивается, когда исчерпаны попытки, время вызова или бюджет повторов.
+        remaining - сколько осталось у входящего запроса, если меньше дедлайна вызова
+        """
+        deadline_at = monotonic() + (self.deadline if remaining is None else min(self.deadline, remaining))
+        budget.deposit()
+        for attempt in range(self.max_attempts):
+            delay = self.backoff(attempt - 1) if attempt else 0
+            if attempt and (monotonic() + delay >= deadline_at or not budget.withdraw()):
+                return
+            yield delay, deadline_at - monotonic() - delay
+
+
 def handles_circuit_break(func):
     @wraps(func)
     def wrap(*args, **kwargs):
         try:
             return func(*args, **kwargs)
+        except DeadlineExceededException as e:
+            return {"message": str(e)}, deadline.DEADLINE_EXCEEDED_STATUS
+        except CircuitBreakerException as e:
+            return {"message": str(e)}, CIRCUIT_BREAK_STATUS_CODE
+    return wrap
+
+
+def async_handles_circuit_break(func):
+    @wraps(func)
+    async def wrap(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except DeadlineExceededException as e:
+            return {"message": str(e)}, deadline.DEADLINE_EXCEEDED_STATUS
         except CircuitBreakerException as e:
             return {"message": str(e)}, CIRCUIT_BREAK_STATUS_CODE
     return wrap
 
 
+class AsyncResponse:
+    """
+    Полностью прочитанный ответ aiohttp с тем же интерфейсом, что у requests.Response
+    """
+    def __init__(self, status_code, headers, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode()
+
+    def json(self):
+        return json.loads(self.content)
+
+
 class CircuitBreaker:
-    def __init__(self):
-        self.circuit_breaker_cache = {}
-        self.circuit_breaker_timeout = BREAK_TIME
+    def __init__(self, pool_maxsize=HTTP_POOL_MAXSIZE,
+                 connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT, retry_policy=None,
+                 shared=None):
+        self.breakers = {}
+        # общее для процессов состояние (по умолчанию - из CIRCUIT_BREAKER_SHARED_STATE)
+        self.shared = shared or shared_state
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.retry_budgets = {}
+        self.pool_maxsize = pool_maxsize
+        self.timeout = (connect_timeout, read_timeout)
+        self.sessions = {}
+        self.sessions_lock = Lock()
+        self.async_session = None
+        self.latencies = {}
+        self.hedge_executors = {}
+        self.bulkheads = {}
+
+    def session_for(self, service) -> requests.Session:
+        """
+        Долгоживущая сессия с пулом keep-alive соединений к service
+        """
+        session = self.sessions.get(service)
+        if session is None:
+            with self.sessions_lock:
+                session = self.sessions.get(service)
+                if session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self.sessions[service] = session
+        return session
+
+    def pooled_request(self, method, url, **kwargs) -> requests.Response:
+        """
+        Запрос через пул соединений и с таймаутами, но без circuit breaker'а
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session_for(urlparse(url).netloc).request(method, url, **kwargs)
+
+    def latency_for(self, service) -> ServiceLatency:
+        latency = self.latencies.get(service)
+        if latency is None:
+            latency = self.latencies.setdefault(service, ServiceLatency())
+        return latency
+
+    def bulkhead_for(self, service) -> Bulkhead:
+        bulkhead = self.bulkheads.get(service)
+        if bulkhead is None:
+            bulkhead = self.bulkheads.setdefault(service, Bulkhead(service))
+        return bulkhead
+
+    def bulkhead_stats(self) -> dict:
+        """
+        {service: {"maxConcurrent": ..., "inFlight": ..., "waiting": ..., "rejected": ...}}
+        """
+        return {service: bulkhead.stats() for service, bulkhead in list(self.bulkheads.items())}
+
+    def stats(self) -> dict:
+        """
+        Вся статистика клиента по сервисам
+        """
+        return {
+            "breakers": self.breaker_stats(),
+            "bulkheads": self.bulkhead_stats(),
+            "retries": self.retry_stats(),
+            "hedges": self.hedge_stats(),
+            "pools": self.pool_stats(),
+        }
+
+    def export_metrics(self):
+        """
+        Состояние circuit breaker'ов, bulkhead'ов, повторов, хеджей и пулов в /manage/metrics
+        """
+        states = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+        metrics.registry.gauges(
+            "circuit_breaker_state", "Circuit breaker state (0 closed, 1 open, 2 half-open)", ("dependency",),
+            lambda: [((service,), states[breaker.peek_state()]) for service, breaker in list(self.breakers.items())]
+        )
+        metrics.stats_gauges("circuit_breaker_bulkhead", "Bulkhead saturation", "dependency",
+                             self.bulkhead_stats, ("maxConcurrent", "inFlight", "waiting", "rejected"))
+        metrics.stats_gauges("circuit_breaker_retries", "Retries done and denied by retry budget", "dependency",
+                             self.retry_stats, ("retries", "denied"))
+        metrics.stats_gauges("circuit_breaker_hedges", "Hedged requests sent and won", "dependency",
+                             self.hedge_stats, ("sent", "won", "threshold"))
+        metrics.stats_gauges("circuit_breaker_pool", "Keep-alive connection pool usage", "dependency",
+                             self.pool_stats, ("requests", "connections", "reused"))
+
+    def hedge_stats(self) -> dict:
+        """
+        {service: {"sent": ..., "won": ..., "threshold": ...}} - отправленные и выигравшие хеджи
+        """
+        return {service: latency.stats() for service, latency in list(self.latencies.items())}
+
+    def hedge_executor_for(self, service, bulkhead) -> ThreadPoolExecutor:
+        """
+        Потоки для запросов с хеджем: свои у каждого сервиса, по два (основной запрос и хедж)
+        на место в его bulkhead'е
+        """
+        executor = self.hedge_executors.get(service)
+        if executor is None:
+            with self.sessions_lock:
+                executor = self.hedge_executors.get(service)
+                if executor is None:
+                    executor = self.hedge_executors[service] = ThreadPoolExecutor(
+                        2 * bulkhead.max_concurrent, thread_name_prefix=f"hedge-{service}")
+        return executor
+
+    def send_hedge(self, latency, bulkhead, send_at, primary_done, method, url, kwargs):
+        """
+        Если основной запрос не ответил к send_at, отправляет такой же запрос (если есть бюджет хеджей
+        и свободное место в bulkhead'е - его хедж занимает, пока не получит ответ).
+        Возвращает ответ или None, если хедж не отправлялся
+        """
+        if primary_done.wait(max(send_at - monotonic(), 0)) or not bulkhead.try_acquire():
+            return None
+        try:
+            if not latency.budget.withdraw():
+                return None
+            with latency.lock:
+                latency.sent += 1
+            return self.pooled_request(method, url, **kwargs)
+        finally:
+            bulkhead.release()
+
+    def run_primary(self, bulkhead, primary_done, method, url, kwargs):
+        """
+        Основной запрос: освобождает место в bulkhead'е, когда получит ответ, даже если хедж уже выиграл
+        """
+        try:
+            return self.pooled_request(method, url, **kwargs)
+        finally:
+            primary_done.set()
+            bulkhead.release()
+
+    def hedged_request(self, method, url, bulkhead, **kwargs) -> requests.Response:
+        """
+        pooled_request с хеджем: если ответа нет дольше обычного, отправляется второй такой же запрос,
+        и возвращается первый успешный ответ. Место в bulkhead'е, уже занятое вызывающим, освобождает сам,
+        когда закончится основной запрос
+        """
+        service = urlparse(url).netloc
+        latency = self.latency_for(service)
+        delay = latency.hedge_delay()
+        if delay is None:
+            try:
+                return self.pooled_request(method, url, **kwargs)
+            finally:
+                bulkhead.release()
+
+        executor = self.hedge_executor_for(service, bulkhead)
+        primary_done = Event()
+        try:
+            primary = executor.submit(
+                contextvars.copy_context().run, self.run_primary, bulkhead, primary_done, method, url, kwargs)
+        except BaseException:
+            bulkhead.release()
+            raise
+        # задержка отсчитывается от начала основного запроса, а не от того, когда хедж получит поток
+        hedge = executor.submit(
+            contextvars.copy_context().run, self.send_hedge,
+            latency, bulkhead, monotonic() + delay, primary_done, method, url, kwargs
+        )
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and future.result() is not None:
+                    if future is hedge:
+                        with latency.lock:
+                            latency.won += 1
+                    return future.result()
+        # оба запроса не удались (или хедж не отправлялся) - ошибка основного
+        return primary.result()
 
-    def external_request(self, method, url, **kwargs):
+    async def async_hedged_request(self, method, url, bulkhead=None, **kwargs) -> AsyncResponse:
+        """
+        То же, что hedged_request, но проигравший запрос отменяется
+        """
         service = urlparse(url).netloc
+        latency = self.latency_for(service)
+        delay = latency.hedge_delay()
+        first = asyncio.ensure_future(self.async_pooled_request(method, url, **kwargs))
+        if delay is None:
+            return await first
+
+        done, _ = await asyncio.wait([first], timeout=delay)
+        bulkhead = bulkhead or self.bulkhead_for(service)
+        if done or not await bulkhead.async_try_acquire():
+            return await first
+        if not latency.budget.withdraw():
+            bulkhead.async_release()
+            return await first
+
+        async def send_hedge():
+            try:
+                return await self.async_pooled_request(method, url, **kwargs)
+            finally:
+                bulkhead.async_release()
+
+        hedge = asyncio.ensure_future(send_hedge())
+        with latency.lock:
+            latency.sent += 1
+        pending = {first, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if future is hedge:
+                            with latency.lock:
+                                latency.won += 1
+                        return future.result()
+            return first.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def async_pooled_request(self, method, url, **kwargs) -> AsyncResponse:
+        """
+        Одна попытка асинхронного запроса через общую aiohttp сессию
+        """
+        if self.async_session is None:
+            self.async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.pool_maxsize),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]),
+            )
+        async with self.async_session.request(method, url, **kwargs) as aio_resp:
+            return AsyncResponse(aio_resp.status, aio_resp.headers, await aio_resp.read())
+
+    def retry_budget_for(self, service) -> RetryBudget:
+        budget = self.retry_budgets.get(service)
+        if budget is None:
+            budget = self.retry_budgets.setdefault(service, RetryBudget())
+        return budget
+
+    def retry_stats(self) -> dict:
+        """
+        {service: {"retries": ..., "denied": ...}} - выполненные и запрещенные бюджетом повторы
+        """
+        return {
+            service: {"retries": budget.retries, "denied": budget.denied}
+            for service, budget in list(self.retry_budgets.items())
+        }
 
-        if service in self.circuit_breaker_cache:
-            time_passed = time() - self.circuit_breaker_cache[service]
-            if time_passed < self.circuit_breaker_timeout:
-                raise CircuitBreakerException(
-                    f"Curcuit breaker to '{service}' still active, "
-                    f"please wait {int(self.circuit_breaker_timeout - time_passed)} seconds"
-                )
-            del self.circuit_breaker_cache[service]
+    def attempt_timeout(self, remaining):
+        """
+        Таймауты (подключение, чтение) для попытки, не выходящие за дедлайн вызова
+        """
+        connect_timeout, read_timeout = self.timeout
+        remaining = max(remaining, 0.001)
+        return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+    def pool_stats(self) -> dict:
+        """
+        {service: {"requests": ..., "connections": ..., "reused": ...}} по пулам соединений
+        """
+        stats = {}
+        for service, session in list(self.sessions.items()):
+            service_stats = stats[service] = {"requests": 0, "connections": 0, "reused": 0}
+            for adapter in set(session.adapters.values()):
+                for key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools.get(key)
+                    if pool is None:
+                        continue
+                    service_stats["requests"] += pool.num_requests
+                    service_stats["connections"] += pool.num_connections
+            service_stats["reused"] = max(service_stats["requests"] - service_stats["connections"], 0)
+        return stats
+
+    def breaker_for(self, service) -> ServiceBreaker:
+        breaker = self.breakers.get(service)
+        if breaker is None:
+            new_breaker = self.shared.breaker(service) if self.shared else ServiceBreaker(service)
+            breaker = self.breakers.setdefault(service, new_breaker)
+        return breaker
+
+    def breaker_stats(self) -> dict:
+        return {service: breaker.stats() for service, breaker in list(self.breakers.items())}
+
+    @staticmethod
+    def check_deadline(service):
+        if deadline.expired():
+            raise DeadlineExceededException(f"Deadline exceeded before request to '{service}'")
+
+    @staticmethod
+    def with_headers(kwargs) -> dict:
+        """
+        Параметры запроса с заголовками оставшегося до дедлайна времени и трассировки
+        """
+        context_headers = {**deadline.headers(), **tracing.headers()}
+        if not context_headers:
+            return kwargs
+        return {**kwargs, "headers": {**(kwargs.get("headers") or {}), **context_headers}}
+
+    @staticmethod
+    def check_response(resp):
+        """
+        Ответы 555 и 504 (circuit breaker и дедлайн в следующем сервисе) - пробрасываем дальше
+        """
+        if resp.status_code == CIRCUIT_BREAK_STATUS_CODE:
+            raise CircuitBreakerException(resp.text)
+        if resp.status_code == deadline.DEADLINE_EXCEEDED_STATUS:
+            raise DeadlineExceededException(resp.text)
+        return resp
+
+    def failure(self, breaker, exc) -> CircuitBreakerException:
+        """
+        Исключение после того, как все попытки запроса к сервису не удались
+        """
+        if deadline.expired():
+            return DeadlineExceededException(
+                f"Deadline exceeded while requesting '{breaker.service}'. Exception: {repr(exc)}"
+            )
+        if breaker.peek_state() == CLOSED:
+            return CircuitBreakerException(f"Problem with '{breaker.service}'. Exception: {repr(exc)}")
+        return CircuitBreakerException(
+            f"Problem with '{breaker.service}'. Circuit breaker activated. "
+            f"Exception: {repr(exc)}"
+        )
+
+    @staticmethod
+    def acquire(breaker):
+        try:
+            breaker.acquire()
+        except CircuitBreakerException:
+            metrics.observe_dependency(breaker.service, "rejected")
+            raise
+
+    def attempt_failed(self, breaker, exc, duration):
+        """
+        Попытка запроса не удалась. Если время входящего запроса вышло - повторять нечего
+        """
+        metrics.observe_dependency(breaker.service, "error", duration)
+        if deadline.expired():
+            breaker.cancel()
+            raise self.failure(breaker, exc)
+        breaker.record(False, duration)
+
+    def attempt_succeeded(self, breaker, resp, duration):
+        metrics.observe_dependency(breaker.service, "success", duration)
+        breaker.record(True, duration)
+        self.latency_for(breaker.service).add(duration)
+        return self.check_response(resp)
+
+    def external_request(self, method, url, hedge=False, **kwargs):
+        with tracing.span(f"{method} {urlparse(url).netloc}", url=url) as span:
+            resp = self.attempt_requests(method, url, hedge, **kwargs)
+            if span is not None:
+                span.set(status=resp.status_code)
+            return resp
+
+    async def async_external_request(self, method, url, hedge=False, **kwargs) -> AsyncResponse:
+        with tracing.span(f"{method} {urlparse(url).netloc}", url=url) as span:
+            resp = await self.async_attempt_requests(method, url, hedge, **kwargs)
+            if span is not None:
+                span.set(status=resp.status_code)
+            return resp
+
+    def attempt_requests(self, method, url, hedge=False, **kwargs):
+        """
+        Попытки запроса с повторами, circuit breaker'ом, bulkhead'ом и дедлайном
+        """
+        service = urlparse(url).netloc
+        self.check_deadline(service)
+        breaker = self.breaker_for(service)
+        self.acquire(breaker)
+        bulkhead = self.bulkhead_for(service)
 
         exc = None
-        for _ in range(NUMBER_OF_ATTEMPTS):
+        attempts = self.retry_policy.attempts(self.retry_budget_for(service), deadline.remaining())
+        for attempt, (delay, remaining) in enumerate(attempts):
+            if attempt:
+                sleep(delay)
+                if not breaker.try_acquire():
+                    metrics.observe_dependency(service, "rejected")
+                    break
+            try:
+                bulkhead.acquire(remaining)
+            except BaseException as e:
+                breaker.cancel()
+                if isinstance(e, BulkheadFullException):
+                    metrics.observe_dependency(service, "rejected")
+                raise
+            started = monotonic()
+            attempt_kwargs = {"timeout": self.attempt_timeout(remaining), **self.with_headers(kwargs)}
             try:
-                resp = requests.request(method, url, **kwargs)
-                if resp.status_code == CIRCUIT_BREAK_STATUS_CODE:
-                    raise CircuitBreakerException(str(resp.text))
-                return resp
+                if hedge:
+                    # место в bulkhead'е освободит hedged_request, когда закончится основной запрос
+                    resp = self.hedged_request(method, url, bulkhead, **attempt_kwargs)
+                else:
+                    resp = self.pooled_request(method, url, **attempt_kwargs)
             except RequestException as e:
+                self.attempt_failed(breaker, e, monotonic() - started)
                 exc = e
-                sleep(TIME_BETWEEN_ATTEMPTS)
+                continue
+            except BaseException:
+                # попытка прервана (отмена задачи и т.п.): иначе место пробного запроса half-open не освободится
+                breaker.cancel()
+                raise
+            finally:
+                if not hedge:
+                    bulkhead.release()
+            return self.attempt_succeeded(breaker, resp, monotonic() - started)
 
-        self.circuit_breaker_cache[service] = time()
-        raise CircuitBreakerException(
-            f"Problem with '{service}'. Circuit breaker activated. "
-            f"Exception: {repr(exc)}"
-        )
+        raise self.failure(breaker, exc)
+
+    async def async_attempt_requests(self, method, url, hedge=False, **kwargs) -> AsyncResponse:
+        service = urlparse(url).netloc
+        self.check_deadline(service)
+        breaker = self.breaker_for(service)
+        self.acquire(breaker)
+        bulkhead = self.bulkhead_for(service)
+
+        exc = None
+        attempts = self.retry_policy.attempts(self.retry_budget_for(service), deadline.remaining())
+        for attempt, (delay, remaining) in enumerate(attempts):
+            if attempt:
+                await asyncio.sleep(delay)
+                if not breaker.try_acquire():
+                    metrics.observe_dependency(service, "rejected")
+                    break
+            connect_timeout, read_timeout = self.attempt_timeout(remaining)
+            timeout = aiohttp.ClientTimeout(total=remaining, sock_connect=connect_timeout, sock_read=read_timeout)
+            try:
+                await bulkhead.async_acquire(remaining)
+            except BaseException as e:
+                breaker.cancel()
+                if isinstance(e, BulkheadFullException):
+                    metrics.observe_dependency(service, "rejected")
+                raise
+            started = monotonic()
+            try:
+                if hedge:
+                    resp = await self.async_hedged_request(
+                        method, url, bulkhead, timeout=timeout, **self.with_headers(kwargs))
+                else:
+                    resp = await self.async_pooled_request(method, url, timeout=timeout, **self.with_headers(kwargs))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.attempt_failed(breaker, e, monotonic() - started)
+                exc = e
+                continue
+            except BaseException:
+                # попытка прервана (отмена задачи и т.п.): иначе место пробного запроса half-open не освободится
+                breaker.cancel()
+                raise
+            finally:
+                bulkhead.async_release()
+            return self.attempt_succeeded(breaker, resp, monotonic() - started)
+
+        raise self.failure(breaker, exc)
+
+    async def close(self):
+        if self.async_session is not None:
+            await self.async_session.close()
+            self.async_session = None
 
@@ -1,16 +1,122 @@
 # тут подключение к бд и методы для работы с ней
+#
+# Пул соединений настраивается переменными окружения: DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+# DB_POOL_RECYCLE (секунды), DB_POOL_PRE_PING (проверка соединения перед выдачей из пула)
+# и DB_STATEMENT_TIMEOUT_MS (только postgres, 0 - без ограничения). Фабрика сессий одна на процесс.
+#
+# database.install(app) включает для flask-приложения сессию на запрос: все `with Session()`
+# внутри одного запроса используют одну ORM-сессию на одном соединении из пула (каждый блок
+# по-прежнему коммитится при выходе), а соединение возвращается в пул в конце запроса.
+# Вне контекста flask (пул потоков fanout, воркеры) каждая Session - отдельная сессия.
+#
+# Реплики для чтения: DATABASE_REPLICA_URLS - url'ы через запятую. `with ReadSession(key)` открывает
+# сессию на одной из реплик (по кругу), но если по key (пользователь, вещь и т.п.) в этом процессе
+# недавно писали (mark_write(key), в течение READ_YOUR_WRITES_WINDOW секунд), читает из основной базы,
+# чтобы не увидеть устаревшие из-за задержки репликации данные. Без реплик ReadSession - это Session.
+#
+# Миграции: сервис объявляет список Migration (номер версии, название, SQL) и при старте
+# вызывает migrate(имя сервиса, миграции) после create_schema. Примененные версии записываются
+# в таблицу schema_migrations (отдельно для каждого сервиса), так что каждая миграция выполняется
+# один раз; SQL стоит писать идемпотентным (CREATE INDEX IF NOT EXISTS), на случай, если объекты
+# уже созданы вручную.
 
 import os
+from itertools import count
+from time import perf_counter
 
+from flask import g, current_app, has_app_context
+import sqlalchemy as sa
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import Session as ORMSession
 from sqlalchemy.ext.declarative import declarative_base
 
+import metrics
+import tracing
+from cache import TTLCache
+
 Base = declarative_base()
 DATABASE_URL = os.environ.get('DATABASE_URL', "sqlite:///temp.db")
 print("DATABASE_URL:", DATABASE_URL, "($DATABASE_URL)")
-engine = create_engine(DATABASE_URL)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "1") == "1"
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+print(f"DB pool size: {DB_POOL_SIZE} ($DB_POOL_SIZE), max overflow: {DB_MAX_OVERFLOW} ($DB_MAX_OVERFLOW), "
+      f"recycle: {DB_POOL_RECYCLE} ($DB_POOL_RECYCLE), pre-ping: {DB_POOL_PRE_PING} ($DB_POOL_PRE_PING), "
+      f"statement timeout: {DB_STATEMENT_TIMEOUT_MS} ms ($DB_STATEMENT_TIMEOUT_MS)")
+
+
+def make_engine(url=DATABASE_URL):
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+    # у sqlite свой пул без этих настроек
+    if not url.startswith("sqlite"):
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    if DB_STATEMENT_TIMEOUT_MS and url.startswith("postgres"):
+        options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return create_engine(url, **options)
+
+
+engine = make_engine()
+session_factory = sessionmaker(bind=engine)
+
+DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+READ_YOUR_WRITES_WINDOW = float(os.environ.get("READ_YOUR_WRITES_WINDOW", 5))
+print(f"DB replicas: {len(DATABASE_REPLICA_URLS)} ($DATABASE_REPLICA_URLS), "
+      f"read-your-writes window: {READ_YOUR_WRITES_WINDOW} ($READ_YOUR_WRITES_WINDOW)")
+replica_factories = [sessionmaker(bind=make_engine(url)) for url in DATABASE_REPLICA_URLS]
+replica_counter = count()
+# ключи, по которым недавно писали: чтение по ним идет в основную базу
+recent_writes = TTLCache(100000, READ_YOUR_WRITES_WINDOW)
+
+
+migrations_metadata = sa.MetaData()
+schema_migrations = sa.Table(
+    "schema_migrations", migrations_metadata,
+    sa.Column("service", sa.VARCHAR(255), primary_key=True),
+    sa.Column("version", sa.Integer, primary_key=True),
+    sa.Column("name", sa.Text),
+    sa.Column("applied_at", sa.TIMESTAMP, server_default=sa.func.now()),
+)
+
+
+class Migration:
+    def __init__(self, version, name, *statements):
+        self.version = version
+        self.name = name
+        self.statements = statements
+
+
+def migrate(service, migrations, engine_=None) -> list:
+    """
+    Применяет еще не примененные миграции сервиса по порядку версий, каждую в своей транзакции.
+    Возвращает номера примененных версий
+    """
+    engine_ = engine_ or engine
+    migrations_metadata.create_all(engine_, checkfirst=True)
+    applied = []
+    for migration in sorted(migrations, key=lambda m: m.version):
+        with engine_.begin() as connection:
+            if engine_.dialect.name == "postgresql":
+                # несколько процессов сервиса стартуют одновременно - миграции по очереди
+                connection.execute(sa.text("SELECT pg_advisory_xact_lock(hashtext(:service))"), service=service)
+            done = connection.execute(
+                sa.select([schema_migrations.c.version])
+                .where(schema_migrations.c.service == service)
+                .where(schema_migrations.c.version == migration.version)
+            ).first()
+            if done:
+                continue
+            for statement in migration.statements:
+                connection.execute(sa.text(statement))
+            connection.execute(schema_migrations.insert().values(
+                service=service, version=migration.version, name=migration.name
+            ))
+            applied.append(migration.version)
+            print(f"Applied migration {service} #{migration.version}: {migration.name}")
+    return applied
 
 
 def create_schema(engine_=engine):
@@ -21,21 +127,81 @@ def drop_schema(engine_=engine):
     Base.metadata.drop_all(engine_, checkfirst=True)
 
 
+def install(app):
+    """
+    Одна сессия (и одно соединение) на запрос
+    """
+    app.extensions["database_request_scope"] = True
+
+    @app.teardown_appcontext
+    def close_request_session(exc):
+        session = g.pop("db_session", None)
+        connection = g.pop("db_connection", None)
+        if session is not None:
+            session.close()
+        if connection is not None:
+            connection.close()
+
+
+def request_session() -> ORMSession:
+    """
+    Сессия текущего запроса или None, если сессия на запрос не включена (или мы не в запросе)
+    """
+    if not has_app_context() or not current_app.extensions.get("database_request_scope"):
+        return None
+    if "db_session" not in g:
+        g.db_connection = engine.connect()
+        g.db_session = session_factory(bind=g.db_connection)
+    return g.db_session
+
+
 class Session:
     session = None
-    session_class = None
-
-    def __init__(self) -> None:
-        self.session_class = sessionmaker(bind=engine)
 
     def __enter__(self) -> ORMSession:
-        self.session = self.session_class()
+        self.started = perf_counter()
+        self.span = tracing.span("db session")
+        self.span.__enter__()
+        self.session = request_session()
+        self.request_scoped = self.session is not None
+        if not self.request_scoped:
+            self.session = session_factory()
         return self.session
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
-        if not exc_type:
-            self.session.commit()
-        else:
-            self.session.rollback()
-        self.session.close()
-        self.session = None
+        try:
+            if not exc_type:
+                self.session.commit()
+            else:
+                self.session.rollback()
+            if not self.request_scoped:
+                self.session.close()
+            self.session = None
+        finally:
+            metrics.db_session_duration.observe(perf_counter() - self.started, "rollback" if exc_type else "commit")
+            self.span.__exit__(exc_type, exc_val, exc_tb)
+
+
+def mark_write(*keys):
+    """
+    По этим ключам только что писали: READ_YOUR_WRITES_WINDOW секунд читать их из основной базы
+    """
+    recent_writes.set_many({key: True for key in keys})
+
+
+class ReadSession(Session):
+    """
+    Сессия только для чтения: на реплике, если по keys недавно не писали, иначе как Session
+    """
+    def __init__(self, *keys):
+        self.keys = keys
+
+    def __enter__(self) -> ORMSession:
+        if not replica_factories or recent_writes.get_many(self.keys):
+            return super().__enter__()
+        self.started = perf_counter()
+        self.span = tracing.span("db read session")
+        self.span.__enter__()
+        self.request_scoped = False
+        self.session = replica_factories[next(replica_counter) % len(replica_factories)]()
+        return self.session
@@ -0,0 +1,79 @@
+# Дедлайн запроса, общий для всей цепочки store -> order -> warehouse -> warranty
+# store_service (край системы) задает запросу DEFAULT_DEADLINE_MS миллисекунд (если клиент не прислал
+# свой заголовок), и при каждом обращении к следующему сервису в заголовке DEADLINE_HEADER передается,
+# сколько миллисекунд осталось. Каждый сервис сразу отвечает DEADLINE_EXCEEDED_STATUS на запросы,
+# время которых уже вышло, а CircuitBreaker.external_request не ждет ответа дольше оставшегося времени.
+#
+# Дедлайн хранится в contextvars, поэтому переходит в потоки fanout и в задачи asyncio.
+#
+# Использование: deadline.install(app) для flask-приложения
+# (deadline.install(app, DEFAULT_DEADLINE_MS) на краю системы)
+
+import os
+import contextvars
+from time import monotonic
+
+from flask import request
+
+DEADLINE_HEADER = "X-Deadline-Ms"
+DEADLINE_EXCEEDED_STATUS = 504
+DEFAULT_DEADLINE_MS = int(os.environ.get("DEFAULT_DEADLINE_MS", 10000))
+print(f"Default deadline: {DEFAULT_DEADLINE_MS} ms ($DEFAULT_DEADLINE_MS)")
+
+# момент (по monotonic), к которому запрос должен быть выполнен, или None, если дедлайна нет
+deadline_at = contextvars.ContextVar("deadline_at", default=None)
+
+
+def start(header_value=None, default_ms=None):
+    """
+    Задает дедлайн текущего запроса по значению заголовка (или default_ms, если заголовка нет).
+    Некорректный заголовок игнорируется
+    """
+    try:
+        remaining_ms = float(header_value) if header_value is not None else default_ms
+    except ValueError:
+        remaining_ms = default_ms
+    deadline_at.set(None if remaining_ms is None else monotonic() + remaining_ms / 1000)
+
+
+def clear():
+    deadline_at.set(None)
+
+
+def remaining():
+    """
+    Сколько секунд осталось до дедлайна (может быть отрицательным) или None, если дедлайна нет
+    """
+    at = deadline_at.get()
+    return None if at is None else at - monotonic()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def headers() -> dict:
+    """
+    Заголовок с оставшимся временем для запроса в следующий сервис
+    """
+    left = remaining()
+    if left is None:
+        return {}
+    return {DEADLINE_HEADER: str(max(int(left * 1000), 0))}
+
+
+def expired_response():
+    return {"message": "Deadline exceeded"}, DEADLINE_EXCEEDED_STATUS
+
+
+def install(app, default_ms=None):
+    @app.before_request
+    def start_deadline():
+        start(request.headers.get(DEADLINE_HEADER), default_ms)
+        if expired():
+            return expired_response()
+
+    @app.teardown_request
+    def clear_deadline(exc):
+        clear()
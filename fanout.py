@@ -0,0 +1,55 @@
+# Параллельный запуск независимых запросов к другим сервисам
+# Все запросы выполняются в общем ограниченном пуле потоков FANOUT_POOL_SIZE,
+# а в рамках одного входящего запроса одновременно выполняется не больше
+# FANOUT_MAX_CONCURRENCY задач, чтобы один большой запрос не занял все исходящие соединения.
+#
+# Использование:
+#     with fan_out.limited() as pool:
+#         a = pool.submit(func_a, arg)
+#         b = pool.submit(func_b, arg)
+#     a.result(), b.result()  # исключения пробрасываются из .result()
+
+import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import BoundedSemaphore
+
+FANOUT_POOL_SIZE = int(os.environ.get("FANOUT_POOL_SIZE", 32))
+FANOUT_MAX_CONCURRENCY = int(os.environ.get("FANOUT_MAX_CONCURRENCY", 4))
+print(f"Fan-out pool size: {FANOUT_POOL_SIZE} ($FANOUT_POOL_SIZE), "
+      f"max concurrency per request: {FANOUT_MAX_CONCURRENCY} ($FANOUT_MAX_CONCURRENCY)")
+
+
+class FanOutScope:
+    """
+    Набор задач одного входящего запроса. При выходе из with дожидается всех задач
+    """
+    def __init__(self, executor, max_concurrency):
+        self.executor = executor
+        self.semaphore = BoundedSemaphore(max_concurrency)
+        self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        wait(self.futures)
+
+    def submit(self, func, *args, **kwargs):
+        # ждем в потоке запроса, пока не освободится место, а не в потоке пула
+        self.semaphore.acquire()
+        # контекст (contextvars) запроса передается в поток пула
+        context = contextvars.copy_context()
+        future = self.executor.submit(context.run, func, *args, **kwargs)
+        future.add_done_callback(lambda _: self.semaphore.release())
+        self.futures.append(future)
+        return future
+
+
+class FanOut:
+    def __init__(self, pool_size=FANOUT_POOL_SIZE, max_concurrency=FANOUT_MAX_CONCURRENCY):
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="fanout")
+        self.max_concurrency = max_concurrency
+
+    def limited(self, max_concurrency=None) -> FanOutScope:
+        return FanOutScope(self.executor, max_concurrency or self.max_concurrency)
@@ -0,0 +1,97 @@
+# Групповая запись (group commit)
+# Одновременные вызовы GroupCommitter.submit(запись) собираются в пачку: до max_batch записей
+# или сколько пришло за max_wait секунд после первой, и вся пачка пишется одним вызовом
+# write_batch (один многострочный INSERT и один commit вместо commit'а на каждую строку).
+# submit возвращается только после того, как пачка закоммичена, то есть запись уже надежно в базе.
+#
+# Если пачка не записалась, записи пишутся по одной, чтобы ошибку (например, нарушение unique)
+# получил только тот, чья запись ее вызвала.
+# Пишет пачки один фоновый поток (запускается при первом submit): пока коммитится одна пачка,
+# собирается следующая.
+#
+# Использование:
+#     committer = GroupCommitter("warranty", insert_warranties, max_batch=100, max_wait=0.005)
+#     committer.submit(item_uid)
+
+from queue import Queue, Empty
+from threading import Event, Lock, Thread
+from time import perf_counter
+
+import metrics
+
+
+class Pending:
+    def __init__(self, item):
+        self.item = item
+        self.done = Event()
+        self.error = None
+        self.submitted = perf_counter()
+
+
+class GroupCommitter:
+    def __init__(self, name, write_batch, max_batch, max_wait):
+        self.name = name
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.lock = Lock()
+        self.thread = None
+
+    def submit(self, item):
+        """
+        Записывает item в составе пачки и ждет commit'а. Ошибку записи пробрасывает вызывающему
+        """
+        entry = Pending(item)
+        self.start()
+        self.queue.put(entry)
+        entry.done.wait()
+        if entry.error is not None:
+            raise entry.error
+
+    def start(self):
+        # поток запускается лениво: после fork'а воркера, а не при импорте
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = Thread(target=self.run, name=f"group-commit-{self.name}", daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            self.commit(self.collect())
+
+    def collect(self) -> list:
+        """
+        Первая запись из очереди и все, что успеет прийти за max_wait (но не больше max_batch)
+        """
+        batch = [self.queue.get()]
+        window_end = perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            left = window_end - perf_counter()
+            if left <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=left))
+            except Empty:
+                break
+        return batch
+
+    def commit(self, batch):
+        metrics.group_commit_batch_size.observe(len(batch), self.name)
+        try:
+            self.write_batch([entry.item for entry in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = e
+            else:
+                # пачка откатилась целиком: пишем по одной, чтобы найти виноватые записи
+                for entry in batch:
+                    try:
+                        self.write_batch([entry.item])
+                    except Exception as entry_error:
+                        entry.error = entry_error
+        committed = perf_counter()
+        for entry in batch:
+            metrics.group_commit_wait.observe(committed - entry.submitted, self.name)
+            entry.done.set()
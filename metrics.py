@@ -0,0 +1,217 @@
+# Метрики сервисов в текстовом формате Prometheus (GET /manage/metrics)
+# Счетчики и гистограммы хранятся в памяти процесса; запись - один словарь и Lock на метрику,
+# без выделения памяти под уже встречавшиеся метки. Gauge'и (размеры кэшей, пулы, bulkhead'ы и т.п.)
+# не хранятся, а собираются функциями в момент запроса /manage/metrics.
+#
+# Что собирается:
+#   http_requests_total, http_request_duration_seconds           - входящие запросы по route/method/status
+#   dependency_requests_total, dependency_request_duration_seconds - попытки запросов в другие сервисы
+#                                                                    по dependency/outcome (circuit_breaker.py)
+#   circuit_breaker_transitions_total                            - переходы состояний circuit breaker'а
+#   db_session_duration_seconds                                  - время жизни database.Session
+#   queue_messages_total                                         - публикация/получение сообщений rabbitmq
+#   group_commit_batch_size, group_commit_wait_seconds           - размер пачек group_commit.py и время
+#                                                                  от submit до commit'а
+#
+# Использование: metrics.install(app) для flask-приложения
+
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+
+from flask import g, request
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.values.get(label_values, 0)
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # метки -> [счетчики по корзинам (+Inf последняя), сумма, количество]
+        self.lock = Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, *label_values):
+        entry = self.values.get(label_values)
+        return entry[2] if entry else 0
+
+    def render(self):
+        with self.lock:
+            values = [(label_values, list(counts), total, count)
+                      for label_values, (counts, total, count) in self.values.items()]
+        for label_values, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels, label_values, [("le", bound)])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, label_values)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(self.labels, label_values)} {count}"
+
+
+class Gauges:
+    """
+    Gauge, значения которого собирает collect() -> [(значения меток, значение)]
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels, collect):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+
+    def render(self):
+        for label_values, value in self.collect():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        # при повторной регистрации (например, повторный импорт модуля в тестах) остается последняя
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauges(self, name, help, labels, collect) -> Gauges:
+        return self.register(Gauges(name, help, labels, collect))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} collection failed: {repr(e)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "http_requests_total", "Incoming HTTP requests", ("route", "method", "status"))
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Incoming HTTP request latency", ("route", "method", "status"))
+dependency_requests = registry.counter(
+    "dependency_requests_total", "Outbound request attempts", ("dependency", "outcome"))
+dependency_request_duration = registry.histogram(
+    "dependency_request_duration_seconds", "Outbound request attempt latency", ("dependency", "outcome"))
+breaker_transitions = registry.counter(
+    "circuit_breaker_transitions_total", "Circuit breaker state transitions", ("dependency", "from", "to"))
+db_session_duration = registry.histogram(
+    "db_session_duration_seconds", "Database session lifetime", ("outcome",))
+queue_messages = registry.counter(
+    "queue_messages_total", "RabbitMQ messages by operation", ("operation",))
+group_commit_batch_size = registry.histogram(
+    "group_commit_batch_size", "Rows written by one group commit", ("name",),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+group_commit_wait = registry.histogram(
+    "group_commit_wait_seconds", "Time from group commit submit to commit", ("name",))
+
+
+def observe_request(route, method, status, duration):
+    http_requests.inc(route, method, str(status))
+    http_request_duration.observe(duration, route, method, str(status))
+
+
+def observe_dependency(dependency, outcome, duration=None):
+    """
+    outcome: success (сервис ответил), error (не ответил), rejected (не отправлен: circuit breaker/bulkhead)
+    """
+    dependency_requests.inc(dependency, outcome)
+    if duration is not None:
+        dependency_request_duration.observe(duration, dependency, outcome)
+
+
+def stats_gauges(name, help, label, stats, fields):
+    """
+    Gauge'и из словаря статистики вида {key: {field: value}} с метками label=key и field
+    """
+    def collect():
+        return [((key, field), values[field])
+                for key, values in stats().items() for field in fields if values.get(field) is not None]
+    return registry.gauges(name, help, (label, "field"), collect)
+
+
+def render_response():
+    return registry.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+
+def install(app):
+    @app.before_request
+    def start_timer():
+        g.metrics_started = perf_counter()
+
+    @app.after_request
+    def observe(response):
+        started = g.get("metrics_started")
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            observe_request(route, request.method, response.status_code, perf_counter() - started)
+        return response
+
+    app.add_url_rule("/manage/metrics", "metrics", render_response, methods=["GET"])
@@ -1,26 +1,46 @@
 import os
+import json
+import base64
+import binascii
 from uuid import uuid4
 from enum import Enum
-from datetime import date
+from datetime import date, datetime
+from typing import List
 
 from pydantic import BaseModel, ValidationError
 from flask import Flask, request, jsonify
 from werkzeug.exceptions import BadRequest
 import sqlalchemy as sa
-import requests
 
 import database
+import deadline
+import metrics
+import tracing
 import circuit_breaker as cb
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
+metrics.install(app)
+tracing.install(app)
+database.install(app)
+deadline.install(app)
 ROOT_PATH = "/api/v1"
 WAREHOUSE_SERVICE_URL = os.environ.get("WAREHOUSE_SERVICE_URL", "localhost:8280")
 print(f"Warehouse service url: {WAREHOUSE_SERVICE_URL} ($WAREHOUSE_SERVICE_URL)")
 WARRANTY_SERVICE_URL = os.environ.get("WARRANTY_SERVICE_URL", "localhost:8180")
 print(f"Warranty service url: {WARRANTY_SERVICE_URL} ($WARRANTY_SERVICE_URL)")
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 1000))
+print(f"Max page size: {MAX_PAGE_SIZE} ($MAX_PAGE_SIZE)")
+# сколько вещей можно заказать одним запросом /batch
+MAX_BASKET_SIZE = int(os.environ.get("MAX_BASKET_SIZE", 100))
+print(f"Max basket size: {MAX_BASKET_SIZE} ($MAX_BASKET_SIZE)")
+# заголовок, в котором возвращается курсор следующей страницы заказов
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# заголовок, в котором возвращается вещь заказа (по нему store сбрасывает свой кэш)
+ITEM_UID_HEADER = "X-Item-Uid"
 
 circuit_breaker = cb.CircuitBreaker()
+circuit_breaker.export_metrics()
 
 # ------------------------------ dto ------------------------------
 
@@ -35,11 +55,23 @@ class Order(database.Base):
     user_uid = sa.Column(sa.Text)
 
 
+# индексы под запросы сервиса (применяются при старте через database.migrate)
+MIGRATIONS = [
+    # список заказов пользователя: фильтр по user_uid, сортировка и курсор по order_date
+    database.Migration(1, "orders by user and date",
+                       "CREATE INDEX IF NOT EXISTS ix_orders_user_uid_order_date ON orders (user_uid, order_date)"),
+]
+
+
 class NewOrderRequest(BaseModel):
     model: str
     size: str
 
 
+class NewBasketRequest(BaseModel):
+    items: List[NewOrderRequest]
+
+
 class WarrantyRequest(BaseModel):
     reason: str
 
@@ -52,6 +84,25 @@ class Status(str, Enum):
 # ------------------------------ вспомогательные функции ------------------------------
 
 
+def encode_cursor(order):
+    """
+    Непрозрачный курсор на позицию после заказа order в порядке (order_date, id)
+    """
+    position = json.dumps([order.order_date.isoformat(), order.id])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    (order_date, id) из курсора. ValueError, если курсор некорректный
+    """
+    try:
+        order_date, order_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(order_date), int(order_id)
+    except (binascii.Error, TypeError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"bad cursor: {e}")
+
+
 @app.errorhandler(Exception)
 def default_error_handler(error):
     return {
@@ -66,6 +117,11 @@ def health_check():
     return "UP", 200
 
 
+@app.route("/manage/circuit-breaker", methods=["GET"])
+def circuit_breaker_stats():
+    return circuit_breaker.stats(), 200
+
+
 @app.route(f"{ROOT_PATH}/orders/<string:user_uid>", methods=["POST"])
 @cb.handles_circuit_break
 def request_new_order(user_uid):
@@ -108,7 +164,7 @@ def request_new_order(user_uid):
         )
     except cb.CircuitBreakerException:
         # Откат, если недоступен warranty service, в базу ничего сохранено не будет
-        requests.delete(f"http://{WAREHOUSE_SERVICE_URL}{ROOT_PATH}/warehouse/{item_uid}")
+        circuit_breaker.pooled_request("DELETE", f"http://{WAREHOUSE_SERVICE_URL}{ROOT_PATH}/warehouse/{item_uid}")
         return "Warranty service suddenly became unavailable, rolling back", 502
 
     # сохраняем в базу
@@ -120,17 +176,103 @@ def request_new_order(user_uid):
             status=Status.paid,
             user_uid=user_uid,
         ))
+    # следующие GET этого пользователя читают из основной базы, а не с отстающей реплики
+    database.mark_write(user_uid)
 
     return {"orderUid": order_uid}, 200
 
 
+@app.route(f"{ROOT_PATH}/orders/<string:user_uid>/batch", methods=["POST"])
+@cb.handles_circuit_break
+def request_new_orders_batch(user_uid):
+    """
+    Сделать сразу несколько заказов от имени пользователя: по одному запросу в warehouse и warranty
+    на всю корзину, все или ничего
+    """
+    # парсим входные данные
+    try:
+        basket_request = NewBasketRequest.parse_obj(request.get_json(force=True))
+    except BadRequest:
+        return {"message": "Bad json"}, 400
+    except ValidationError as e:
+        return {"message": e.errors()}, 400
+    if not 0 < len(basket_request.items) <= MAX_BASKET_SIZE:
+        return {"message": f"items count should be in range 1..{MAX_BASKET_SIZE}"}, 400
+
+    order_uids = [str(uuid4()) for _ in basket_request.items]
+
+    # резервируем все item'ы в warehouse одной транзакцией (если хоть одного нет, не резервируется ничего)
+    warehouse_service_response = circuit_breaker.external_request(
+        "POST",
+        f"http://{WAREHOUSE_SERVICE_URL}{ROOT_PATH}/warehouse/batch/reserve",
+        json={"items": [
+            {"orderUid": order_uid, "model": item.model, "size": item.size}
+            for order_uid, item in zip(order_uids, basket_request.items)
+        ]}
+    )
+    if not warehouse_service_response.ok:
+        return {"message": f"bad response from warehouse "
+                           f"({warehouse_service_response.status_code}): "
+                           f"{warehouse_service_response.text}"}, 422
+    item_uids = [item["orderItemUid"] for item in warehouse_service_response.json()]
+
+    def release_items():
+        circuit_breaker.pooled_request(
+            "POST",
+            f"http://{WAREHOUSE_SERVICE_URL}{ROOT_PATH}/warehouse/batch/release",
+            json={"itemUids": item_uids}
+        )
+
+    # создаем все гарантии в warranty service
+    try:
+        warranty_service_response = circuit_breaker.external_request(
+            "POST",
+            f"http://{WARRANTY_SERVICE_URL}{ROOT_PATH}/warranty/batch/start",
+            json={"itemUids": item_uids}
+        )
+    except cb.CircuitBreakerException:
+        # Откат, если недоступен warranty service, в базу ничего сохранено не будет
+        release_items()
+        return "Warranty service suddenly became unavailable, rolling back", 502
+    if not warranty_service_response.ok:
+        release_items()
+        return {"message": f"bad response from warranty "
+                           f"({warranty_service_response.status_code}): "
+                           f"{warranty_service_response.text}"}, 422
+
+    # сохраняем все заказы в базу одной транзакцией
+    try:
+        with database.Session() as s:
+            s.add_all([
+                Order(
+                    item_uid=item_uid,
+                    order_date=date.today(),
+                    order_uid=order_uid,
+                    status=Status.paid,
+                    user_uid=user_uid,
+                ) for order_uid, item_uid in zip(order_uids, item_uids)
+            ])
+    except Exception:
+        # откат гарантий и item'ов, раз заказы не сохранились
+        circuit_breaker.pooled_request(
+            "POST",
+            f"http://{WARRANTY_SERVICE_URL}{ROOT_PATH}/warranty/batch/stop",
+            json={"itemUids": item_uids}
+        )
+        release_items()
+        raise
+    database.mark_write(user_uid)
+
+    return {"orderUids": order_uids}, 200
+
+
 @app.route(f"{ROOT_PATH}/orders/<string:user_uid>/<string:order_uid>", methods=["GET"])
 def request_order(user_uid, order_uid):
     """
     Получить информацию по конкретному заказу пользователя
     """
-    # просто достаем order из базы
-    with database.Session() as s:
+    # просто достаем order из базы (реплики)
+    with database.ReadSession(user_uid) as s:
         order = (
             s.query(Order)
             .filter(Order.order_uid == order_uid)
@@ -152,10 +294,43 @@ def request_order(user_uid, order_uid):
 def request_all_orders(user_uid):
     """
     Получить все заказы пользователя
+    Если передан ?limit=N, возвращается только N заказов, а курсор на следующую страницу
+    возвращается в заголовке X-Next-Cursor (его нужно передать в ?cursor=...)
     """
-    # просто достаем order'ы из базы
-    with database.Session() as s:
-        orders = s.query(Order).filter(Order.user_uid == user_uid).all()
+    # парсим параметры страницы
+    try:
+        limit = request.args.get("limit")
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                return {"message": "limit should be an integer"}, 400
+        if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+            return {"message": f"limit should be in range 1..{MAX_PAGE_SIZE}"}, 400
+        cursor = request.args.get("cursor")
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return {"message": str(e)}, 400
+
+    # достаем order'ы из базы (реплики) по порядку (order_date, id), начиная с позиции курсора
+    with database.ReadSession(user_uid) as s:
+        query = s.query(Order).filter(Order.user_uid == user_uid)
+        if after:
+            after_date, after_id = after
+            query = query.filter(sa.or_(
+                Order.order_date > after_date,
+                sa.and_(Order.order_date == after_date, Order.id > after_id)
+            ))
+        query = query.order_by(Order.order_date, Order.id)
+        if limit is not None:
+            # берем на один больше, чтобы понять, есть ли следующая страница
+            query = query.limit(limit + 1)
+        orders = query.all()
+
+        headers = {}
+        if limit is not None and len(orders) > limit:
+            orders = orders[:limit]
+            headers[NEXT_CURSOR_HEADER] = encode_cursor(orders[-1])
 
         result = [{
             "orderUid": order.order_uid,
@@ -163,7 +338,7 @@ def request_all_orders(user_uid):
             "itemUid": order.item_uid,
             "status": order.status
         } for order in orders]
-        return jsonify(result), 200
+        return jsonify(result), 200, headers
 
 
 @app.route(f"{ROOT_PATH}/orders/<string:order_uid>/warranty", methods=["POST"])
@@ -194,8 +369,9 @@ def request_warranty(order_uid):
         )
         if not warehouse_service_response.ok:
             return {"message": "Warranty not found"}, 404
+        item_uid = order.item_uid
 
-    return warehouse_service_response.json(), 200
+    return warehouse_service_response.json(), 200, {ITEM_UID_HEADER: item_uid}
 
 
 @app.route(f"{ROOT_PATH}/orders/<string:order_uid>", methods=["DELETE"])
@@ -220,11 +396,15 @@ def request_delete_order(order_uid):
 
         # удаляем из базы
         s.delete(order)
-    return '', 204
+        user_uid = order.user_uid
+        item_uid = order.item_uid
+    database.mark_write(user_uid)
+    return '', 204, {ITEM_UID_HEADER: item_uid}
 
 
 if __name__ == '__main__':
     PORT = os.environ.get("PORT", 8380)
     print("LISTENING ON PORT:", PORT, "($PORT)")
     database.create_schema()
+    database.migrate("order_service", MIGRATIONS)
     app.run("0.0.0.0", PORT)
@@ -1,45 +1,351 @@
 # тут подключение к rabbitmq и методы для работы с ним
+#
+# Соединения с rabbitmq долгоживущие: на процесс держится пул из QUEUE_POOL_SIZE соединений
+# (у каждого свой канал, очередь на нем объявляется один раз при подключении).
+# `with Queue() as q` берет соединение из пула и возвращает его обратно; перед выдачей
+# соединение проверяется и при необходимости переподключается.
+#
+# Подтверждения публикации (QUEUE_PUBLISH_CONFIRMS):
+#   none  - без подтверждений (по умолчанию)
+#   each  - publisher confirms: каждый publish ждет подтверждения брокера
+#   batch - publisher confirms пачкой: одновременные publish (в том числе из разных `with Queue()`)
+#           собираются через GroupCommitter - до QUEUE_CONFIRM_BATCH_SIZE сообщений или сколько пришло
+#           за QUEUE_CONFIRM_MAX_WAIT_MS - и публикуются подряд с одним ожиданием подтверждений на пачку.
+#           publish возвращается после подтверждения. Пачки публикует отдельное соединение
+#           (сверх QUEUE_POOL_SIZE), которым пользуется только поток GroupCommitter'а.
+#           Если брокер отклонил пачку, она переотправляется по одному сообщению (возможны дубли)
+#
+# QUEUE_URL=memory:// - вместо rabbitmq очередь в памяти процесса (для тестов и локального запуска)
 
 import os
 import json
+from collections import deque
+from itertools import count
+from queue import LifoQueue, Empty
+from threading import BoundedSemaphore
 
 import pika
 
+import metrics
+import tracing
+from group_commit import GroupCommitter
+
 QUEUE_URL = os.environ.get("QUEUE_URL", "amqp://localhost")
 QUEUE_NAME = "warranty"
 print(f"RabbitMQ url: {QUEUE_URL} ($QUEUE_URL). Queue name: '{QUEUE_NAME}'")
+QUEUE_POOL_SIZE = int(os.environ.get("QUEUE_POOL_SIZE", 4))
+QUEUE_PUBLISH_CONFIRMS = os.environ.get("QUEUE_PUBLISH_CONFIRMS", "none")
+QUEUE_CONFIRM_BATCH_SIZE = int(os.environ.get("QUEUE_CONFIRM_BATCH_SIZE", 100))
+QUEUE_CONFIRM_MAX_WAIT_MS = float(os.environ.get("QUEUE_CONFIRM_MAX_WAIT_MS", 5))
+print(f"RabbitMQ pool size: {QUEUE_POOL_SIZE} ($QUEUE_POOL_SIZE), "
+      f"publish confirms: {QUEUE_PUBLISH_CONFIRMS} ($QUEUE_PUBLISH_CONFIRMS)")
+print(f"RabbitMQ confirm batch size: {QUEUE_CONFIRM_BATCH_SIZE} ($QUEUE_CONFIRM_BATCH_SIZE), "
+      f"max wait: {QUEUE_CONFIRM_MAX_WAIT_MS} ms ($QUEUE_CONFIRM_MAX_WAIT_MS)")
 
 
-class Queue:
-    def __enter__(self):
+class PooledChannel:
+    """
+    Соединение с rabbitmq и канал на нем с уже объявленной очередью
+    """
+    def __init__(self, confirms):
         self.connection = pika.BlockingConnection(pika.URLParameters(QUEUE_URL))
         self.channel = self.connection.channel()
         self.channel.queue_declare(queue=QUEUE_NAME)
+        if confirms == "each":
+            self.channel.confirm_delivery()
+        elif confirms == "batch":
+            self.select_async_confirms()
+        self.consuming = False
+        # delivery tag'и выданных, но еще не подтвержденных сообщений
+        self.unacked = set()
+
+    def is_healthy(self) -> bool:
+        if not (self.connection.is_open and self.channel.is_open):
+            return False
+        try:
+            # заодно обрабатывает heartbeat'ы, накопившиеся, пока соединение лежало в пуле
+            self.connection.process_data_events(time_limit=0)
+            return True
+        except pika.exceptions.AMQPError:
+            return False
+
+    def settle(self, delivery_tag, multiple=False):
+        """
+        Сообщение (при multiple - все до delivery_tag включительно) подтверждено или возвращено
+        """
+        if multiple:
+            self.unacked = {tag for tag in self.unacked if tag > delivery_tag}
+        else:
+            self.unacked.discard(delivery_tag)
+
+    def select_async_confirms(self):
+        """
+        Confirm mode без ожидания на каждом publish: BlockingChannel в confirm mode ждет подтверждения
+        каждого сообщения, поэтому подтверждения принимаются callback'ом нижележащего канала
+        """
+        self.published = 0
+        # номера опубликованных, но еще не подтвержденных сообщений и сколько из них брокер отклонил
+        self.unconfirmed = set()
+        self.nacked = 0
+        selected = []
+        self.channel._impl.confirm_delivery(ack_nack_callback=self.on_confirm, callback=selected.append)
+        while not selected:
+            self.connection.process_data_events(time_limit=1)
+
+    def on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            settled = {tag for tag in self.unconfirmed if tag <= method.delivery_tag}
+        else:
+            settled = self.unconfirmed & {method.delivery_tag}
+        self.unconfirmed -= settled
+        if isinstance(method, pika.spec.Basic.Nack):
+            self.nacked += len(settled)
+
+    def publish_confirmed(self, bodies):
+        """
+        Публикует пачку подряд и один раз ждет подтверждения всех ее сообщений
+        """
+        for body in bodies:
+            self.channel._impl.basic_publish(exchange='', routing_key=QUEUE_NAME, body=body)
+            self.published += 1
+            self.unconfirmed.add(self.published)
+        while self.unconfirmed:
+            self.connection.process_data_events(time_limit=1)
+        if self.nacked:
+            self.nacked = 0
+            raise pika.exceptions.NackError([])
+
+    def close(self):
+        try:
+            self.connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+
+
+class BatchPublisher:
+    """
+    Публикация с подтверждениями пачкой (QUEUE_PUBLISH_CONFIRMS=batch)
+    """
+    def __init__(self, max_batch, max_wait):
+        self.pooled = None
+        self.committer = GroupCommitter("queue", self.publish_batch, max_batch, max_wait)
+
+    def submit(self, body):
+        """
+        Публикует сообщение в составе пачки и ждет подтверждения брокера
+        """
+        self.committer.submit(body)
+
+    def publish_batch(self, bodies):
+        if self.pooled is not None and not self.pooled.is_healthy():
+            self.pooled.close()
+            self.pooled = None
+        try:
+            if self.pooled is None:
+                self.pooled = PooledChannel("batch")
+            self.pooled.publish_confirmed(bodies)
+        except pika.exceptions.AMQPError as e:
+            # после nack'а канал жив, а потерянное соединение переоткроется на следующей пачке
+            if not isinstance(e, pika.exceptions.NackError) and self.pooled is not None:
+                self.pooled.close()
+                self.pooled = None
+            raise
+
+
+class ChannelPool:
+    def __init__(self, size, confirms):
+        self.confirms = confirms
+        self.idle = LifoQueue()
+        self.semaphore = BoundedSemaphore(size)
+        # каналы пула публикуют сами только при none/each, при batch - через publisher
+        self.publisher = None
+        if confirms == "batch":
+            self.publisher = BatchPublisher(QUEUE_CONFIRM_BATCH_SIZE, QUEUE_CONFIRM_MAX_WAIT_MS / 1000)
+
+    def acquire(self) -> PooledChannel:
+        self.semaphore.acquire()
+        try:
+            while True:
+                try:
+                    pooled = self.idle.get_nowait()
+                except Empty:
+                    return PooledChannel("none" if self.publisher else self.confirms)
+                if pooled.is_healthy():
+                    return pooled
+                pooled.close()
+        except Exception:
+            self.semaphore.release()
+            raise
+
+    def release(self, pooled: PooledChannel, broken=False):
+        try:
+            if broken:
+                pooled.close()
+            else:
+                # отменяем consumer'а, если он был: вернутся в очередь только сообщения, которые
+                # pika получила, но еще не выдала
+                if pooled.consuming:
+                    pooled.channel.cancel()
+                    pooled.consuming = False
+                # выданные, но не подтвержденные сообщения сами не вернутся, пока соединение живо,
+                # а оно переиспользуется - возвращаем их в очередь явно
+                if pooled.unacked:
+                    pooled.channel.basic_nack(delivery_tag=0, multiple=True, requeue=True)
+                    pooled.unacked.clear()
+                self.idle.put(pooled)
+        except pika.exceptions.AMQPError:
+            pooled.close()
+        finally:
+            self.semaphore.release()
+
+
+pool = ChannelPool(QUEUE_POOL_SIZE, QUEUE_PUBLISH_CONFIRMS)
+
+
+class Queue:
+    def __enter__(self):
+        self.pooled = pool.acquire()
+        self.channel = self.pooled.channel
         return self
 
-    def __exit__(self, *args):
-        self.connection.close()
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        broken = isinstance(exc_val, pika.exceptions.AMQPError)
+        pool.release(self.pooled, broken=broken)
 
     def publish(self, data: "json dict"):
-        self.channel.basic_publish(exchange='', routing_key=QUEUE_NAME, body=json.dumps(data))
+        with tracing.span("queue publish", queue=QUEUE_NAME):
+            if pool.publisher is not None:
+                pool.publisher.submit(json.dumps(data))
+            else:
+                self.channel.basic_publish(exchange='', routing_key=QUEUE_NAME, body=json.dumps(data))
+            metrics.queue_messages.inc("publish")
 
     def consume(self) -> "generator (json)":
+        self.pooled.consuming = True
         for method_frame, properties, body in self.channel.consume(QUEUE_NAME, inactivity_timeout=0):
             if not method_frame:
                 break
+            metrics.queue_messages.inc("consume")
+            self.pooled.unacked.add(method_frame.delivery_tag)
             yield json.loads(body)
-            self.channel.basic_ack(method_frame.delivery_tag)
+            self.ack(method_frame.delivery_tag)
+
+    def set_prefetch(self, prefetch_count):
+        """
+        Сколько неподтвержденных сообщений брокер может отдать этому каналу
+        """
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+
+    def get_batch(self, max_count, timeout=1) -> "list (delivery_tag, json)":
+        """
+        До max_count сообщений без подтверждения. Ждет не дольше timeout секунд, если очередь пуста.
+        Сообщения нужно подтвердить через ack (можно сразу пачкой) или вернуть через nack
+        """
+        batch = []
+        self.pooled.consuming = True
+        with tracing.span("queue get batch", queue=QUEUE_NAME) as span:
+            for method_frame, properties, body in self.channel.consume(QUEUE_NAME, inactivity_timeout=timeout):
+                if not method_frame:
+                    break
+                self.pooled.unacked.add(method_frame.delivery_tag)
+                batch.append((method_frame.delivery_tag, json.loads(body)))
+                if len(batch) >= max_count:
+                    break
+            if span is not None:
+                span.set(messages=len(batch))
+        if batch:
+            metrics.queue_messages.inc("consume", amount=len(batch))
+        return batch
+
+    def ack(self, delivery_tag, multiple=False):
+        """
+        Подтверждает сообщение (при multiple=True - все неподтвержденные до delivery_tag включительно)
+        """
+        self.channel.basic_ack(delivery_tag, multiple=multiple)
+        self.pooled.settle(delivery_tag, multiple)
+        metrics.queue_messages.inc("ack")
+
+    def nack(self, delivery_tag, requeue=True):
+        self.channel.basic_nack(delivery_tag, requeue=requeue)
+        self.pooled.settle(delivery_tag)
+        metrics.queue_messages.inc("nack")
 
+    def depth(self) -> int:
+        """
+        Количество сообщений в очереди, ожидающих доставки
+        """
+        return self.channel.queue_declare(queue=QUEUE_NAME, passive=True).method.message_count
+
+
+class MemoryQueue:
+    """
+    Очередь в памяти процесса вместо rabbitmq (общая для всех MemoryQueue процесса)
+    """
+    messages = deque()
+    unacked = {}
+    delivery_tags = count(1)
 
-class TestQueue:
     def __enter__(self):
         return self
 
     def __exit__(self, *args):
-        pass
+        # неподтвержденные сообщения возвращаются в очередь, как при закрытии канала
+        for delivery_tag in sorted(self.unacked, reverse=True):
+            self.messages.appendleft(self.unacked.pop(delivery_tag))
+
+    @classmethod
+    def reset(cls):
+        cls.messages.clear()
+        cls.unacked.clear()
 
     def publish(self, data):
-        pass
+        with tracing.span("queue publish", queue="memory"):
+            self.messages.append(json.dumps(data))
+        metrics.queue_messages.inc("publish")
 
     def consume(self):
-        return iter([])
+        while self.messages:
+            metrics.queue_messages.inc("consume")
+            yield json.loads(self.messages.popleft())
+
+    def set_prefetch(self, prefetch_count):
+        pass
+
+    def get_batch(self, max_count, timeout=1):
+        batch = []
+        while self.messages and len(batch) < max_count:
+            delivery_tag = next(self.delivery_tags)
+            self.unacked[delivery_tag] = self.messages.popleft()
+            batch.append((delivery_tag, json.loads(self.unacked[delivery_tag])))
+        if batch:
+            metrics.queue_messages.inc("consume", amount=len(batch))
+        return batch
+
+    def check_delivery_tag(self, delivery_tag):
+        # как rabbitmq: неизвестный (уже подтвержденный или возвращенный) тег закрывает канал
+        if delivery_tag not in self.unacked:
+            raise pika.exceptions.ChannelClosedByBroker(406, f"PRECONDITION_FAILED - unknown delivery tag {delivery_tag}")
+
+    def ack(self, delivery_tag, multiple=False):
+        self.check_delivery_tag(delivery_tag)
+        for tag in list(self.unacked):
+            if tag == delivery_tag or multiple and tag < delivery_tag:
+                del self.unacked[tag]
+        metrics.queue_messages.inc("ack")
+
+    def nack(self, delivery_tag, requeue=True):
+        self.check_delivery_tag(delivery_tag)
+        body = self.unacked.pop(delivery_tag)
+        metrics.queue_messages.inc("nack")
+        if requeue:
+            self.messages.append(body)
+
+    def depth(self):
+        return len(self.messages)
+
+
+TestQueue = MemoryQueue
+
+if QUEUE_URL.startswith("memory://"):
+    Queue = MemoryQueue
@@ -0,0 +1,114 @@
+# Объединение одинаковых одновременных запросов (single-flight)
+# Если несколько потоков одновременно вызывают Group.do с одним ключом, функция выполняется
+# только в первом из них, а остальные ждут и получают тот же результат (или то же исключение).
+# Результат нигде не сохраняется: следующий вызов после завершения снова выполнит функцию,
+# поэтому ошибки не кэшируются, а для кэширования есть cache.py.
+#
+# Дедлайн (deadline.py) у каждого вызова свой: ждущий вызов ждет не дольше своего оставшегося времени
+# (потом DeadlineExceededException), а если у первого вызова время вышло раньше, чем у ждущего,
+# ждущий выполняет функцию сам, а не получает чужой DeadlineExceededException.
+#
+# Использование:
+#     single_flight = Group()
+#     resp = single_flight.do(("GET", url), circuit_breaker.external_request, "GET", url)
+
+import asyncio
+from threading import Event, Lock
+
+import deadline
+from circuit_breaker import DeadlineExceededException
+
+
+def wait_timeout():
+    """
+    Сколько ждать чужой вызов: до своего дедлайна (None - без ограничения)
+    """
+    left = deadline.remaining()
+    return None if left is None else max(left, 0)
+
+
+def wait_expired():
+    return DeadlineExceededException("Deadline exceeded while waiting for a shared request")
+
+
+class Call:
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class Group:
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.executed += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            if not call.done.wait(wait_timeout()):
+                raise wait_expired()
+            if isinstance(call.error, DeadlineExceededException) and not deadline.expired():
+                # время вышло у первого вызова, а у этого еще есть
+                return self.do(key, func, *args, **kwargs)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self) -> dict:
+        """
+        executed - сколько раз функция выполнялась, shared - сколько вызовов получили чужой результат
+        """
+        with self.lock:
+            return {"executed": self.executed, "shared": self.shared, "inFlight": len(self.calls)}
+
+
+class AsyncGroup(Group):
+    """
+    То же для корутин одного event loop'а
+    """
+    async def do(self, key, func, *args, **kwargs):
+        future = self.calls.get(key)
+        if future is not None:
+            self.shared += 1
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), wait_timeout())
+            except asyncio.TimeoutError:
+                if future.done():
+                    raise
+                raise wait_expired()
+            except DeadlineExceededException:
+                if deadline.expired():
+                    raise
+                return await self.do(key, func, *args, **kwargs)
+
+        future = self.calls[key] = asyncio.ensure_future(func(*args, **kwargs))
+        self.executed += 1
+
+        def forget(_):
+            if self.calls.get(key) is future:
+                del self.calls[key]
+        future.add_done_callback(forget)
+        # shield: отмена одного из ожидающих не отменяет общий запрос
+        return await asyncio.shield(future)
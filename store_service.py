@@ -5,19 +5,35 @@
 #
 
 import os
+import json
 from datetime import datetime
+from concurrent.futures import wait, FIRST_COMPLETED
+from threading import Lock
+from time import monotonic
+from typing import List
 
 from pydantic import BaseModel, ValidationError
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from werkzeug.exceptions import BadRequest
 import sqlalchemy as sa
 
 import database
+import deadline
+import metrics
+import tracing
 import circuit_breaker as cb
 import rabbitmq as mq
+import fanout
+import singleflight
+from cache import TTLCache
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
+metrics.install(app)
+tracing.install(app)
+database.install(app)
+# край системы: здесь запросу задается дедлайн для всей цепочки сервисов
+deadline.install(app, deadline.DEFAULT_DEADLINE_MS)
 ROOT_PATH = "/api/v1"
 ORDER_SERVICE_URL = os.environ.get("ORDER_SERVICE_URL", "localhost:8380")
 print(f"Order service url: {ORDER_SERVICE_URL} ($ORDER_SERVICE_URL)")
@@ -25,8 +41,47 @@ WAREHOUSE_SERVICE_URL = os.environ.get("WAREHOUSE_SERVICE_URL", "localhost:8280"
 print(f"Warehouse service url: {WAREHOUSE_SERVICE_URL} ($WAREHOUSE_SERVICE_URL)")
 WARRANTY_SERVICE_URL = os.environ.get("WARRANTY_SERVICE_URL", "localhost:8180")
 print(f"Warranty service url: {WARRANTY_SERVICE_URL} ($WARRANTY_SERVICE_URL)")
+# сколько вещей запрашивать в warehouse/warranty одним batch-запросом (0 - все сразу)
+LOOKUP_CHUNK_SIZE = int(os.environ.get("LOOKUP_CHUNK_SIZE", 0))
+print(f"Lookup chunk size: {LOOKUP_CHUNK_SIZE} ($LOOKUP_CHUNK_SIZE)")
+# заголовок, в котором order_service возвращает курсор следующей страницы заказов
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# заголовок, в котором order_service возвращает вещь заказа после гарантии или возврата
+ITEM_UID_HEADER = "X-Item-Uid"
+# потоковая выдача списка заказов (Accept: application/x-ndjson) частями по STREAM_CHUNK_SIZE заказов
+NDJSON_MIMETYPE = "application/x-ndjson"
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 10))
+print(f"Stream chunk size: {STREAM_CHUNK_SIZE} ($STREAM_CHUNK_SIZE)")
+# сколько вещей можно купить одним запросом /purchase/batch
+MAX_BASKET_SIZE = int(os.environ.get("MAX_BASKET_SIZE", 100))
+print(f"Max basket size: {MAX_BASKET_SIZE} ($MAX_BASKET_SIZE)")
+
+# кэш ответов warehouse и warranty: модель/размер вещи после покупки не меняются,
+# а статус гарантии меняется только через методы warranty, поэтому живет недолго
+CACHE_MAX_SIZE = int(os.environ.get("CACHE_MAX_SIZE", 10000))
+ITEM_CACHE_TTL = float(os.environ.get("ITEM_CACHE_TTL", 3600))
+WARRANTY_CACHE_TTL = float(os.environ.get("WARRANTY_CACHE_TTL", 30))
+print(f"Cache max size: {CACHE_MAX_SIZE} ($CACHE_MAX_SIZE), "
+      f"item ttl: {ITEM_CACHE_TTL} ($ITEM_CACHE_TTL), "
+      f"warranty ttl: {WARRANTY_CACHE_TTL} ($WARRANTY_CACHE_TTL)")
+
+# справочник пользователей в памяти: новые записи в users подгружаются при промахе,
+# неизвестные user_uid кэшируются на USER_NEGATIVE_TTL секунд (это и есть максимальная задержка,
+# с которой новый пользователь становится виден), раз в USER_RELOAD_INTERVAL справочник перечитывается целиком
+USER_NEGATIVE_TTL = float(os.environ.get("USER_NEGATIVE_TTL", 5))
+USER_RELOAD_INTERVAL = float(os.environ.get("USER_RELOAD_INTERVAL", 300))
+print(f"User negative ttl: {USER_NEGATIVE_TTL} ($USER_NEGATIVE_TTL), "
+      f"reload interval: {USER_RELOAD_INTERVAL} ($USER_RELOAD_INTERVAL)")
 
 circuit_breaker = cb.CircuitBreaker()
+circuit_breaker.export_metrics()
+fan_out = fanout.FanOut()
+# одинаковые одновременные запросы на чтение в другие сервисы выполняются один раз
+single_flight = singleflight.Group()
+items_cache = TTLCache(CACHE_MAX_SIZE, ITEM_CACHE_TTL)
+warranties_cache = TTLCache(CACHE_MAX_SIZE, WARRANTY_CACHE_TTL)
+# order_uid -> item_uid, чтобы сбрасывать кэш при запросах по заказу
+order_items_cache = TTLCache(CACHE_MAX_SIZE, ITEM_CACHE_TTL)
 
 # ------------------------------ dto ------------------------------
 
@@ -46,9 +101,82 @@ class NewOrderRequest(BaseModel):
     model: str
     size: str
 
+
+class NewBasketRequest(BaseModel):
+    items: List[NewOrderRequest]
+
 # ------------------------------ вспомогательные функции ------------------------------
 
 
+class UserDirectory:
+    """
+    Множество user_uid из таблицы users, чтобы проверять пользователя без запроса в базу
+    """
+    def __init__(self, negative_ttl, reload_interval):
+        self.reload_interval = reload_interval
+        self.unknown_users = TTLCache(CACHE_MAX_SIZE, negative_ttl)
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.user_uids = set()
+            self.last_id = 0
+            self.loaded_at = None
+            self.unknown_users.clear()
+
+    def is_stale(self) -> bool:
+        return self.loaded_at is None or monotonic() - self.loaded_at > self.reload_interval
+
+    def load(self, only_if_stale=False):
+        """
+        Полная загрузка справочника из базы.
+        С only_if_stale устаревание проверяется еще раз под lock: пока первый поток перечитывал таблицу,
+        остальные ждали на lock и перечитывать ее снова не должны
+        """
+        with self.lock:
+            if only_if_stale and not self.is_stale():
+                return
+            with database.Session() as s:
+                rows = s.query(User.id, User.user_uid).all()
+            self.user_uids = {row.user_uid for row in rows}
+            self.last_id = max((row.id for row in rows), default=0)
+            self.loaded_at = monotonic()
+
+    def refresh(self):
+        """
+        Подгрузка пользователей, добавленных после последней загрузки
+        """
+        with self.lock, database.Session() as s:
+            rows = s.query(User.id, User.user_uid).filter(User.id > self.last_id).all()
+            self.user_uids.update(row.user_uid for row in rows)
+            self.last_id = max((row.id for row in rows), default=self.last_id)
+
+    def add(self, user_uid):
+        """
+        Хук для тех, кто сам добавляет пользователей: новый user_uid виден сразу
+        """
+        with self.lock:
+            self.user_uids.add(user_uid)
+        self.unknown_users.invalidate(user_uid)
+
+    def contains(self, user_uid) -> bool:
+        if self.is_stale():
+            self.load(only_if_stale=True)
+        if user_uid in self.user_uids:
+            return True
+        if self.unknown_users.get(user_uid):
+            return False
+        self.refresh()
+        if user_uid in self.user_uids:
+            return True
+        self.unknown_users.set(user_uid, True)
+        return False
+
+
+user_directory = UserDirectory(USER_NEGATIVE_TTL, USER_RELOAD_INTERVAL)
+
+
 def refresh_items_in_db():
     with database.Session() as s:
         s.execute(User.__table__.delete())
@@ -56,12 +184,243 @@ def refresh_items_in_db():
             User(id=1, name="Alex", user_uid="6d2cb5a0-943c-4b96-9aa6-89eac7bdfd2b"),
         ])
         print("Initialized default values in User table")
+    user_directory.load()
 
 
 def is_user_exists(user_uid):
-    with database.Session() as s:
-        user = s.query(User).filter(User.user_uid == user_uid).one_or_none()
-        return bool(user)
+    return user_directory.contains(user_uid)
+
+
+def request_key(method, url, kwargs):
+    return method, url, json.dumps(kwargs.get("params"), sort_keys=True), json.dumps(kwargs.get("json"), sort_keys=True)
+
+
+def shared_request(method, url, **kwargs):
+    """
+    external_request для запросов на чтение: одновременные одинаковые запросы ждут первого
+    и получают его ответ (или его ошибку)
+    """
+    return single_flight.do(request_key(method, url, kwargs), circuit_breaker.external_request, method, url, **kwargs)
+
+
+def request_item_info(item_uid):
+    """
+    Информация о вещи из warehouse (через кэш). None, если warehouse ее не нашел
+    """
+    item_info = items_cache.get(item_uid)
+    if item_info is None:
+        warehouse_service_response = shared_request(
+            "GET",
+            f"http://{WAREHOUSE_SERVICE_URL}{ROOT_PATH}/warehouse/{item_uid}",
+            hedge=True
+        )
+        if not warehouse_service_response.ok:
+            return None
+        item_info = warehouse_service_response.json()
+        items_cache.set(item_uid, item_info)
+    return item_info
+
+
+def request_warranty_info(item_uid):
+    """
+    Статус гарантии из warranty (через кэш). None, если warranty ее не нашел
+    """
+    warranty_info = warranties_cache.get(item_uid)
+    if warranty_info is None:
+        warranty_service_response = shared_request(
+            "GET",
+            f"http://{WARRANTY_SERVICE_URL}{ROOT_PATH}/warranty/{item_uid}",
+            hedge=True
+        )
+        if not warranty_service_response.ok:
+            return None
+        warranty_info = warranty_service_response.json()
+        warranties_cache.set(item_uid, warranty_info)
+    return warranty_info
+
+
+def request_items_info(item_uids):
+    """
+    Информация о вещах из warehouse одним запросом: {item_uid: {"model": ..., "size": ...}}
+    Запрашиваются только вещи, которых нет в кэше.
+    Если warehouse ответил ошибкой, то запрошенных вещей в результате нет
+    """
+    items_info = items_cache.get_many(item_uids)
+    # отсортированы, чтобы одинаковые наборы вещей давали одинаковый запрос для single-flight
+    missing_uids = sorted(item_uid for item_uid in item_uids if item_uid not in items_info)
+    if not missing_uids:
+        return items_info
+    warehouse_service_response = shared_request(
+        "POST",
+        f"http://{WAREHOUSE_SERVICE_URL}{ROOT_PATH}/warehouse/batch",
+        json={"itemUids": missing_uids}
+    )
+    if not warehouse_service_response.ok:
+        return items_info
+    fetched = {item["orderItemUid"]: item for item in warehouse_service_response.json()}
+    items_cache.set_many(fetched)
+    return {**items_info, **fetched}
+
+
+def request_warranties_info(item_uids):
+    """
+    Статусы гарантий из warranty одним запросом: {item_uid: {"warrantyDate": ..., "status": ...}}
+    Запрашиваются только гарантии, которых нет в кэше.
+    Если warranty ответил ошибкой, то запрошенных гарантий в результате нет
+    """
+    warranties_info = warranties_cache.get_many(item_uids)
+    missing_uids = sorted(item_uid for item_uid in item_uids if item_uid not in warranties_info)
+    if not missing_uids:
+        return warranties_info
+    warranty_service_response = shared_request(
+        "POST",
+        f"http://{WARRANTY_SERVICE_URL}{ROOT_PATH}/warranty/batch",
+        json={"itemUids": missing_uids}
+    )
+    if not warranty_service_response.ok:
+        return warranties_info
+    fetched = {warranty["itemUid"]: warranty for warranty in warranty_service_response.json()}
+    warranties_cache.set_many(fetched)
+    return {**warranties_info, **fetched}
+
+
+def invalidate_order_cache(order_uid, order_service_response):
+    """
+    Сбросить закэшированную информацию по заказу (после запроса гарантии или возврата).
+    Вещь берется из ответа order_service: связка заказ -> вещь в order_items_cache могла уже вытесниться
+    """
+    item_uid = order_service_response.headers.get(ITEM_UID_HEADER) or order_items_cache.get(order_uid)
+    if item_uid is not None:
+        warranties_cache.invalidate(item_uid)
+        items_cache.invalidate(item_uid)
+
+
+def request_lookups(item_uids):
+    """
+    Параллельно запрашивает информацию о вещах из warehouse и warranty
+    (по частям размером LOOKUP_CHUNK_SIZE, если он задан).
+    Возвращает (items_info, warranties_info) вида {item_uid: info}:
+    если для вещи сработал circuit breaker, то info равен None,
+    а если сервис вещь не нашел, то ее нет в словаре
+    """
+    chunk_size = LOOKUP_CHUNK_SIZE or len(item_uids) or 1
+    chunks = [item_uids[i:i + chunk_size] for i in range(0, len(item_uids), chunk_size)]
+
+    with fan_out.limited() as pool:
+        futures = [
+            (chunk, pool.submit(request_items_info, chunk), pool.submit(request_warranties_info, chunk))
+            for chunk in chunks
+        ]
+
+    items_info, warranties_info = {}, {}
+    for chunk, items_future, warranties_future in futures:
+        items_info.update(lookup_result(items_future, chunk))
+        warranties_info.update(lookup_result(warranties_future, chunk))
+    return items_info, warranties_info
+
+
+def lookup_result(future, item_uids):
+    """
+    Результат request_items_info/request_warranties_info из future.
+    Если сработал circuit breaker, то для всех item_uids возвращается None
+    """
+    try:
+        return future.result()
+    except cb.CircuitBreakerException:
+        return dict.fromkeys(item_uids)
+
+
+def make_stream_line(order, items_info, warranties_info, summary):
+    """
+    Строка NDJSON с информацией о заказе (заодно обновляет итоги summary)
+    """
+    item_uid = order["itemUid"]
+    if item_uid not in items_info:
+        order_info = {"orderUid": order["orderUid"], "message": "Order in warehouse not found"}
+    elif item_uid not in warranties_info:
+        order_info = {"orderUid": order["orderUid"], "message": "Warranty not found"}
+    else:
+        order_info = make_order_info(
+            order["orderUid"], order["orderDate"], items_info[item_uid], warranties_info[item_uid]
+        )
+    summary["count"] += 1
+    summary["notFound"] += "message" in order_info
+    summary["incomplete"] += "circuit_breaker" in order_info
+    return json.dumps(order_info) + "\n"
+
+
+def stream_orders(orders):
+    """
+    Генератор строк NDJSON: заказы обрабатываются частями по STREAM_CHUNK_SIZE,
+    и каждая часть отдается, как только для нее пришла информация из warehouse и warranty.
+    Последняя строка - итоги: {"summary": {"count": ..., "incomplete": ..., "notFound": ...}}
+    """
+    summary = {"count": 0, "incomplete": 0, "notFound": 0}
+    pending = []
+
+    def ready_chunks(block):
+        if block:
+            # только незавершенные: с уже готовым future wait сразу вернется, и цикл будет крутиться вхолостую
+            wait([future for _, *chunk_futures in pending for future in chunk_futures if not future.done()],
+                 return_when=FIRST_COMPLETED)
+        for entry in list(pending):
+            chunk, items_future, warranties_future = entry
+            if not (items_future.done() and warranties_future.done()):
+                continue
+            pending.remove(entry)
+            item_uids = [order["itemUid"] for order in chunk]
+            items_info = lookup_result(items_future, item_uids)
+            warranties_info = lookup_result(warranties_future, item_uids)
+            for order in chunk:
+                yield make_stream_line(order, items_info, warranties_info, summary)
+
+    with fan_out.limited() as pool:
+        for i in range(0, len(orders), STREAM_CHUNK_SIZE):
+            chunk = orders[i:i + STREAM_CHUNK_SIZE]
+            item_uids = [order["itemUid"] for order in chunk]
+            pending.append((
+                chunk,
+                pool.submit(request_items_info, item_uids),
+                pool.submit(request_warranties_info, item_uids),
+            ))
+            yield from ready_chunks(block=False)
+        while pending:
+            yield from ready_chunks(block=True)
+
+    yield json.dumps({"summary": summary}) + "\n"
+
+
+def enqueue_warranty_request(order_uid, reason):
+    """
+    ЛР3 4c: Ставим в очередь запрос гарантии, если система недоступна.
+    Очередь разбирает отдельный процесс warranty_worker.py
+    """
+    with mq.Queue() as q:
+        q.publish({"time": str(datetime.utcnow()), "orderUid": order_uid, "reason": reason})
+
+
+def make_order_info(order_uid, order_date, item_info, warranty_info):
+    """
+    ЛР3 4a: Собираем информацию о заказе из того, что доступно
+    (item_info или warranty_info равны None, если соответствующий сервис недоступен)
+    """
+    order_info = {
+        "orderUid": order_uid,
+        "date": order_date,
+    }
+    if item_info:
+        order_info.update({
+            "model": item_info["model"],
+            "size": item_info["size"]
+        })
+    if warranty_info:
+        order_info.update({
+            "warrantyDate": warranty_info["warrantyDate"],
+            "warrantyStatus": warranty_info["status"]
+        })
+    if not item_info or not warranty_info:
+        order_info["circuit_breaker"] = "Some services unavailable, information is not complete"
+    return order_info
 
 
 # ЛР3 1: Возврат ошибок в json
@@ -79,74 +438,77 @@ def health_check():
     return "UP", 200
 
 
+@app.route("/manage/circuit-breaker", methods=["GET"])
+def circuit_breaker_stats():
+    return circuit_breaker.stats(), 200
+
+
+@app.route("/manage/cache", methods=["GET"])
+def cache_stats():
+    return {
+        "items": items_cache.stats(),
+        "warranties": warranties_cache.stats(),
+        "orderItems": order_items_cache.stats(),
+        "unknownUsers": user_directory.unknown_users.stats(),
+    }, 200
+
+
+metrics.stats_gauges("store_cache", "Store lookup caches", "cache", lambda: cache_stats()[0],
+                     ("size", "maxSize", "hits", "misses", "evictions", "expirations"))
+metrics.stats_gauges("store_single_flight", "Coalesced outbound reads", "group",
+                     lambda: {"outbound": single_flight.stats()}, ("executed", "shared", "inFlight"))
+
+
 @app.route(f"{ROOT_PATH}/store/<string:user_uid>/orders", methods=["GET"])
 @cb.handles_circuit_break
 def request_all_orders(user_uid):
     """
     Получить список заказов пользователя
+    Параметры страницы ?limit=N&cursor=... передаются в order_service как есть,
+    поэтому информация из warehouse и warranty запрашивается только по заказам этой страницы.
+    С заголовком Accept: application/x-ndjson заказы отдаются потоком, по мере готовности
     """
     user_uid = user_uid.lower()
     if not is_user_exists(user_uid):
         return {"message": "User not found"}, 404
 
     # запрос заказов юзера из order_service
-    order_service_response = circuit_breaker.external_request(
+    order_service_response = shared_request(
         "GET",
-        f"http://{ORDER_SERVICE_URL}{ROOT_PATH}/orders/{user_uid}"
+        f"http://{ORDER_SERVICE_URL}{ROOT_PATH}/orders/{user_uid}",
+        params={key: request.args[key] for key in ("limit", "cursor") if key in request.args}
     )
+    if order_service_response.status_code == 400:
+        return order_service_response.json(), 400
     if not order_service_response.ok:
         return {"message": "Order not found"}, 422
-
-    result = []
-
-    # для каждого заказа, который сделал юзер
-    for order in order_service_response.json():
-        order_uid = order["orderUid"]
-        item_uid = order["itemUid"]
-
-        # запросить инфу из warehouse
-        try:
-            warehouse_service_response = circuit_breaker.external_request(
-                "GET",
-                f"http://{WAREHOUSE_SERVICE_URL}{ROOT_PATH}/warehouse/{item_uid}"
-            )
-            if not warehouse_service_response.ok:
-                return {"message": "Order in warehouse not found"}, 422
-        except cb.CircuitBreakerException:
-            warehouse_service_response = None
-
-        # запросить инфу из warranty
-        try:
-            warranty_service_response = circuit_breaker.external_request(
-                "GET",
-                f"http://{WARRANTY_SERVICE_URL}{ROOT_PATH}/warranty/{item_uid}"
-            )
-            if not warranty_service_response.ok:
-                return {"message": "Warranty not found"}, 422
-        except cb.CircuitBreakerException:
-            warranty_service_response = None
-
-        # ЛР3 4a: Собираем результат из того, что доступно
-        order_info = {
-            "orderUid": order_uid,
-            "date": order["orderDate"]
-        }
-        if warehouse_service_response:
-            order_info.update({
-                "model": warehouse_service_response.json()["model"],
-                "size": warehouse_service_response.json()["size"]
-            })
-        if warranty_service_response:
-            order_info.update({
-                "warrantyDate": warranty_service_response.json()["warrantyDate"],
-                "warrantyStatus": warranty_service_response.json()["status"]
-            })
-        if not warehouse_service_response or not warranty_service_response:
-            order_info["circuit_breaker"] = "Some services unavailable, information is not complete"
-
-        result.append(order_info)
-
-    return jsonify(result), 200
+    headers = {}
+    if NEXT_CURSOR_HEADER in order_service_response.headers:
+        headers[NEXT_CURSOR_HEADER] = order_service_response.headers[NEXT_CURSOR_HEADER]
+    orders = order_service_response.json()
+    item_uids = [order["itemUid"] for order in orders]
+    order_items_cache.set_many({order["orderUid"]: order["itemUid"] for order in orders})
+
+    if request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE:
+        return Response(stream_with_context(stream_orders(orders)), mimetype=NDJSON_MIMETYPE, headers=headers)
+
+    # запросить инфу из warehouse и warranty сразу по всем заказам (параллельно)
+    items_info, warranties_info = request_lookups(item_uids)
+    if any(item_uid not in items_info for item_uid in item_uids):
+        return {"message": "Order in warehouse not found"}, 422
+    if any(item_uid not in warranties_info for item_uid in item_uids):
+        return {"message": "Warranty not found"}, 422
+
+    result = [
+        make_order_info(
+            order["orderUid"],
+            order["orderDate"],
+            items_info.get(order["itemUid"]),
+            warranties_info.get(order["itemUid"]),
+        )
+        for order in orders
+    ]
+    return jsonify(result), 200, headers
 
 
 @app.route(f"{ROOT_PATH}/store/<string:user_uid>/<string:order_uid>", methods=["GET"])
@@ -161,7 +523,7 @@ def request_order(user_uid, order_uid):
         return {"message": "User not found"}, 404
 
     # запрос заказа из order_service
-    order_service_response = circuit_breaker.external_request(
+    order_service_response = shared_request(
         "GET",
         f"http://{ORDER_SERVICE_URL}{ROOT_PATH}/orders/{user_uid}/{order_uid}"
     )
@@ -169,46 +531,33 @@ def request_order(user_uid, order_uid):
         return {"message": "Order not found"}, 422
     item_uid = order_service_response.json()["itemUid"]
 
-    # для этого заказа загружаем инфу из warehouse
+    order_items_cache.set(order_uid, item_uid)
+
+    # для этого заказа параллельно загружаем инфу из warehouse и warranty
+    with fan_out.limited() as pool:
+        item_future = pool.submit(request_item_info, item_uid)
+        warranty_future = pool.submit(request_warranty_info, item_uid)
+
     try:
-        warehouse_service_response = circuit_breaker.external_request(
-            "GET",
-            f"http://{WAREHOUSE_SERVICE_URL}{ROOT_PATH}/warehouse/{item_uid}"
-        )
-        if not warehouse_service_response.ok:
+        item_info = item_future.result()
+        if item_info is None:
             return {"message": "Order in warehouse not found"}, 422
     except cb.CircuitBreakerException:
-        warehouse_service_response = None
+        item_info = None
 
-    # а также инфу из warranty
     try:
-        warranty_service_response = circuit_breaker.external_request(
-            "GET",
-            f"http://{WARRANTY_SERVICE_URL}{ROOT_PATH}/warranty/{item_uid}"
-        )
-        if not warranty_service_response.ok:
+        warranty_info = warranty_future.result()
+        if warranty_info is None:
             return {"message": "Warranty not found"}, 422
     except cb.CircuitBreakerException:
-        warranty_service_response = None
-
-    # ЛР3 4a: Собираем результат из того, что доступно
-    result = {
-        "orderUid": order_uid,
-        "date": order_service_response.json()["orderDate"],
-    }
-    if warehouse_service_response:
-        result.update({
-            "model": warehouse_service_response.json()["model"],
-            "size": warehouse_service_response.json()["size"]
-        })
-    if warranty_service_response:
-        result.update({
-            "warrantyDate": warranty_service_response.json()["warrantyDate"],
-            "warrantyStatus": warranty_service_response.json()["status"]
-        })
-    if not warehouse_service_response or not warranty_service_response:
-        result["circuit_breaker"] = "Some services unavailable, information is not complete"
+        warranty_info = None
 
+    result = make_order_info(
+        order_uid,
+        order_service_response.json()["orderDate"],
+        item_info,
+        warranty_info,
+    )
     return result, 200
 
 
@@ -240,32 +589,14 @@ def request_warranty(user_uid, order_uid):
         )
     except cb.CircuitBreakerException:
         # ЛР3 4c: Ставим в очередь запрос, если система недоступна
-        with mq.Queue() as q:
-            q.publish({"time": str(datetime.utcnow()), "reason": warranty_request.reason})
+        enqueue_warranty_request(order_uid, warranty_request.reason)
         return {"message": "Warranty service unavailable, but SUCCESS! Your request added to queue"}, 200
 
     if not order_service_response.ok:
         return {"message": "Order not found"}, 422
+    invalidate_order_cache(order_uid, order_service_response)
 
-    # ЛР3 4c: Читаем то, что сохранено в очереди и пытаемся выполнить
-    queued_requests = []
-    try:
-        with mq.Queue() as q:
-            for req in q.consume():
-                resp = circuit_breaker.external_request(
-                    "POST",
-                    f"http://{ORDER_SERVICE_URL}{ROOT_PATH}/orders/{order_uid}/warranty",
-                    json={"reason": req["reason"]}
-                )
-                queued_requests.append({"time": req["time"], "result": resp.json()})
-    except cb.CircuitBreakerException:
-        pass
-
-    result = {"orderUid": order_uid, **order_service_response.json()}
-    # если что-то из очереди выполнилось успешно, возвращаем это в атрибуте queued_requests
-    if queued_requests:
-        result["queued_requests"] = queued_requests
-    return result, 200
+    return {"orderUid": order_uid, **order_service_response.json()}, 200
 
 
 @app.route(f"{ROOT_PATH}/store/<string:user_uid>/purchase", methods=["POST"])
@@ -301,6 +632,38 @@ def request_purchase(user_uid):
     return '', 201, {"Location": f"{ROOT_PATH}/store/{user_uid}/{order_uid}"}
 
 
+@app.route(f"{ROOT_PATH}/store/<string:user_uid>/purchase/batch", methods=["POST"])
+@cb.handles_circuit_break
+def request_purchase_batch(user_uid):
+    """
+    Купить сразу несколько вещей: одним запросом в order_service, все или ничего
+    """
+    user_uid = user_uid.lower()
+    if not is_user_exists(user_uid):
+        return {"message": "User not found"}, 404
+
+    # парсим входные данные
+    try:
+        basket_request = NewBasketRequest.parse_obj(request.get_json(force=True))
+    except BadRequest:
+        return {"message": "Bad json"}, 400
+    except ValidationError as e:
+        return {"message": e.errors()}, 400
+    if not 0 < len(basket_request.items) <= MAX_BASKET_SIZE:
+        return {"message": f"items count should be in range 1..{MAX_BASKET_SIZE}"}, 400
+
+    # перенаправляем всю корзину в order_service
+    order_service_response = circuit_breaker.external_request(
+        "POST",
+        f"http://{ORDER_SERVICE_URL}{ROOT_PATH}/orders/{user_uid}/batch",
+        json={"items": [{"model": item.model, "size": item.size} for item in basket_request.items]}
+    )
+    if not order_service_response.ok:
+        return {"message": "Orders not created due to errors. All changes was rolled back"}, 422
+
+    return {"orderUids": order_service_response.json()["orderUids"]}, 201
+
+
 @app.route(f"{ROOT_PATH}/store/<string:user_uid>/<string:order_uid>/refund", methods=["DELETE"])
 @cb.handles_circuit_break
 def request_refund(user_uid, order_uid):
@@ -320,6 +683,7 @@ def request_refund(user_uid, order_uid):
     # ЛР3 4b: Откат операции при недоступности системы (в остальных сервисах тоже поддерживается)
     if not order_service_response.ok:
         return {"message": "Order not refunded due to errors. All changes was rolled back"}, 422
+    invalidate_order_cache(order_uid, order_service_response)
     return '', 204
 
 
@@ -0,0 +1,510 @@
+# Асинхронный вариант store_service на aiohttp
+# Те же методы api и тот же формат ответов, что и в store_service.py, но все запросы
+# в другие сервисы (и ожидание между повторными попытками в circuit breaker'е) не блокируют
+# поток, поэтому один процесс держит тысячи одновременных запросов.
+# Кэши, справочник пользователей и сборка ответа общие с store_service.py.
+# Блокирующие операции (база, RabbitMQ) выполняются в пуле потоков.
+#
+# Запуск: python store_service_async.py
+
+import os
+import json
+import asyncio
+from functools import partial
+from time import perf_counter
+
+from aiohttp import web
+from pydantic import ValidationError
+
+import database
+import deadline
+import metrics
+import tracing
+import circuit_breaker as cb
+import singleflight
+import store_service as store
+from store_service import (
+    ROOT_PATH, ORDER_SERVICE_URL, WAREHOUSE_SERVICE_URL, WARRANTY_SERVICE_URL,
+    NEXT_CURSOR_HEADER, NDJSON_MIMETYPE, MAX_BASKET_SIZE, WarrantyRequest, NewOrderRequest, NewBasketRequest,
+    make_order_info, make_stream_line,
+)
+
+routes = web.RouteTableDef()
+circuit_breaker = cb.CircuitBreaker()
+circuit_breaker.export_metrics()
+single_flight = singleflight.AsyncGroup()
+
+# ------------------------------ вспомогательные функции ------------------------------
+
+
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args))
+
+
+def to_response(result):
+    """
+    Превращает ответ в стиле flask ((body, status) или (body, status, headers)) в ответ aiohttp
+    """
+    body, status, *headers = result
+    headers = headers[0] if headers else {}
+    if isinstance(body, (dict, list)):
+        return web.json_response(body, status=status, headers=headers)
+    return web.Response(text=body, status=status, headers=headers)
+
+
+def api(func):
+    """
+    Метод api: circuit breaker -> 555, дедлайн -> 504, любые другие ошибки -> 500 в json,
+    ответ в стиле flask (или уже готовый ответ aiohttp для потоковой выдачи)
+    """
+    func = cb.async_handles_circuit_break(func)
+
+    async def wrap(http_request):
+        # у каждого запроса своя задача asyncio, поэтому и свой дедлайн в contextvars
+        deadline.start(http_request.headers.get(deadline.DEADLINE_HEADER), deadline.DEFAULT_DEADLINE_MS)
+        if deadline.expired():
+            return to_response(deadline.expired_response())
+        try:
+            result = await func(http_request, **http_request.match_info)
+            if isinstance(result, web.StreamResponse):
+                return result
+            return to_response(result)
+        except Exception as error:
+            return web.json_response({"message": f"An error occurred: {repr(error)}"}, status=500)
+    return wrap
+
+
+async def is_user_exists(user_uid):
+    # без похода в пул потоков, если пользователь уже есть в справочнике
+    if user_uid in store.user_directory.user_uids:
+        return True
+    return await run_blocking(store.is_user_exists, user_uid)
+
+
+async def read_json(http_request, model):
+    """
+    Разбирает тело запроса в model. Возвращает (model, None) или (None, ответ с ошибкой 400)
+    """
+    try:
+        return model.parse_obj(json.loads(await http_request.text())), None
+    except json.JSONDecodeError:
+        return None, ({"message": "Bad json"}, 400)
+    except ValidationError as e:
+        return None, ({"message": e.errors()}, 400)
+
+
+async def shared_request(method, url, **kwargs):
+    return await single_flight.do(
+        store.request_key(method, url, kwargs), circuit_breaker.async_external_request, method, url, **kwargs
+    )
+
+
+async def request_item_info(item_uid):
+    item_info = store.items_cache.get(item_uid)
+    if item_info is None:
+        warehouse_service_response = await shared_request(
+            "GET",
+            f"http://{WAREHOUSE_SERVICE_URL}{ROOT_PATH}/warehouse/{item_uid}",
+            hedge=True
+        )
+        if not warehouse_service_response.ok:
+            return None
+        item_info = warehouse_service_response.json()
+        store.items_cache.set(item_uid, item_info)
+    return item_info
+
+
+async def request_warranty_info(item_uid):
+    warranty_info = store.warranties_cache.get(item_uid)
+    if warranty_info is None:
+        warranty_service_response = await shared_request(
+            "GET",
+            f"http://{WARRANTY_SERVICE_URL}{ROOT_PATH}/warranty/{item_uid}",
+            hedge=True
+        )
+        if not warranty_service_response.ok:
+            return None
+        warranty_info = warranty_service_response.json()
+        store.warranties_cache.set(item_uid, warranty_info)
+    return warranty_info
+
+
+async def request_items_info(item_uids):
+    items_info = store.items_cache.get_many(item_uids)
+    missing_uids = sorted(item_uid for item_uid in item_uids if item_uid not in items_info)
+    if not missing_uids:
+        return items_info
+    warehouse_service_response = await shared_request(
+        "POST",
+        f"http://{WAREHOUSE_SERVICE_URL}{ROOT_PATH}/warehouse/batch",
+        json={"itemUids": missing_uids}
+    )
+    if not warehouse_service_response.ok:
+        return items_info
+    fetched = {item["orderItemUid"]: item for item in warehouse_service_response.json()}
+    store.items_cache.set_many(fetched)
+    return {**items_info, **fetched}
+
+
+async def request_warranties_info(item_uids):
+    warranties_info = store.warranties_cache.get_many(item_uids)
+    missing_uids = sorted(item_uid for item_uid in item_uids if item_uid not in warranties_info)
+    if not missing_uids:
+        return warranties_info
+    warranty_service_response = await shared_request(
+        "POST",
+        f"http://{WARRANTY_SERVICE_URL}{ROOT_PATH}/warranty/batch",
+        json={"itemUids": missing_uids}
+    )
+    if not warranty_service_response.ok:
+        return warranties_info
+    fetched = {warranty["itemUid"]: warranty for warranty in warranty_service_response.json()}
+    store.warranties_cache.set_many(fetched)
+    return {**warranties_info, **fetched}
+
+
+async def lookup(coroutine, item_uids):
+    """
+    Результат request_items_info/request_warranties_info.
+    Если сработал circuit breaker, то для всех item_uids возвращается None
+    """
+    try:
+        return await coroutine
+    except cb.CircuitBreakerException:
+        return dict.fromkeys(item_uids)
+
+
+async def request_chunk(chunk, semaphore):
+    """
+    Информация из warehouse и warranty для части заказов (параллельно)
+    """
+    item_uids = [order["itemUid"] for order in chunk]
+    async with semaphore:
+        items_info, warranties_info = await asyncio.gather(
+            lookup(request_items_info(item_uids), item_uids),
+            lookup(request_warranties_info(item_uids), item_uids),
+        )
+    return chunk, items_info, warranties_info
+
+
+async def stream_orders(http_request, orders, headers):
+    """
+    Потоковая выдача заказов в NDJSON (см. store_service.stream_orders)
+    """
+    response = web.StreamResponse(headers={**headers, "Content-Type": NDJSON_MIMETYPE})
+    await response.prepare(http_request)
+
+    summary = {"count": 0, "incomplete": 0, "notFound": 0}
+    semaphore = asyncio.Semaphore(store.fan_out.max_concurrency)
+    chunks = [
+        request_chunk(orders[i:i + store.STREAM_CHUNK_SIZE], semaphore)
+        for i in range(0, len(orders), store.STREAM_CHUNK_SIZE)
+    ]
+    for next_chunk in asyncio.as_completed(chunks):
+        chunk, items_info, warranties_info = await next_chunk
+        for order in chunk:
+            await response.write(make_stream_line(order, items_info, warranties_info, summary).encode())
+
+    await response.write((json.dumps({"summary": summary}) + "\n").encode())
+    await response.write_eof()
+    return response
+
+# ------------------------------ методы api ------------------------------
+
+
+@routes.get("/manage/health")
+async def health_check(http_request):
+    return web.Response(text="UP")
+
+
+@routes.get("/manage/cache")
+async def cache_stats(http_request):
+    return to_response(store.cache_stats())
+
+
+@routes.get("/manage/metrics")
+async def metrics_view(http_request):
+    body, status, headers = metrics.render_response()
+    return web.Response(body=body.encode(), status=status, headers=headers)
+
+
+@routes.get("/manage/traces")
+async def traces(http_request):
+    if not hasattr(tracing.exporter, "spans"):
+        return web.json_response({"message": f"Spans are written to {tracing.TRACE_FILE}"}, status=404)
+    return web.json_response(tracing.exporter.spans(http_request.query.get("traceId")))
+
+
+@routes.get("/manage/circuit-breaker")
+async def circuit_breaker_stats(http_request):
+    return web.json_response(circuit_breaker.stats())
+
+
+@routes.get(f"{ROOT_PATH}/store/{{user_uid}}/orders")
+@api
+async def request_all_orders(http_request, user_uid):
+    """
+    Получить список заказов пользователя
+    """
+    user_uid = user_uid.lower()
+    if not await is_user_exists(user_uid):
+        return {"message": "User not found"}, 404
+
+    # запрос заказов юзера из order_service
+    query = http_request.query
+    order_service_response = await shared_request(
+        "GET",
+        f"http://{ORDER_SERVICE_URL}{ROOT_PATH}/orders/{user_uid}",
+        params={key: query[key] for key in ("limit", "cursor") if key in query}
+    )
+    if order_service_response.status_code == 400:
+        return order_service_response.json(), 400
+    if not order_service_response.ok:
+        return {"message": "Order not found"}, 422
+    headers = {}
+    if NEXT_CURSOR_HEADER in order_service_response.headers:
+        headers[NEXT_CURSOR_HEADER] = order_service_response.headers[NEXT_CURSOR_HEADER]
+    orders = order_service_response.json()
+    store.order_items_cache.set_many({order["orderUid"]: order["itemUid"] for order in orders})
+
+    if NDJSON_MIMETYPE in http_request.headers.get("Accept", ""):
+        return await stream_orders(http_request, orders, headers)
+
+    # запросить инфу из warehouse и warranty сразу по всем заказам (параллельно)
+    chunk_size = store.LOOKUP_CHUNK_SIZE or len(orders) or 1
+    semaphore = asyncio.Semaphore(store.fan_out.max_concurrency)
+    chunks = await asyncio.gather(*[
+        request_chunk(orders[i:i + chunk_size], semaphore) for i in range(0, len(orders), chunk_size)
+    ])
+    items_info, warranties_info = {}, {}
+    for _, chunk_items_info, chunk_warranties_info in chunks:
+        items_info.update(chunk_items_info)
+        warranties_info.update(chunk_warranties_info)
+
+    item_uids = [order["itemUid"] for order in orders]
+    if any(item_uid not in items_info for item_uid in item_uids):
+        return {"message": "Order in warehouse not found"}, 422
+    if any(item_uid not in warranties_info for item_uid in item_uids):
+        return {"message": "Warranty not found"}, 422
+
+    result = [
+        make_order_info(
+            order["orderUid"],
+            order["orderDate"],
+            items_info.get(order["itemUid"]),
+            warranties_info.get(order["itemUid"]),
+        )
+        for order in orders
+    ]
+    return result, 200, headers
+
+
+@routes.get(f"{ROOT_PATH}/store/{{user_uid}}/{{order_uid}}")
+@api
+async def request_order(http_request, user_uid, order_uid):
+    """
+    Информация по конкретному заказу
+    """
+    user_uid = user_uid.lower()
+    order_uid = order_uid.lower()
+    if not await is_user_exists(user_uid):
+        return {"message": "User not found"}, 404
+
+    # запрос заказа из order_service
+    order_service_response = await shared_request(
+        "GET",
+        f"http://{ORDER_SERVICE_URL}{ROOT_PATH}/orders/{user_uid}/{order_uid}"
+    )
+    if not order_service_response.ok:
+        return {"message": "Order not found"}, 422
+    item_uid = order_service_response.json()["itemUid"]
+    store.order_items_cache.set(order_uid, item_uid)
+
+    # для этого заказа параллельно загружаем инфу из warehouse и warranty
+    item_result, warranty_result = await asyncio.gather(
+        request_item_info(item_uid), request_warranty_info(item_uid), return_exceptions=True
+    )
+    for lookup_result in (item_result, warranty_result):
+        if isinstance(lookup_result, Exception) and not isinstance(lookup_result, cb.CircuitBreakerException):
+            raise lookup_result
+
+    if isinstance(item_result, cb.CircuitBreakerException):
+        item_result = None
+    elif item_result is None:
+        return {"message": "Order in warehouse not found"}, 422
+
+    if isinstance(warranty_result, cb.CircuitBreakerException):
+        warranty_result = None
+    elif warranty_result is None:
+        return {"message": "Warranty not found"}, 422
+
+    result = make_order_info(order_uid, order_service_response.json()["orderDate"], item_result, warranty_result)
+    return result, 200
+
+
+@routes.post(f"{ROOT_PATH}/store/{{user_uid}}/{{order_uid}}/warranty")
+@api
+async def request_warranty(http_request, user_uid, order_uid):
+    """
+    Запрос гарантии по заказу
+    """
+    user_uid = user_uid.lower()
+    order_uid = order_uid.lower()
+    if not await is_user_exists(user_uid):
+        return {"message": "User not found"}, 404
+
+    # парсим входные данные
+    warranty_request, error = await read_json(http_request, WarrantyRequest)
+    if error:
+        return error
+
+    # перенаправляем запрос в order_service
+    try:
+        order_service_response = await circuit_breaker.async_external_request(
+            "POST",
+            f"http://{ORDER_SERVICE_URL}{ROOT_PATH}/orders/{order_uid}/warranty",
+            json={"reason": warranty_request.reason}
+        )
+    except cb.CircuitBreakerException:
+        await run_blocking(store.enqueue_warranty_request, order_uid, warranty_request.reason)
+        return {"message": "Warranty service unavailable, but SUCCESS! Your request added to queue"}, 200
+
+    if not order_service_response.ok:
+        return {"message": "Order not found"}, 422
+    store.invalidate_order_cache(order_uid, order_service_response)
+
+    return {"orderUid": order_uid, **order_service_response.json()}, 200
+
+
+@routes.post(f"{ROOT_PATH}/store/{{user_uid}}/purchase")
+@api
+async def request_purchase(http_request, user_uid):
+    """
+    Выполнить покупку
+    """
+    user_uid = user_uid.lower()
+    if not await is_user_exists(user_uid):
+        return {"message": "User not found"}, 404
+
+    # парсим входные данные
+    new_order_request, error = await read_json(http_request, NewOrderRequest)
+    if error:
+        return error
+
+    # перенаправляем запрос в order_service
+    order_service_response = await circuit_breaker.async_external_request(
+        "POST",
+        f"http://{ORDER_SERVICE_URL}{ROOT_PATH}/orders/{user_uid}",
+        json={"model": new_order_request.model, "size": new_order_request.size}
+    )
+    if not order_service_response.ok:
+        return {"message": "Order not created due to errors. All changes was rolled back"}, 422
+
+    order_uid = order_service_response.json()["orderUid"]
+    return '', 201, {"Location": f"{ROOT_PATH}/store/{user_uid}/{order_uid}"}
+
+
+@routes.post(f"{ROOT_PATH}/store/{{user_uid}}/purchase/batch")
+@api
+async def request_purchase_batch(http_request, user_uid):
+    """
+    Купить сразу несколько вещей: одним запросом в order_service, все или ничего
+    """
+    user_uid = user_uid.lower()
+    if not await is_user_exists(user_uid):
+        return {"message": "User not found"}, 404
+
+    # парсим входные данные
+    basket_request, error = await read_json(http_request, NewBasketRequest)
+    if error:
+        return error
+    if not 0 < len(basket_request.items) <= MAX_BASKET_SIZE:
+        return {"message": f"items count should be in range 1..{MAX_BASKET_SIZE}"}, 400
+
+    # перенаправляем всю корзину в order_service
+    order_service_response = await circuit_breaker.async_external_request(
+        "POST",
+        f"http://{ORDER_SERVICE_URL}{ROOT_PATH}/orders/{user_uid}/batch",
+        json={"items": [{"model": item.model, "size": item.size} for item in basket_request.items]}
+    )
+    if not order_service_response.ok:
+        return {"message": "Orders not created due to errors. All changes was rolled back"}, 422
+
+    return {"orderUids": order_service_response.json()["orderUids"]}, 201
+
+
+@routes.delete(f"{ROOT_PATH}/store/{{user_uid}}/{{order_uid}}/refund")
+@api
+async def request_refund(http_request, user_uid, order_uid):
+    """
+    Вернуть заказ
+    """
+    user_uid = user_uid.lower()
+    order_uid = order_uid.lower()
+    if not await is_user_exists(user_uid):
+        return {"message": "User not found"}, 404
+
+    # перенаправляем запрос в order_service
+    order_service_response = await circuit_breaker.async_external_request(
+        "DELETE",
+        f"http://{ORDER_SERVICE_URL}{ROOT_PATH}/orders/{order_uid}"
+    )
+    if not order_service_response.ok:
+        return {"message": "Order not refunded due to errors. All changes was rolled back"}, 422
+    store.invalidate_order_cache(order_uid, order_service_response)
+    return '', 204
+
+
+async def close_circuit_breaker(app):
+    await circuit_breaker.close()
+
+
+@web.middleware
+async def observe_request(http_request, handler):
+    started = perf_counter()
+    status = 500
+    try:
+        response = await handler(http_request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = http_request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        metrics.observe_request(route, http_request.method, status, perf_counter() - started)
+
+
+@web.middleware
+async def trace_request(http_request, handler):
+    resource = http_request.match_info.route.resource
+    trace = tracing.start_trace(
+        f"{http_request.method} {resource.canonical if resource is not None else 'unmatched'}",
+        http_request.headers.get(tracing.TRACEPARENT_HEADER),
+        service=__name__,
+    )
+    try:
+        response = await handler(http_request)
+        trace.set(status=response.status)
+        return response
+    except Exception as e:
+        trace.fail(e)
+        raise
+    finally:
+        tracing.finish_trace(trace)
+
+
+def make_app():
+    app = web.Application(middlewares=[observe_request, trace_request])
+    app.add_routes(routes)
+    app.on_cleanup.append(close_circuit_breaker)
+    return app
+
+
+if __name__ == '__main__':
+    PORT = os.environ.get("PORT", 8480)
+    print("LISTENING ON PORT:", PORT, "($PORT)")
+    database.create_schema()
+    store.refresh_items_in_db()
+    web.run_app(make_app(), host="0.0.0.0", port=int(PORT))
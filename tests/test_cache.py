@@ -0,0 +1,26 @@
+from unittest.mock import patch
+
+from cache import TTLCache
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set_many({"a": 1, "b": 2})
+    assert cache.get("a") == 1  # теперь "b" - самый старый
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get_many(["a", "b", "c"]) == {"a": 1, "c": 3}
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 2
+
+
+def test_ttl_cache_expiration():
+    cache = TTLCache(max_size=10, ttl=5)
+    with patch("cache.monotonic", return_value=100):
+        cache.set("a", 1)
+    with patch("cache.monotonic", return_value=104):
+        assert cache.get("a") == 1
+    with patch("cache.monotonic", return_value=105):
+        assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
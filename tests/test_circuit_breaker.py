@@ -0,0 +1,391 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import multiprocessing
+from threading import Thread
+from time import sleep, monotonic
+from unittest.mock import patch
+
+import pytest
+import requests
+import requests_mock
+
+import deadline
+import circuit_breaker as cb
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/slow-once" and not self.server.slowed_down:
+            # первый запрос отвечает медленно, остальные - сразу
+            self.server.slowed_down = True
+            sleep(1)
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def http_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    server.slowed_down = False
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f"127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_external_request_reuses_connections(http_server):
+    breaker = cb.CircuitBreaker()
+    for _ in range(3):
+        assert breaker.external_request("GET", f"http://{http_server}/ok").json() == {"ok": True}
+    breaker.pooled_request("GET", f"http://{http_server}/ok")
+
+    stats = breaker.pool_stats()[http_server]
+    assert stats == {"requests": 4, "connections": 1, "reused": 3}
+
+
+def test_retry_policy_backoff_with_jitter():
+    policy = cb.RetryPolicy(base_delay=0.1, max_delay=0.5)
+    for retry in range(6):
+        assert 0 <= policy.backoff(retry) <= min(0.5, 0.1 * 2 ** retry)
+
+
+def test_retry_budget_limits_retries():
+    policy = cb.RetryPolicy(max_attempts=3, base_delay=0)
+    budget = cb.RetryBudget(ratio=0.5, min_per_second=0, max_balance=10)
+    # бюджет пуст: повторов нет, только первая попытка
+    assert len(list(policy.attempts(budget))) == 1
+    # два запроса накопили ровно один повтор
+    assert len(list(policy.attempts(budget))) == 2
+    assert budget.retries == 1
+    assert budget.denied == 2
+
+
+def test_retry_policy_respects_deadline():
+    policy = cb.RetryPolicy(max_attempts=5, base_delay=10, max_delay=10, deadline=0.5)
+    with patch("circuit_breaker.random.uniform", return_value=1):
+        attempts = list(policy.attempts(cb.RetryBudget(min_per_second=100)))
+    assert len(attempts) == 1
+    assert attempts[0][1] <= 0.5
+
+
+@patch("circuit_breaker.RETRY_BASE_DELAY", 0)
+def test_external_request_breaks_circuit():
+    breaker = cb.CircuitBreaker()
+    with requests_mock.Mocker() as m:
+        m.get("http://unavailable/", exc=requests.exceptions.ConnectionError)
+        with pytest.raises(cb.CircuitBreakerException, match="activated"):
+            breaker.external_request("GET", "http://unavailable/")
+        assert m.call_count == cb.NUMBER_OF_ATTEMPTS
+        with pytest.raises(cb.CircuitBreakerException, match="still active"):
+            breaker.external_request("GET", "http://unavailable/")
+        assert m.call_count == cb.NUMBER_OF_ATTEMPTS
+
+
+@patch("circuit_breaker.BREAKER_MIN_CALLS", 4)
+def test_breaker_opens_on_failure_rate():
+    breaker = cb.ServiceBreaker("service")
+    for success in (True, False, True, False):
+        assert breaker.try_acquire()
+        breaker.record(success, 0.1)
+    assert breaker.state == cb.CLOSED  # 50% неудачных - еще не больше порога
+    breaker.record(False, 0.1)
+    assert breaker.state == cb.OPEN
+    assert not breaker.try_acquire()
+
+
+@patch("circuit_breaker.BREAKER_MIN_CALLS", 2)
+@patch("circuit_breaker.BREAKER_HALF_OPEN_PROBES", 2)
+def test_breaker_half_open_probes():
+    breaker = cb.ServiceBreaker("service")
+    breaker.record(False, 0.1)
+    breaker.record(False, 0.1)
+    assert breaker.state == cb.OPEN
+
+    breaker.opened_at -= cb.BREAK_TIME
+    assert breaker.try_acquire() and breaker.try_acquire()
+    assert breaker.state == cb.HALF_OPEN
+    assert not breaker.try_acquire()  # пробных запросов не больше BREAKER_HALF_OPEN_PROBES
+
+    breaker.record(True, 0.1)
+    assert breaker.state == cb.HALF_OPEN
+    breaker.record(True, 0.1)
+    assert breaker.state == cb.CLOSED
+    assert breaker.stats()["calls"] == 0
+
+
+@patch("circuit_breaker.BREAKER_MIN_CALLS", 2)
+@patch("circuit_breaker.BREAKER_HALF_OPEN_PROBES", 1)
+def test_breaker_lost_probe_expires():
+    breaker = cb.ServiceBreaker("service")
+    breaker.record(False, 0.1)
+    breaker.record(False, 0.1)
+    breaker.opened_at -= cb.BREAK_TIME
+    assert breaker.try_acquire()  # пробный запрос, результата которого не будет
+    assert not breaker.try_acquire()
+    breaker.opened_at -= cb.BREAKER_PROBE_TIMEOUT
+    assert breaker.try_acquire()
+    assert breaker.probes_in_flight == 1
+
+
+@patch("circuit_breaker.BREAKER_MIN_CALLS", 2)
+@patch("circuit_breaker.BREAKER_HALF_OPEN_PROBES", 1)
+def test_cancelled_probe_is_released():
+    client = cb.CircuitBreaker()
+    breaker = client.breaker_for("service")
+    breaker.record(False, 0.1)
+    breaker.record(False, 0.1)
+    breaker.opened_at -= cb.BREAK_TIME
+
+    async def hang(method, url, **kwargs):
+        await asyncio.sleep(10)
+
+    async def run():
+        with patch.object(client, "async_pooled_request", side_effect=hang):
+            request = asyncio.ensure_future(client.async_external_request("GET", "http://service/"))
+            await asyncio.sleep(0.01)
+            assert breaker.probes_in_flight == 1
+            request.cancel()
+            await asyncio.gather(request, return_exceptions=True)
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert breaker.probes_in_flight == 0
+    assert breaker.try_acquire()
+
+
+@patch("circuit_breaker.BREAKER_MIN_CALLS", 2)
+def test_breaker_failed_probe_reopens():
+    breaker = cb.ServiceBreaker("service")
+    breaker.record(False, 0.1)
+    breaker.record(False, 0.1)
+    breaker.opened_at -= cb.BREAK_TIME
+    assert breaker.try_acquire()
+    breaker.record(False, 0.1)
+    assert breaker.state == cb.OPEN
+    assert not breaker.try_acquire()
+
+
+@patch("circuit_breaker.BREAKER_MIN_CALLS", 2)
+def test_breaker_opens_on_slow_calls():
+    breaker = cb.ServiceBreaker("service")
+    breaker.record(True, cb.BREAKER_SLOW_CALL_DURATION)
+    breaker.record(True, cb.BREAKER_SLOW_CALL_DURATION)
+    assert breaker.state == cb.OPEN
+
+
+@patch("circuit_breaker.BREAKER_MIN_CALLS", 1000)
+def test_breaker_counts_from_many_threads():
+    breaker = cb.ServiceBreaker("service")
+
+    def record():
+        for _ in range(100):
+            breaker.record(True, 0.1)
+
+    threads = [Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert breaker.stats()["calls"] == 800
+
+
+def open_shared_breaker(path, service):
+    # в отдельном процессе: две неудачные попытки открывают circuit breaker
+    breaker = cb.SharedBreakerState(path).breaker(service)
+    breaker.record(False, 0.1)
+    breaker.record(False, 0.1)
+
+
+@patch("circuit_breaker.BREAKER_MIN_CALLS", 2)
+def test_shared_state_between_processes(tmp_path):
+    path = str(tmp_path / "breakers")
+    shared = cb.SharedBreakerState(path)
+    breaker = cb.CircuitBreaker(shared=shared).breaker_for("warehouse:8280")
+    assert breaker.try_acquire()
+
+    process = multiprocessing.get_context("fork").Process(
+        target=open_shared_breaker, args=(path, "warehouse:8280")
+    )
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+    assert breaker.peek_state() == cb.OPEN
+    with pytest.raises(cb.CircuitBreakerException, match="still active"):
+        breaker.acquire()
+    assert cb.CircuitBreaker(shared=shared).breaker_for("warranty:8180").try_acquire()
+    assert breaker.stats()["failures"] == 2
+    shared.close()
+
+
+def test_external_request_respects_deadline():
+    breaker = cb.CircuitBreaker()
+    with requests_mock.Mocker() as m:
+        m.get("http://service/")
+        deadline.start("0")
+        try:
+            with pytest.raises(cb.DeadlineExceededException):
+                breaker.external_request("GET", "http://service/")
+        finally:
+            deadline.clear()
+        assert m.call_count == 0
+
+        breaker.external_request("GET", "http://service/")
+        assert "X-Deadline-Ms" not in m.last_request.headers
+
+
+def ready_to_hedge(breaker, service):
+    latency = breaker.latency_for(service)
+    latency.samples.extend([0.01] * cb.HEDGE_MIN_SAMPLES)
+    latency.budget.balance = 1
+    return latency
+
+
+def test_hedged_request_wins_over_slow_attempt(http_server):
+    breaker = cb.CircuitBreaker()
+    latency = ready_to_hedge(breaker, http_server)
+
+    started = monotonic()
+    resp = breaker.external_request("GET", f"http://{http_server}/slow-once", hedge=True)
+    assert resp.json() == {"ok": True}
+    assert monotonic() - started < 0.9
+    assert breaker.hedge_stats()[http_server]["sent"] == 1
+    assert latency.won == 1
+    # медленный основной запрос дорабатывает в фоне и держит свое место в bulkhead'е
+    assert breaker.bulkhead_stats()[http_server]["inFlight"] == 1
+    sleep(1.2)
+    assert breaker.bulkhead_stats()[http_server]["inFlight"] == 0
+
+
+def test_hedged_request_covers_failed_primary():
+    breaker = cb.CircuitBreaker()
+    latency = ready_to_hedge(breaker, "service")
+    calls = []
+
+    def pooled_request(method, url, **kwargs):
+        calls.append(url)
+        if len(calls) == 1:
+            # основной запрос долгий и с ошибкой
+            sleep(0.3)
+            raise requests.ConnectionError("reset")
+        assert breaker.bulkhead_stats()["service"]["inFlight"] == 2
+        return requests_mock.create_response(requests.Request("GET", url).prepare(), json={"ok": True})
+
+    with patch.object(breaker, "pooled_request", side_effect=pooled_request):
+        resp = breaker.external_request("GET", "http://service/", hedge=True)
+        assert resp.json() == {"ok": True}
+        sleep(0.4)
+    assert len(calls) == 2
+    assert (latency.sent, latency.won) == (1, 1)
+    assert breaker.bulkhead_stats()["service"]["inFlight"] == 0
+
+
+def test_hedge_needs_free_bulkhead_slot():
+    breaker = cb.CircuitBreaker()
+    latency = ready_to_hedge(breaker, "service")
+    breaker.bulkheads["service"] = cb.Bulkhead("service", max_concurrent=1)
+    calls = []
+
+    def pooled_request(method, url, **kwargs):
+        calls.append(url)
+        sleep(0.2)
+        return requests_mock.create_response(requests.Request("GET", url).prepare(), json={"ok": True})
+
+    with patch.object(breaker, "pooled_request", side_effect=pooled_request):
+        assert breaker.external_request("GET", "http://service/", hedge=True).json() == {"ok": True}
+    # единственное место занято основным запросом - хедж не отправлялся
+    assert len(calls) == 1
+    assert latency.sent == 0
+    assert latency.budget.balance >= 1
+
+
+def test_hedge_rate_is_limited(http_server):
+    breaker = cb.CircuitBreaker()
+    latency = ready_to_hedge(breaker, http_server)
+    latency.budget.balance = 0
+
+    started = monotonic()
+    breaker.external_request("GET", f"http://{http_server}/slow-once", hedge=True)
+    assert monotonic() - started >= 1
+    assert latency.sent == 0
+
+
+def test_async_hedged_request_cancels_loser():
+    breaker = cb.CircuitBreaker()
+    latency = ready_to_hedge(breaker, "service")
+    calls = []
+
+    async def pooled_request(method, url, **kwargs):
+        calls.append(url)
+        if len(calls) == 1:
+            await asyncio.sleep(10)
+        return cb.AsyncResponse(200, {}, b'{"ok": true}')
+
+    async def run():
+        with patch.object(breaker, "async_pooled_request", side_effect=pooled_request):
+            return await breaker.async_external_request("GET", "http://service/", hedge=True)
+
+    assert asyncio.get_event_loop().run_until_complete(run()).json() == {"ok": True}
+    assert len(calls) == 2
+    assert latency.won == 1
+
+
+def test_bulkhead_rejects_when_queue_is_full():
+    bulkhead = cb.Bulkhead("service", max_concurrent=1, max_waiting=1, wait_timeout=0.2)
+    bulkhead.acquire()
+
+    waiter = Thread(target=lambda: pytest.raises(cb.BulkheadFullException, bulkhead.acquire))
+    waiter.start()
+    while bulkhead.stats()["waiting"] == 0:
+        sleep(0.01)
+    with pytest.raises(cb.BulkheadFullException, match="wait queue is full"):
+        bulkhead.acquire()
+    waiter.join()
+
+    assert bulkhead.stats() == {"maxConcurrent": 1, "inFlight": 1, "waiting": 0, "rejected": 2}
+    bulkhead.release()
+    bulkhead.acquire()
+    assert bulkhead.stats()["inFlight"] == 1
+
+
+def test_bulkhead_cancelled_async_waiter_leaves_queue():
+    bulkhead = cb.Bulkhead("service", max_concurrent=1, max_waiting=2, wait_timeout=5)
+
+    async def run():
+        await bulkhead.async_acquire()
+        for _ in range(3):
+            waiters = [asyncio.ensure_future(bulkhead.async_acquire()) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            assert bulkhead.stats()["waiting"] == 2
+            for waiter in waiters:
+                waiter.cancel()
+            await asyncio.gather(*waiters, return_exceptions=True)
+            assert bulkhead.stats()["waiting"] == 0
+
+        waiter = asyncio.ensure_future(bulkhead.async_acquire())
+        await asyncio.sleep(0.01)
+        bulkhead.async_release()
+        await waiter
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert bulkhead.stats() == {"maxConcurrent": 1, "inFlight": 1, "waiting": 0, "rejected": 0}
+
+
+def test_bulkhead_rejection_goes_to_circuit_break_path():
+    breaker = cb.CircuitBreaker()
+    bulkhead = breaker.bulkheads["service"] = cb.Bulkhead("service", max_concurrent=1, max_waiting=0)
+    bulkhead.acquire()
+    with requests_mock.Mocker() as m:
+        m.get("http://service/")
+        response = cb.handles_circuit_break(lambda: breaker.external_request("GET", "http://service/"))()
+        assert response[1] == cb.CIRCUIT_BREAK_STATUS_CODE
+        assert m.call_count == 0
+    assert breaker.breaker_for("service").stats()["calls"] == 0
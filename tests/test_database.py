@@ -0,0 +1,121 @@
+from unittest.mock import patch
+
+from flask import Flask
+import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+import database
+import order_service
+import warehouse_service
+from cache import TTLCache
+from database import Session
+from warranty_service import Warranty
+
+
+def count_checkouts(engine):
+    checkouts = []
+    event.listen(engine, "checkout", lambda *args: checkouts.append(1))
+    return checkouts
+
+
+def add_warranty(item_uid):
+    with Session() as s:
+        s.add(Warranty(item_uid=item_uid, status="ON_WARRANTY"))
+
+
+def test_request_scoped_session_uses_one_connection(fresh_database):
+    app = Flask(__name__)
+    database.install(app)
+
+    @app.route("/two-sessions", methods=["POST"])
+    def two_sessions():
+        add_warranty("item-1")
+        add_warranty("item-2")
+        with Session() as s:
+            return {"count": s.query(Warranty).count()}, 200
+
+    checkouts = count_checkouts(fresh_database)
+    with app.test_client() as test_client:
+        assert test_client.post("/two-sessions").json == {"count": 2}
+    assert len(checkouts) == 1
+
+    # коммиты блоков видны после конца запроса
+    with Session() as s:
+        assert s.query(Warranty).count() == 2
+
+
+def test_failed_block_rolls_back_only_itself(fresh_database):
+    app = Flask(__name__)
+    database.install(app)
+
+    @app.route("/partial", methods=["POST"])
+    def partial():
+        add_warranty("item-1")
+        try:
+            with Session() as s:
+                s.add(Warranty(item_uid="item-2", status="ON_WARRANTY"))
+                raise ValueError
+        except ValueError:
+            pass
+        return "", 204
+
+    with app.test_client() as test_client:
+        assert test_client.post("/partial").status_code == 204
+    with Session() as s:
+        assert [w.item_uid for w in s.query(Warranty)] == ["item-1"]
+
+
+def test_sessions_without_request_scope(fresh_database):
+    checkouts = count_checkouts(fresh_database)
+    add_warranty("item-1")
+    add_warranty("item-2")
+    assert len(checkouts) == 2
+
+
+def test_migrations_are_applied_once(fresh_database):
+    assert database.migrate("order_service", order_service.MIGRATIONS) == [1]
+    assert database.migrate("warehouse_service", warehouse_service.MIGRATIONS) == [1, 2]
+    assert database.migrate("order_service", order_service.MIGRATIONS) == []
+
+    indexes = {index["name"] for table in ("orders", "item", "order_item")
+               for index in sa.inspect(fresh_database).get_indexes(table)}
+    assert {"ix_orders_user_uid_order_date", "ix_item_model_size", "ix_order_item_order_uid"} <= indexes
+
+
+def make_replica(*item_uids):
+    engine = sa.create_engine("sqlite:///:memory:")
+    database.create_schema(engine_=engine)
+    factory = sessionmaker(bind=engine)
+    s = factory()
+    s.add_all([Warranty(item_uid=item_uid, status="ON_WARRANTY") for item_uid in item_uids])
+    s.commit()
+    s.close()
+    return factory
+
+
+def read_item_uids(*keys):
+    with database.ReadSession(*keys) as s:
+        return sorted(warranty.item_uid for warranty in s.query(Warranty))
+
+
+def test_read_session_round_robin_over_replicas(fresh_database):
+    add_warranty("primary")
+    replicas = [make_replica("replica-1"), make_replica("replica-2")]
+    with patch("database.replica_factories", replicas), patch("database.recent_writes", TTLCache(100, 5)):
+        assert {tuple(read_item_uids("user")) for _ in range(4)} == {("replica-1",), ("replica-2",)}
+
+
+def test_read_session_reads_own_writes_from_primary(fresh_database):
+    add_warranty("primary")
+    with patch("database.replica_factories", [make_replica("replica")]), \
+            patch("database.recent_writes", TTLCache(100, 5)):
+        database.mark_write("writer")
+        assert read_item_uids("writer") == ["primary"]
+        assert read_item_uids("other", "writer") == ["primary"]
+        assert read_item_uids("other") == ["replica"]
+
+
+def test_read_session_without_replicas_is_primary(fresh_database):
+    add_warranty("primary")
+    assert read_item_uids("user") == ["primary"]
@@ -0,0 +1,36 @@
+from threading import Lock
+from time import sleep
+
+from fanout import FanOut
+
+
+def test_fan_out_limits_concurrency():
+    fan_out = FanOut(pool_size=8, max_concurrency=2)
+    lock = Lock()
+    running = [0, 0]  # сейчас выполняется, максимум одновременно
+
+    def task(i):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return i
+
+    with fan_out.limited() as pool:
+        futures = [pool.submit(task, i) for i in range(6)]
+
+    assert [future.result() for future in futures] == list(range(6))
+    assert running[1] == 2
+
+
+def test_fan_out_keeps_exceptions():
+    fan_out = FanOut(pool_size=2)
+
+    def fail():
+        raise ValueError("boom")
+
+    with fan_out.limited() as pool:
+        future = pool.submit(fail)
+    assert isinstance(future.exception(), ValueError)
@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+import pytest
+
+import metrics
+from group_commit import GroupCommitter
+
+
+def test_concurrent_submits_are_written_in_one_batch():
+    batches = []
+    first_write = Event()
+    release = Event()
+
+    def write_batch(items):
+        batches.append(sorted(items))
+        first_write.set()
+        release.wait(5)
+
+    committer = GroupCommitter("test-batch", write_batch, max_batch=100, max_wait=0.05)
+    with ThreadPoolExecutor(11) as pool:
+        # первая пачка пишется, пока остальные 10 копятся в следующую
+        first = pool.submit(committer.submit, 0)
+        assert first_write.wait(5)
+        rest = [pool.submit(committer.submit, item) for item in range(1, 11)]
+        assert not any(future.done() for future in rest)
+        release.set()
+        for future in [first, *rest]:
+            future.result(5)
+    assert batches == [[0], list(range(1, 11))]
+    assert metrics.group_commit_batch_size.count("test-batch") == 2
+    assert metrics.group_commit_wait.count("test-batch") == 11
+
+
+def test_batch_is_limited_by_max_batch():
+    batches = []
+    committer = GroupCommitter("test-limit", lambda items: batches.append(len(items)), max_batch=3, max_wait=0.05)
+    with ThreadPoolExecutor(7) as pool:
+        list(pool.map(committer.submit, range(7)))
+    assert sum(batches) == 7
+    assert max(batches) <= 3
+
+
+def test_failed_batch_falls_back_to_single_rows():
+    written = []
+
+    def write_batch(items):
+        if "bad" in items:
+            raise ValueError("duplicate")
+        written.extend(items)
+
+    committer = GroupCommitter("test-fallback", write_batch, max_batch=100, max_wait=0.05)
+    with ThreadPoolExecutor(3) as pool:
+        futures = {item: pool.submit(committer.submit, item) for item in ("a", "bad", "b")}
+        assert futures["a"].result(5) is None
+        assert futures["b"].result(5) is None
+        with pytest.raises(ValueError, match="duplicate"):
+            futures["bad"].result(5)
+    assert sorted(written) == ["a", "b"]
@@ -0,0 +1,65 @@
+from unittest.mock import patch
+
+import requests
+import requests_mock
+
+import circuit_breaker as cb
+import metrics
+from warranty_service import app
+
+
+def test_histogram_render():
+    histogram = metrics.Histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1))
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(5, "/a")
+    assert list(histogram.render()) == [
+        'latency_seconds_bucket{route="/a",le="0.1"} 1',
+        'latency_seconds_bucket{route="/a",le="1"} 2',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+        'latency_seconds_sum{route="/a"} 5.55',
+        'latency_seconds_count{route="/a"} 3',
+    ]
+
+
+def test_label_escaping():
+    counter = metrics.Counter("errors_total", "Errors", ("message",))
+    counter.inc('say "hi"\n')
+    assert list(counter.render()) == ['errors_total{message="say \\"hi\\"\\n"} 1']
+
+
+def test_metrics_endpoint(fresh_database):
+    route = "/api/v1/warranty/<string:item_uid>"
+    before = metrics.http_requests.get(route, "GET", "404")
+    sessions_before = metrics.db_session_duration.count("commit")
+    with app.test_client() as test_client:
+        assert test_client.get("/api/v1/warranty/unknown").status_code == 404
+        response = test_client.get("/manage/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    assert metrics.http_requests.get(route, "GET", "404") == before + 1
+    assert metrics.db_session_duration.count("commit") == sessions_before + 1
+    body = response.get_data(as_text=True)
+    assert "# TYPE http_request_duration_seconds histogram" in body
+    assert f'http_requests_total{{route="{route}",method="GET",status="404"}}' in body
+
+
+@patch("circuit_breaker.RETRY_BASE_DELAY", 0)
+def test_dependency_metrics():
+    breaker = cb.CircuitBreaker()
+    breaker.export_metrics()
+    with requests_mock.Mocker() as m:
+        m.get("http://metrics-ok/")
+        m.get("http://metrics-down/", exc=requests.exceptions.ConnectionError)
+        breaker.external_request("GET", "http://metrics-ok/")
+        for _ in range(2):
+            try:
+                breaker.external_request("GET", "http://metrics-down/")
+            except cb.CircuitBreakerException:
+                pass
+
+    assert metrics.dependency_requests.get("metrics-ok", "success") == 1
+    assert metrics.dependency_requests.get("metrics-down", "error") == cb.NUMBER_OF_ATTEMPTS
+    assert metrics.dependency_requests.get("metrics-down", "rejected") == 1
+    assert metrics.breaker_transitions.get("metrics-down", cb.CLOSED, cb.OPEN) == 1
+    assert 'circuit_breaker_state{dependency="metrics-down"} 1' in metrics.registry.render()
@@ -1,6 +1,6 @@
 from database import Session
 from order_service import Order
-from datetime import date
+from datetime import date, datetime
 import re
 
 import requests_mock
@@ -64,6 +64,33 @@ def test_request_all_orders(fresh_database, add_some_order):
         assert response.json[0]["status"] == "PAID"
 
 
+def test_request_all_orders_paginated(fresh_database):
+    with Session() as s:
+        s.add_all([Order(
+            item_uid=f"item-{i}",
+            order_date=datetime(2020, 11, 20 + i // 2),
+            order_uid=f"{i}-{i}-{i}",
+            status="PAID",
+            user_uid="1",
+        ) for i in range(5)])
+
+    with app.test_client() as test_client:
+        order_uids = []
+        cursor = None
+        for _ in range(3):
+            query = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+            response = test_client.get("/api/v1/orders/1", query_string=query)
+            assert response.status_code == 200
+            order_uids += [order["orderUid"] for order in response.json]
+            cursor = response.headers.get("X-Next-Cursor")
+        assert order_uids == [f"{i}-{i}-{i}" for i in range(5)]
+        assert cursor is None
+
+        assert test_client.get("/api/v1/orders/1", query_string={"cursor": "bad"}).status_code == 400
+        assert test_client.get("/api/v1/orders/1", query_string={"limit": 0}).status_code == 400
+        assert test_client.get("/api/v1/orders/1", query_string={"limit": "abc"}).status_code == 400
+
+
 def test_request_warranty(fresh_database, add_some_order):
     with app.test_client() as test_client:
         with requests_mock.Mocker(real_http=True) as m:
@@ -78,6 +105,7 @@ def test_request_warranty(fresh_database, add_some_order):
             )
             assert response.status == "200 OK"
             assert response.json["decision"] == "FIXING"
+            assert response.headers["X-Item-Uid"] == "item-1"
 
 
 def test_request_delete_order(fresh_database, add_some_order):
@@ -87,3 +115,86 @@ def test_request_delete_order(fresh_database, add_some_order):
             m.delete(re.compile("/api/v1/warehouse"))
             response = test_client.delete("/api/v1/orders/1-1-1")
             assert response.status == "204 NO CONTENT"
+            assert response.headers["X-Item-Uid"] == "item-1"
+
+
+def test_request_new_order_propagates_deadline(fresh_database):
+    with app.test_client() as test_client:
+        with requests_mock.Mocker() as m:
+            m.post(
+                re.compile("/api/v1/warehouse"),
+                json={"orderItemUid": "item-1", "orderUid": "1-1-1", "model": "Lego 8880", "size": "L"}
+            )
+            m.post(re.compile("/api/v1/warranty/item-1"))
+
+            response = test_client.post(
+                "/api/v1/orders/1",
+                json={"model": "Lego 8880", "size": "L"},
+                headers={"X-Deadline-Ms": "5000"}
+            )
+            assert response.status_code == 200
+            for call in m.request_history:
+                assert 0 < int(call.headers["X-Deadline-Ms"]) <= 5000
+
+
+def test_expired_deadline_rejected_early(fresh_database):
+    with app.test_client() as test_client:
+        with requests_mock.Mocker() as m:
+            response = test_client.post(
+                "/api/v1/orders/1",
+                json={"model": "Lego 8880", "size": "L"},
+                headers={"X-Deadline-Ms": "0"}
+            )
+            assert response.status_code == 504
+            assert m.call_count == 0
+
+
+def test_downstream_deadline_exceeded(fresh_database):
+    with app.test_client() as test_client:
+        with requests_mock.Mocker() as m:
+            m.post(re.compile("/api/v1/warehouse"), status_code=504, json={"message": "Deadline exceeded"})
+
+            response = test_client.post("/api/v1/orders/1", json={"model": "Lego 8880", "size": "L"})
+            assert response.status_code == 504
+
+
+BASKET = {"items": [{"model": "Lego 8880", "size": "L"}, {"model": "Lego 8070", "size": "M"}]}
+
+
+def mock_reserve(request, context):
+    return [{"orderItemUid": f"item-{i}", **item} for i, item in enumerate(request.json()["items"])]
+
+
+def test_request_new_orders_batch(fresh_database):
+    with app.test_client() as test_client:
+        with requests_mock.Mocker(real_http=True) as m:
+            m.get(re.compile("/manage/health"), text='')
+            m.post(re.compile("/api/v1/warehouse/batch/reserve"), json=mock_reserve)
+            warranty = m.post(re.compile("/api/v1/warranty/batch/start"), status_code=204)
+
+            response = test_client.post("/api/v1/orders/1/batch", json=BASKET)
+            assert response.status_code == 200
+            assert len(response.json["orderUids"]) == 2
+            assert warranty.call_count == 1
+            assert warranty.last_request.json() == {"itemUids": ["item-0", "item-1"]}
+
+    with Session() as s:
+        assert sorted(order.item_uid for order in s.query(Order)) == ["item-0", "item-1"]
+
+
+def test_request_new_orders_batch_rolls_back(fresh_database):
+    with app.test_client() as test_client:
+        with requests_mock.Mocker(real_http=True) as m:
+            m.get(re.compile("/manage/health"), text='')
+            m.post(re.compile("/api/v1/warehouse/batch/reserve"), json=mock_reserve)
+            m.post(re.compile("/api/v1/warranty/batch/start"), status_code=400, json={"message": "bad"})
+            release = m.post(re.compile("/api/v1/warehouse/batch/release"), status_code=204)
+
+            response = test_client.post("/api/v1/orders/1/batch", json=BASKET)
+            assert response.status_code == 422
+            assert release.last_request.json() == {"itemUids": ["item-0", "item-1"]}
+
+            assert test_client.post("/api/v1/orders/1/batch", json={"items": []}).status_code == 400
+
+    with Session() as s:
+        assert s.query(Order).count() == 0
@@ -0,0 +1,111 @@
+from threading import Thread
+from unittest.mock import patch, MagicMock
+
+import pika
+import pytest
+
+import rabbitmq as mq
+
+
+@pytest.fixture()
+def fake_pika():
+    with patch("rabbitmq.pika.BlockingConnection") as connection_class:
+        connection_class.side_effect = lambda *args: MagicMock()
+        yield connection_class
+
+
+def test_pool_reuses_connection(fake_pika):
+    pool = mq.ChannelPool(size=2, confirms="none")
+    with patch("rabbitmq.pool", pool):
+        for _ in range(3):
+            with mq.Queue() as q:
+                q.publish({"reason": "Broken"})
+
+    assert fake_pika.call_count == 1
+    pooled = pool.idle.get_nowait()
+    pooled.channel.queue_declare.assert_called_once()
+    assert pooled.channel.basic_publish.call_count == 3
+
+
+def test_pool_reconnects_broken_connection(fake_pika):
+    pool = mq.ChannelPool(size=1, confirms="none")
+    with patch("rabbitmq.pool", pool):
+        with pytest.raises(pika.exceptions.AMQPConnectionError):
+            with mq.Queue() as q:
+                raise pika.exceptions.AMQPConnectionError()
+        with mq.Queue() as q:
+            q.channel.is_open = False
+        with mq.Queue() as q:
+            q.publish({"reason": "Broken"})
+
+    assert fake_pika.call_count == 3
+
+
+def confirming_connection(confirmed_batches):
+    """
+    Соединение, брокер которого подтверждает все опубликованное одним multiple ack
+    """
+    connection = MagicMock()
+    impl = connection.channel.return_value._impl
+    published = []
+
+    def confirm_delivery(ack_nack_callback, callback):
+        impl.ack_nack_callback = ack_nack_callback
+        callback(None)
+
+    def process_data_events(time_limit):
+        if len(published) > sum(confirmed_batches):
+            confirmed_batches.append(len(published) - sum(confirmed_batches))
+            ack = pika.spec.Basic.Ack(delivery_tag=len(published), multiple=True)
+            impl.ack_nack_callback(MagicMock(method=ack))
+
+    impl.confirm_delivery.side_effect = confirm_delivery
+    impl.basic_publish.side_effect = lambda **kwargs: published.append(kwargs["body"])
+    connection.process_data_events.side_effect = process_data_events
+    return connection
+
+
+@patch("rabbitmq.QUEUE_CONFIRM_MAX_WAIT_MS", 200)
+def test_batch_publish_confirms(fake_pika):
+    confirmed_batches = []
+    fake_pika.side_effect = lambda *args: confirming_connection(confirmed_batches)
+    pool = mq.ChannelPool(size=3, confirms="batch")
+
+    def publish():
+        with mq.Queue() as q:
+            q.publish({"reason": "Broken"})
+
+    with patch("rabbitmq.pool", pool):
+        # publish'и из разных with подтверждаются одной пачкой
+        threads = [Thread(target=publish) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert confirmed_batches == [3]
+
+        publish()
+        assert confirmed_batches == [3, 1]
+    pooled = pool.idle.get_nowait()
+    pooled.channel.basic_publish.assert_not_called()
+    pooled.channel.confirm_delivery.assert_not_called()
+
+
+def test_release_requeues_unacked_messages(fake_pika):
+    pool = mq.ChannelPool(size=1, confirms="none")
+    with patch("rabbitmq.pool", pool):
+        with mq.Queue() as q:
+            q.channel.consume.return_value = [
+                (MagicMock(delivery_tag=tag), None, b'{"orderUid": "1-1-1"}') for tag in (1, 2, 3)
+            ]
+            batch = q.get_batch(3)
+            q.ack(batch[0][0])
+        # 2 и 3 выданы, но не подтверждены: соединение уходит в пул, поэтому они возвращаются в очередь явно
+        q.channel.basic_nack.assert_called_once_with(delivery_tag=0, multiple=True, requeue=True)
+        assert not q.pooled.unacked
+
+        with mq.Queue() as q:
+            q.channel.consume.return_value = [(MagicMock(delivery_tag=4), None, b'{}')]
+            [(delivery_tag, _)] = q.get_batch(1)
+            q.ack(delivery_tag)
+        q.channel.basic_nack.assert_called_once()
@@ -0,0 +1,178 @@
+import asyncio
+from threading import Event, Thread
+from time import monotonic
+
+import pytest
+
+import deadline
+import singleflight
+from circuit_breaker import DeadlineExceededException
+
+
+def run_concurrently(group, func, count=5):
+    results = []
+
+    def call():
+        try:
+            results.append(group.do("key", func))
+        except Exception as e:
+            results.append(e)
+
+    threads = [Thread(target=call) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_concurrent_calls_share_one_execution():
+    group = singleflight.Group()
+    release = Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait()
+        return {"model": "Lego 8880"}
+
+    threads, results = run_concurrently(group, fetch)
+    while group.stats()["shared"] < 4:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [{"model": "Lego 8880"}] * 5
+    assert group.stats() == {"executed": 1, "shared": 4, "inFlight": 0}
+
+
+def test_error_is_shared_but_not_cached():
+    group = singleflight.Group()
+    release = Event()
+
+    def fail():
+        release.wait()
+        raise ValueError("warehouse is down")
+
+    threads, results = run_concurrently(group, fail, count=3)
+    while group.stats()["shared"] < 2:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert all(isinstance(result, ValueError) for result in results)
+
+    assert group.do("key", lambda: "recovered") == "recovered"
+    assert group.stats()["executed"] == 2
+
+
+def test_waiter_keeps_its_own_deadline():
+    group = singleflight.Group()
+    release = Event()
+    results = {}
+
+    def fetch():
+        release.wait()
+        return "slow"
+
+    def call(name, deadline_ms):
+        deadline.start(default_ms=deadline_ms)
+        try:
+            results[name] = group.do("key", fetch)
+        except DeadlineExceededException as e:
+            results[name] = e
+
+    leader = Thread(target=call, args=("leader", None))
+    leader.start()
+    while group.stats()["inFlight"] < 1:
+        pass
+    # ждущий с коротким дедлайном не ждет дольше своего времени
+    started = monotonic()
+    try:
+        call("waiter", 100)
+    finally:
+        deadline.clear()
+    assert isinstance(results["waiter"], DeadlineExceededException)
+    assert monotonic() - started < 1
+    release.set()
+    leader.join()
+    assert results["leader"] == "slow"
+
+
+def test_waiter_with_time_left_retries_expired_call():
+    group = singleflight.Group()
+    release = Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        if len(calls) == 1:
+            release.wait()
+            raise DeadlineExceededException("leader ran out of time")
+        return "fresh"
+
+    threads, results = run_concurrently(group, fetch, count=2)
+    while group.stats()["shared"] < 1:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+    # у первого вызова время вышло, а ждущий выполнил запрос сам
+    assert len(calls) == 2
+    assert "fresh" in results
+    assert any(isinstance(result, DeadlineExceededException) for result in results)
+
+
+def test_async_group():
+    group = singleflight.AsyncGroup()
+    calls = []
+
+    async def fetch(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    async def run():
+        return await asyncio.gather(*(group.do("key", fetch, i) for i in range(3)))
+
+    assert asyncio.run(run()) == [0, 0, 0]
+    assert calls == [0]
+
+
+def test_async_group_error_is_not_cached():
+    group = singleflight.AsyncGroup()
+
+    async def fail():
+        raise ValueError("warranty is down")
+
+    async def ok():
+        return "recovered"
+
+    async def run():
+        with pytest.raises(ValueError):
+            await group.do("key", fail)
+        await asyncio.sleep(0)
+        return await group.do("key", ok)
+
+    assert asyncio.run(run()) == "recovered"
+
+
+def test_async_waiter_keeps_its_own_deadline():
+    group = singleflight.AsyncGroup()
+
+    async def fetch():
+        await asyncio.sleep(0.5)
+        return "slow"
+
+    async def waiter():
+        deadline.start(default_ms=50)
+        with pytest.raises(DeadlineExceededException):
+            await group.do("key", fetch)
+
+    async def run():
+        leader = asyncio.ensure_future(group.do("key", fetch))
+        await asyncio.sleep(0)
+        await asyncio.ensure_future(waiter())
+        return await leader
+
+    assert asyncio.run(run()) == "slow"
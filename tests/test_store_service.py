@@ -1,21 +1,80 @@
-from database import Session
+from database import Session, create_schema
 from order_service import Order
 from datetime import date
+import json
 import re
+import time
+from threading import Thread
 from unittest.mock import patch
 
 import requests_mock
 import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 
+import store_service
 from store_service import app, User
 from rabbitmq import TestQueue
 
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    for cache in (store_service.items_cache, store_service.warranties_cache, store_service.order_items_cache):
+        cache.clear()
+    store_service.user_directory.reset()
+
+
 @pytest.fixture()
 def add_some_user():
     with Session() as s:
         s.add(User(id=1, name='Alex', user_uid='1'))
 
 
+def test_user_directory(fresh_database, add_some_user):
+    directory = store_service.user_directory
+    assert directory.contains('1')
+    assert not directory.contains('2')
+
+    # неизвестный пользователь кэшируется, пока не истечет USER_NEGATIVE_TTL
+    with Session() as s:
+        s.add(User(id=2, name='Bob', user_uid='2'))
+    assert not directory.contains('2')
+    directory.unknown_users.clear()
+    assert directory.contains('2')
+
+    # пользователь, добавленный через хук, виден сразу
+    assert not directory.contains('3')
+    directory.add('3')
+    assert directory.contains('3')
+
+
+def test_user_directory_reloads_once(tmp_path):
+    # файл, а не :memory:, чтобы все потоки работали с одной базой
+    engine = create_engine(f"sqlite:///{tmp_path / 'store.db'}", connect_args={"timeout": 30})
+    create_schema(engine_=engine)
+    directory = store_service.user_directory
+    real_session = store_service.database.Session
+    sessions = []
+
+    def slow_session():
+        sessions.append(1)
+        time.sleep(0.05)
+        return real_session()
+
+    with patch("database.engine", engine), patch("database.session_factory", sessionmaker(bind=engine)):
+        with Session() as s:
+            s.add(User(id=1, name='Alex', user_uid='1'))
+        # справочник устарел, и сразу несколько запросов проверяют пользователя
+        with patch('store_service.database.Session', slow_session):
+            threads = [Thread(target=directory.contains, args=('1',)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert len(sessions) == 1
+        assert directory.contains('1')
+
+
 def test_request_all_orders(fresh_database, add_some_user):
     with app.test_client() as test_client:
         with requests_mock.Mocker(real_http=True) as m:
@@ -29,17 +88,17 @@ def test_request_all_orders(fresh_database, add_some_user):
                     'status': 'PAID'
                 }]
             )
-            m.get(
-                re.compile("/api/v1/warehouse"),
-                json={'model': 'item one', 'size': 'L'}
+            m.post(
+                re.compile("/api/v1/warehouse/batch"),
+                json=[{'orderItemUid': 'item-1', 'model': 'item one', 'size': 'L'}]
             )
-            m.get(
-                re.compile("/api/v1/warranty"),
-                json={
-                    "itemUid": "3fa85f64-5717-4562-b3fc-2c963f66afa6",
+            m.post(
+                re.compile("/api/v1/warranty/batch"),
+                json=[{
+                    "itemUid": "item-1",
                     "warrantyDate": "2020-11-22T00:00:00",
                     "status": "FIXING"
-                }
+                }]
             )
             response = test_client.get("/api/v1/store/1/orders")
             assert response.status == "200 OK"
@@ -49,6 +108,141 @@ def test_request_all_orders(fresh_database, add_some_user):
             assert "date" in response.json[0]
             assert "warrantyDate" in response.json[0]
             assert "warrantyStatus" in response.json[0]
+            # на все заказы - по одному запросу в каждый сервис
+            assert m.call_count == 3
+
+
+def test_request_all_orders_paginated(fresh_database, add_some_user):
+    with app.test_client() as test_client:
+        with requests_mock.Mocker(real_http=True) as m:
+            orders_mock = m.get(
+                re.compile("/api/v1/orders/1"),
+                json=[{
+                    'itemUid': 'item-1',
+                    'orderDate': '2020-11-22T00:00:00',
+                    'orderUid': '1-1-1',
+                    'status': 'PAID'
+                }],
+                headers={"X-Next-Cursor": "next"}
+            )
+            m.post(
+                re.compile("/api/v1/warehouse/batch"),
+                json=[{'orderItemUid': 'item-1', 'model': 'item one', 'size': 'L'}]
+            )
+            m.post(
+                re.compile("/api/v1/warranty/batch"),
+                json=[{"itemUid": "item-1", "warrantyDate": "2020-11-22T00:00:00", "status": "ON"}]
+            )
+            response = test_client.get("/api/v1/store/1/orders?limit=1&cursor=abc")
+            assert response.status == "200 OK"
+            assert response.headers["X-Next-Cursor"] == "next"
+            assert orders_mock.last_request.qs == {"limit": ["1"], "cursor": ["abc"]}
+
+
+def test_request_all_orders_partially_available(fresh_database, add_some_user):
+    with app.test_client() as test_client:
+        with requests_mock.Mocker(real_http=True) as m:
+            m.get(re.compile("/manage/health"), text='')
+            m.get(
+                re.compile("/api/v1/orders/1"),
+                json=[{
+                    'itemUid': f'item-{i}',
+                    'orderDate': '2020-11-22T00:00:00',
+                    'orderUid': f'{i}-{i}-{i}',
+                    'status': 'PAID'
+                } for i in range(3)]
+            )
+            m.post(
+                re.compile("/api/v1/warehouse/batch"),
+                json=[{'orderItemUid': f'item-{i}', 'model': 'item', 'size': 'L'} for i in range(3)]
+            )
+            m.post(re.compile("/api/v1/warranty/batch"), status_code=555, text="unavailable")
+            response = test_client.get("/api/v1/store/1/orders")
+            assert response.status == "200 OK"
+            assert len(response.json) == 3
+            for order_info in response.json:
+                assert order_info["model"] == "item"
+                assert "warrantyStatus" not in order_info
+                assert "circuit_breaker" in order_info
+
+
+@patch('store_service.LOOKUP_CHUNK_SIZE', 2)
+def test_request_all_orders_chunked(fresh_database, add_some_user):
+    def warranty_batch(request, context):
+        item_uids = request.json()["itemUids"]
+        if "item-2" in item_uids:
+            context.status_code = 555
+            return "unavailable"
+        return [{"itemUid": uid, "warrantyDate": "2020-11-22T00:00:00", "status": "ON"} for uid in item_uids]
+
+    with app.test_client() as test_client:
+        with requests_mock.Mocker(real_http=True) as m:
+            m.get(
+                re.compile("/api/v1/orders/1"),
+                json=[{
+                    'itemUid': f'item-{i}',
+                    'orderDate': '2020-11-22T00:00:00',
+                    'orderUid': f'{i}-{i}-{i}',
+                    'status': 'PAID'
+                } for i in range(3)]
+            )
+            m.post(
+                re.compile("/api/v1/warehouse/batch"),
+                json=lambda request, context: [
+                    {'orderItemUid': uid, 'model': 'item', 'size': 'L'} for uid in request.json()["itemUids"]
+                ]
+            )
+            m.post(re.compile("/api/v1/warranty/batch"), json=warranty_batch)
+            response = test_client.get("/api/v1/store/1/orders")
+            assert response.status == "200 OK"
+            assert m.call_count == 5
+            assert "circuit_breaker" not in response.json[0]
+            assert "circuit_breaker" not in response.json[1]
+            assert "circuit_breaker" in response.json[2]
+
+
+@patch('store_service.STREAM_CHUNK_SIZE', 2)
+def test_request_all_orders_ndjson(fresh_database, add_some_user):
+    with app.test_client() as test_client:
+        with requests_mock.Mocker(real_http=True) as m:
+            m.get(
+                re.compile("/api/v1/orders/1"),
+                json=[{
+                    'itemUid': f'item-{i}',
+                    'orderDate': '2020-11-22T00:00:00',
+                    'orderUid': f'{i}-{i}-{i}',
+                    'status': 'PAID'
+                } for i in range(3)]
+            )
+            m.post(
+                re.compile("/api/v1/warehouse/batch"),
+                json=lambda request, context: [
+                    {'orderItemUid': uid, 'model': 'item', 'size': 'L'} for uid in request.json()["itemUids"]
+                ]
+            )
+            m.post(re.compile("/api/v1/warranty/batch"), status_code=555, text="unavailable")
+            response = test_client.get("/api/v1/store/1/orders", headers={"Accept": "application/x-ndjson"})
+            assert response.status == "200 OK"
+            assert response.mimetype == "application/x-ndjson"
+            lines = [json.loads(line) for line in response.data.decode().splitlines()]
+            assert sorted(line["orderUid"] for line in lines[:-1]) == ["0-0-0", "1-1-1", "2-2-2"]
+            assert all("circuit_breaker" in line for line in lines[:-1])
+            assert lines[-1] == {"summary": {"count": 3, "incomplete": 3, "notFound": 0}}
+
+
+def test_stream_orders_waits_without_spinning():
+    def slow_warranties(item_uids):
+        time.sleep(0.3)
+        return {item_uid: {"warrantyDate": "2020-11-22T00:00:00", "status": "ON"} for item_uid in item_uids}
+
+    orders = [{"itemUid": "item-1", "orderDate": "2020-11-22T00:00:00", "orderUid": "1-1-1"}]
+    with patch("store_service.request_items_info", lambda item_uids: {"item-1": {"model": "m", "size": "L"}}), \
+            patch("store_service.request_warranties_info", slow_warranties), \
+            patch("store_service.wait", wraps=store_service.wait) as wait:
+        lines = list(store_service.stream_orders(orders))
+    assert json.loads(lines[-1]) == {"summary": {"count": 1, "incomplete": 0, "notFound": 0}}
+    # warehouse ответил сразу, а warranty через 0.3 с: ждем, а не крутимся в цикле
+    assert wait.call_count <= 3
 
 
 def test_request_order(fresh_database, add_some_user):
@@ -87,6 +281,60 @@ def test_request_order(fresh_database, add_some_user):
             assert "warrantyStatus" in response.json
 
 
+def test_request_order_cached(fresh_database, add_some_user):
+    with app.test_client() as test_client:
+        with requests_mock.Mocker(real_http=True) as m:
+            m.get(
+                re.compile("/api/v1/orders/1/1-1-1"),
+                json={
+                    'itemUid': 'item-1',
+                    'orderDate': '2020-11-22T00:00:00',
+                    'orderUid': '1-1-1',
+                    'status': 'PAID'
+                }
+            )
+            m.get(re.compile("/api/v1/warehouse"), json={'model': 'item one', 'size': 'L'})
+            m.get(
+                re.compile("/api/v1/warranty"),
+                json={"itemUid": "item-1", "warrantyDate": "2020-11-22T00:00:00", "status": "ON"}
+            )
+            m.delete(re.compile("/api/v1/orders/1-1-1"))
+
+            first = test_client.get("/api/v1/store/1/1-1-1")
+            second = test_client.get("/api/v1/store/1/1-1-1")
+            assert first.json == second.json
+            # второй раз warehouse и warranty не запрашиваются
+            assert m.call_count == 4
+            assert store_service.items_cache.stats()["hits"] == 1
+
+            # после возврата заказа кэш по нему сбрасывается
+            test_client.delete("/api/v1/store/1/1-1-1/refund")
+            test_client.get("/api/v1/store/1/1-1-1")
+            assert m.call_count == 8
+
+
+def test_refund_invalidates_cache_without_order_mapping(fresh_database, add_some_user):
+    with app.test_client() as test_client:
+        with requests_mock.Mocker(real_http=True) as m:
+            m.get(
+                re.compile("/api/v1/orders/1/1-1-1"),
+                json={'itemUid': 'item-1', 'orderDate': '2020-11-22T00:00:00', 'orderUid': '1-1-1', 'status': 'PAID'}
+            )
+            m.get(re.compile("/api/v1/warehouse"), json={'model': 'item one', 'size': 'L'})
+            m.get(
+                re.compile("/api/v1/warranty"),
+                json={"itemUid": "item-1", "warrantyDate": "2020-11-22T00:00:00", "status": "ON"}
+            )
+            m.delete(re.compile("/api/v1/orders/1-1-1"), status_code=204, headers={"X-Item-Uid": "item-1"})
+
+            test_client.get("/api/v1/store/1/1-1-1")
+            # связка заказ -> вещь вытеснилась, а вещь и гарантия еще в кэше
+            store_service.order_items_cache.clear()
+            test_client.delete("/api/v1/store/1/1-1-1/refund")
+            assert store_service.items_cache.get("item-1") is None
+            assert store_service.warranties_cache.get("item-1") is None
+
+
 @patch('store_service.mq.Queue', TestQueue)
 def test_request_warranty(fresh_database, add_some_user):
     with app.test_client() as test_client:
@@ -114,6 +362,21 @@ def test_request_purchase(fresh_database, add_some_user):
             assert response.status == "201 CREATED"
 
 
+def test_request_purchase_batch(fresh_database, add_some_user):
+    with app.test_client() as test_client:
+        with requests_mock.Mocker(real_http=True) as m:
+            m.get(re.compile("/manage/health"), text='')
+            order_service = m.post(re.compile("/api/v1/orders/1/batch"), json={"orderUids": ["1-1-1", "2-2-2"]})
+            basket = {"items": [{"size": "L", "model": "item 1"}, {"size": "M", "model": "item 2"}]}
+            response = test_client.post("/api/v1/store/1/purchase/batch", json=basket)
+            assert response.status_code == 201
+            assert response.json["orderUids"] == ["1-1-1", "2-2-2"]
+            assert order_service.call_count == 1
+
+            response = test_client.post("/api/v1/store/1/purchase/batch", json={"items": []})
+            assert response.status_code == 400
+
+
 def test_request_refund(fresh_database, add_some_user):
     with app.test_client() as test_client:
         with requests_mock.Mocker(real_http=True) as m:
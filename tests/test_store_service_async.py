@@ -0,0 +1,127 @@
+import asyncio
+import json
+import re
+from unittest.mock import patch
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import circuit_breaker as cb
+import store_service
+import store_service_async
+from database import Session
+from store_service import User
+
+
+@pytest.fixture()
+def add_some_user(fresh_database):
+    for cache in (store_service.items_cache, store_service.warranties_cache, store_service.order_items_cache):
+        cache.clear()
+    with Session() as s:
+        s.add(User(id=1, name='Alex', user_uid='1'))
+    store_service.user_directory.load()
+
+
+def fake_downstream(responses):
+    """
+    Подмена async_external_request: {(метод, regex url): (статус, json)}
+    """
+    async def external_request(method, url, **kwargs):
+        for (route_method, pattern), (status, body) in responses.items():
+            if route_method == method and re.search(pattern, url):
+                if status == cb.CIRCUIT_BREAK_STATUS_CODE:
+                    raise cb.CircuitBreakerException("unavailable")
+                return cb.AsyncResponse(status, {}, json.dumps(body).encode())
+        raise AssertionError(f"unexpected request {method} {url}")
+    return external_request
+
+
+def call(method, path, **kwargs):
+    async def run():
+        async with TestClient(TestServer(store_service_async.make_app())) as client:
+            response = await client.request(method, path, **kwargs)
+            return response.status, await response.text()
+    return asyncio.run(run())
+
+
+def test_request_all_orders(add_some_user):
+    downstream = fake_downstream({
+        ("GET", "/api/v1/orders/1"): (200, [{
+            'itemUid': 'item-1',
+            'orderDate': '2020-11-22T00:00:00',
+            'orderUid': '1-1-1',
+            'status': 'PAID'
+        }]),
+        ("POST", "/api/v1/warehouse/batch"): (200, [{'orderItemUid': 'item-1', 'model': 'item one', 'size': 'L'}]),
+        ("POST", "/api/v1/warranty/batch"): (555, None),
+    })
+    with patch.object(store_service_async.circuit_breaker, "async_external_request", downstream):
+        status, body = call("GET", "/api/v1/store/1/orders")
+        assert status == 200
+        orders = json.loads(body)
+        assert orders[0]["model"] == "item one"
+        assert "circuit_breaker" in orders[0]
+
+        status, body = call("GET", "/api/v1/store/1/orders", headers={"Accept": "application/x-ndjson"})
+        assert status == 200
+        lines = [json.loads(line) for line in body.splitlines()]
+        assert lines[0]["orderUid"] == "1-1-1"
+        assert lines[-1] == {"summary": {"count": 1, "incomplete": 1, "notFound": 0}}
+
+        # sqlite в памяти недоступна из пула потоков, поэтому неизвестный пользователь уже в кэше
+        store_service.user_directory.unknown_users.set('2', True)
+        status, body = call("GET", "/api/v1/store/2/orders")
+        assert status == 404
+
+
+def test_request_order_and_purchase(add_some_user):
+    downstream = fake_downstream({
+        ("GET", "/api/v1/orders/1/1-1-1"): (200, {
+            'itemUid': 'item-1',
+            'orderDate': '2020-11-22T00:00:00',
+            'orderUid': '1-1-1',
+            'status': 'PAID'
+        }),
+        ("GET", "/api/v1/warehouse/item-1"): (200, {'model': 'item one', 'size': 'L'}),
+        ("GET", "/api/v1/warranty/item-1"): (200, {"warrantyDate": "2020-11-22T00:00:00", "status": "ON"}),
+        ("POST", "/api/v1/orders/1/batch"): (200, {"orderUids": ["1-1-1", "2-2-2"]}),
+        ("POST", "/api/v1/orders/1"): (200, {"orderUid": "1-1-1"}),
+    })
+    with patch.object(store_service_async.circuit_breaker, "async_external_request", downstream):
+        status, body = call("GET", "/api/v1/store/1/1-1-1")
+        assert status == 200
+        assert json.loads(body)["warrantyStatus"] == "ON"
+
+        status, _ = call("POST", "/api/v1/store/1/purchase", json={"size": "L", "model": "item 1"})
+        assert status == 201
+        status, _ = call("POST", "/api/v1/store/1/purchase", data="not json")
+        assert status == 400
+
+        basket = {"items": [{"size": "L", "model": "item 1"}, {"size": "M", "model": "item 2"}]}
+        status, body = call("POST", "/api/v1/store/1/purchase/batch", json=basket)
+        assert status == 201
+        assert json.loads(body)["orderUids"] == ["1-1-1", "2-2-2"]
+
+
+@patch("circuit_breaker.RETRY_BASE_DELAY", 0)
+def test_async_external_request_breaks_circuit():
+    async def run():
+        async def ok(request):
+            return web.json_response({"ok": True})
+
+        app = web.Application()
+        app.router.add_get("/ok", ok)
+        async with TestServer(app) as server:
+            breaker = cb.CircuitBreaker()
+            resp = await breaker.async_external_request("GET", str(server.make_url("/ok")))
+            assert resp.ok and resp.json() == {"ok": True}
+
+            # сервис недоступен: после NUMBER_OF_ATTEMPTS попыток circuit breaker активируется
+            url = "http://127.0.0.1:1/unavailable"
+            with pytest.raises(cb.CircuitBreakerException, match="activated"):
+                await breaker.async_external_request("GET", url)
+            with pytest.raises(cb.CircuitBreakerException, match="still active"):
+                await breaker.async_external_request("GET", url)
+            await breaker.close()
+    asyncio.run(run())
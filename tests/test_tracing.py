@@ -0,0 +1,65 @@
+import re
+
+import pytest
+import requests_mock
+
+import tracing
+from order_service import app
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+@pytest.fixture()
+def ring_buffer():
+    exporter = tracing.RingBufferExporter(100)
+    original, tracing.exporter = tracing.exporter, exporter
+    yield exporter
+    tracing.exporter = original
+
+
+def test_parse_traceparent():
+    assert tracing.parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-01") == (TRACE_ID, PARENT_ID, True)
+    assert tracing.parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-00") == (TRACE_ID, PARENT_ID, False)
+    assert tracing.parse_traceparent("garbage") is None
+    assert tracing.parse_traceparent(f"00-{'0' * 32}-{PARENT_ID}-01") is None
+
+
+def new_order(test_client, flags):
+    with requests_mock.Mocker() as m:
+        m.post(
+            re.compile("/api/v1/warehouse"),
+            json={"orderItemUid": "item-1", "orderUid": "1-1-1", "model": "Lego 8880", "size": "L"}
+        )
+        m.post(re.compile("/api/v1/warranty/item-1"))
+        response = test_client.post(
+            "/api/v1/orders/1",
+            json={"model": "Lego 8880", "size": "L"},
+            headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-{flags}"}
+        )
+        assert response.status_code == 200
+        return [tracing.parse_traceparent(call.headers["traceparent"]) for call in m.request_history]
+
+
+def test_sampled_trace_is_recorded_and_propagated(fresh_database, ring_buffer):
+    with app.test_client() as test_client:
+        outgoing = new_order(test_client, "01")
+        spans = test_client.get(f"/manage/traces?traceId={TRACE_ID}").json
+
+    by_name = {span["name"]: span for span in spans}
+    root = by_name["POST /api/v1/orders/<string:user_uid>"]
+    assert root["parentId"] == PARENT_ID
+    assert root["attributes"]["status"] == 200
+    assert by_name["db session"]["parentId"] == root["spanId"]
+
+    client_spans = [span for span in spans if span["name"].startswith("POST ") and span is not root]
+    assert len(client_spans) == 2
+    # следующий сервис получает span запроса к нему как родительский
+    assert sorted(outgoing) == sorted((TRACE_ID, span["spanId"], True) for span in client_spans)
+
+
+def test_unsampled_trace_is_not_recorded(fresh_database, ring_buffer):
+    with app.test_client() as test_client:
+        outgoing = new_order(test_client, "00")
+    assert ring_buffer.spans() == []
+    assert all(trace_id == TRACE_ID and not sampled for trace_id, _, sampled in outgoing)
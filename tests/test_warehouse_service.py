@@ -1,11 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 import json
 import re
+from unittest.mock import patch
 
 import requests_mock
+import sqlalchemy as sa
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 
-from database import Session
-from warehouse_service import app, refresh_items_in_db, Item, OrderItem
+from database import Session, create_schema
+from warehouse_service import app, refresh_items_in_db, reserve_stock, Item, ItemStockShard, OrderItem
 
 
 TEST_ORDER = {
@@ -40,6 +45,23 @@ def test_request_get_info(fresh_database):
         assert response["model"] == TEST_ORDER["model"]
 
 
+def test_request_get_info_batch(fresh_database):
+    refresh_items_in_db()
+    with Session() as s:
+        s.add(OrderItem(item_id=1, order_item_uid="item-1", order_uid='1-1-1'))
+        s.add(OrderItem(item_id=3, order_item_uid="item-2", order_uid='2-2-2'))
+    with app.test_client() as test_client:
+        response = test_client.post("/api/v1/warehouse/batch",
+                                    json={"itemUids": ["item-1", "item-2", "item-3"]})
+        assert response.status_code == 200
+        items = {item["orderItemUid"]: item for item in json.loads(response.data)}
+        assert set(items) == {"item-1", "item-2"}
+        assert items["item-2"]["model"] == "Lego 8880"
+
+        bad_response = test_client.post("/api/v1/warehouse/batch", json={"uids": []})
+        assert bad_response.status_code == 400
+
+
 def test_request_warranty(fresh_database):
     refresh_items_in_db()
     with Session() as s:
@@ -65,3 +87,113 @@ def test_request_remove_item(fresh_database):
         with Session() as s:
             assert s.query(Item).get(1).available_count == 10001
 
+
+
+def test_concurrent_reservations_do_not_oversell(tmp_path):
+    # файл, а не :memory:, чтобы все потоки работали с одной базой
+    engine = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}", connect_args={"timeout": 30})
+    create_schema(engine_=engine)
+    with patch("database.engine", engine), patch("database.session_factory", sessionmaker(bind=engine)):
+        with Session() as s:
+            s.add(Item(id=1, available_count=50, model="Lego 8070", size="M"))
+
+        def reserve(_):
+            with Session() as s:
+                return reserve_stock(s, "Lego 8070", "M")
+
+        with ThreadPoolExecutor(8) as pool:
+            reserved = list(pool.map(reserve, range(80)))
+        assert reserved.count(1) == 50
+        assert reserved.count(None) == 30
+        with Session() as s:
+            assert s.query(Item).get(1).available_count == 0
+
+
+def test_sharded_stock(fresh_database):
+    with patch("warehouse_service.STOCK_SHARDS", 4):
+        refresh_items_in_db()
+        with Session() as s:
+            shards = s.query(ItemStockShard).filter(ItemStockShard.item_id == 3).all()
+            assert sorted(shard.available_count for shard in shards) == [2500] * 4
+            assert s.query(Item).get(3).available_count == 0
+
+        with app.test_client() as test_client:
+            order_item_uid = test_client.post("/api/v1/warehouse", json=TEST_ORDER).json["orderItemUid"]
+            with Session() as s:
+                shards = s.query(ItemStockShard).filter(ItemStockShard.item_id == 3).all()
+                assert sum(shard.available_count for shard in shards) == 9999
+
+            with requests_mock.Mocker(real_http=True) as m:
+                m.get(re.compile("/manage/health"), text='')
+                warranty = m.post(re.compile("/warranty/.*/warranty"), json={"decision": "RETURN"})
+                test_client.post(f"/api/v1/warehouse/{order_item_uid}/warranty", json={"reason": "Broken"})
+                assert warranty.last_request.json()["availableCount"] == 9999
+
+            assert test_client.delete(f"/api/v1/warehouse/{order_item_uid}").status_code == 204
+            with Session() as s:
+                shards = s.query(ItemStockShard).filter(ItemStockShard.item_id == 3).all()
+                assert sum(shard.available_count for shard in shards) == 10000
+
+
+def test_request_new_item_out_of_stock(fresh_database):
+    with Session() as s:
+        s.add(Item(id=1, available_count=1, model="Lego 8070", size="M"))
+    with app.test_client() as test_client:
+        order = {"orderUid": "1-1-1", "model": "Lego 8070", "size": "M"}
+        assert test_client.post("/api/v1/warehouse", json=order).status_code == 200
+        assert test_client.post("/api/v1/warehouse", json=order).status_code == 409
+        assert test_client.post("/api/v1/warehouse", json={**order, "size": "XL"}).status_code == 404
+
+
+def test_sharded_batch_reserve_takes_shards_in_order(fresh_database):
+    with patch("warehouse_service.STOCK_SHARDS", 3):
+        with Session() as s:
+            s.add(Item(id=1, available_count=1, model="Lego 8070", size="M"))
+            s.add_all([ItemStockShard(item_id=1, shard=number, available_count=2) for number in range(3)])
+        with app.test_client() as test_client:
+            basket = [{"orderUid": str(i), "model": "Lego 8070", "size": "M"} for i in range(3)]
+            response = test_client.post("/api/v1/warehouse/batch/reserve", json={"items": basket})
+            assert response.status_code == 200
+            # шарды обходятся с нулевого и без возврата к уже пройденным
+            with Session() as s:
+                shards = s.query(ItemStockShard).order_by(ItemStockShard.shard).all()
+                assert [shard.available_count for shard in shards] == [0, 1, 2]
+                assert s.query(OrderItem).filter(OrderItem.item_id == 1).count() == 3
+
+            basket = [{"orderUid": str(i), "model": "Lego 8070", "size": "M"} for i in range(5)]
+            assert test_client.post("/api/v1/warehouse/batch/reserve", json={"items": basket}).status_code == 409
+            response = test_client.post("/api/v1/warehouse/batch/reserve", json={"items": basket[:4]})
+            assert response.status_code == 200
+            with Session() as s:
+                assert s.query(sa.func.sum(ItemStockShard.available_count)).scalar() == 0
+                assert s.query(Item).get(1).available_count == 0
+
+
+def test_batch_reserve_is_all_or_nothing(fresh_database):
+    with Session() as s:
+        s.add(Item(id=1, available_count=5, model="Lego 8070", size="M"))
+        s.add(Item(id=2, available_count=1, model="Lego 8880", size="L"))
+    with app.test_client() as test_client:
+        basket = [
+            {"orderUid": "1", "model": "Lego 8880", "size": "L"},
+            {"orderUid": "2", "model": "Lego 8070", "size": "M"},
+            {"orderUid": "3", "model": "Lego 8880", "size": "L"},
+        ]
+        response = test_client.post("/api/v1/warehouse/batch/reserve", json={"items": basket})
+        assert response.status_code == 409
+        with Session() as s:
+            assert [s.query(Item).get(i).available_count for i in (1, 2)] == [5, 1]
+            assert s.query(OrderItem).count() == 0
+
+        response = test_client.post("/api/v1/warehouse/batch/reserve", json={"items": basket[:2]})
+        assert response.status_code == 200
+        assert [item["orderUid"] for item in response.json] == ["1", "2"]
+        with Session() as s:
+            assert [s.query(Item).get(i).available_count for i in (1, 2)] == [4, 0]
+
+        item_uids = [item["orderItemUid"] for item in response.json]
+        for _ in range(2):
+            response = test_client.post("/api/v1/warehouse/batch/release", json={"itemUids": item_uids})
+            assert response.status_code == 204
+        with Session() as s:
+            assert [s.query(Item).get(i).available_count for i in (1, 2)] == [5, 1]
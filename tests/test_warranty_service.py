@@ -1,7 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 import json
+from unittest.mock import patch
 
-from database import Session
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import metrics
+from database import Session, create_schema
 from warranty_service import app, Warranty, Status
 
 
@@ -34,6 +40,18 @@ def test_request_warranty_status(fresh_database):
         assert "message" in json.loads(bad_response.data)
 
 
+def test_request_warranty_status_batch(fresh_database):
+    with Session() as s:
+        s.add(Warranty(**TEST_WARRANTY))
+    with app.test_client() as test_client:
+        response = test_client.post("/api/v1/warranty/batch", json={"itemUids": ["1-1-1", "2-2-2"]})
+        assert response.status_code == 200
+        warranties = json.loads(response.data)
+        assert len(warranties) == 1
+        assert warranties[0]["itemUid"] == "1-1-1"
+        assert warranties[0]["status"] == TEST_WARRANTY["status"]
+
+
 def test_request_stop_warranty(fresh_database):
     with Session() as s:
         s.add(Warranty(**TEST_WARRANTY))
@@ -58,3 +76,36 @@ def test_request_warranty_result(fresh_database):
                                     json={"reason": "", "availableCount": 0})
         assert response.status_code == 200
         assert json.loads(response.data)["decision"] == "FIXING"
+
+
+def test_request_start_and_stop_warranty_batch(fresh_database):
+    with app.test_client() as test_client:
+        response = test_client.post("/api/v1/warranty/batch/start", json={"itemUids": ["item-1", "item-2"]})
+        assert response.status_code == 204
+        with Session() as s:
+            assert {w.item_uid: w.status for w in s.query(Warranty)} == {"item-1": Status.on, "item-2": Status.on}
+
+        response = test_client.post("/api/v1/warranty/batch/stop", json={"itemUids": ["item-1", "item-2"]})
+        assert response.status_code == 204
+        with Session() as s:
+            assert {w.status for w in s.query(Warranty)} == {Status.removed}
+
+
+def test_request_start_warranty_group_commit(tmp_path):
+    # файл, а не :memory:, чтобы поток group commit'а видел ту же базу
+    engine = create_engine(f"sqlite:///{tmp_path / 'warranty.db'}", connect_args={"timeout": 30})
+    create_schema(engine_=engine)
+    batches_before = metrics.group_commit_batch_size.count("warranty")
+    with patch("database.engine", engine), patch("database.session_factory", sessionmaker(bind=engine)), \
+            patch("warranty_service.GROUP_COMMIT", True):
+        def start(item_uid):
+            with app.test_client() as test_client:
+                return test_client.post(f"/api/v1/warranty/{item_uid}").status_code
+
+        with ThreadPoolExecutor(8) as pool:
+            statuses = list(pool.map(start, [f"item-{i}" for i in range(20)] + ["item-0"]))
+        # повторная гарантия на ту же вещь нарушает unique и получает ошибку только сама
+        assert sorted(statuses) == [204] * 20 + [500]
+        with Session() as s:
+            assert s.query(Warranty).count() == 20
+    assert metrics.group_commit_batch_size.count("warranty") > batches_before
@@ -0,0 +1,77 @@
+import re
+from unittest.mock import patch
+
+import pika
+import pytest
+import requests_mock
+
+from rabbitmq import TestQueue
+from warranty_worker import WarrantyQueueWorker
+
+
+@pytest.fixture()
+def queue():
+    TestQueue.reset()
+    with TestQueue() as q:
+        yield q
+    TestQueue.reset()
+
+
+def test_drain_batch(queue):
+    for i in range(5):
+        queue.publish({"time": "2020-11-11", "orderUid": f"{i}-{i}-{i}", "reason": "Broken"})
+    queue.publish({"time": "2020-11-11", "reason": "old format"})
+
+    worker = WarrantyQueueWorker(prefetch=4, concurrency=2)
+    with requests_mock.Mocker() as m:
+        m.post(re.compile("/api/v1/orders/.*/warranty"), json={"decision": "FIXING"})
+        assert worker.drain_batch(queue) == 4
+        assert worker.drain_batch(queue) == 2
+        assert worker.drain_batch(queue) == 0
+        assert m.call_count == 5
+
+    assert queue.depth() == 0
+    assert not TestQueue.unacked
+    assert worker.stats()["drained"] == 6
+    assert worker.stats()["dropped"] == 1
+
+
+@patch("circuit_breaker.RETRY_BASE_DELAY", 0)
+def test_drain_batch_requeues_failed(queue):
+    queue.publish({"time": "2020-11-11", "orderUid": "1-1-1", "reason": "Broken"})
+
+    worker = WarrantyQueueWorker(max_attempts=2, retry_backoff=0)
+    with requests_mock.Mocker() as m:
+        m.post(re.compile("/api/v1/orders/.*/warranty"), status_code=555, text="unavailable")
+        assert worker.drain_batch(queue) == 1
+        assert m.call_count == 2
+
+    assert queue.depth() == 1
+    assert worker.stats()["requeued"] == 1
+    assert worker.stats()["drained"] == 0
+
+
+@patch("circuit_breaker.RETRY_BASE_DELAY", 0)
+def test_drain_batch_last_message_failed(queue):
+    for order_uid in ("1-1-1", "2-2-2", "3-3-3"):
+        queue.publish({"time": "2020-11-11", "orderUid": order_uid, "reason": "Broken"})
+
+    worker = WarrantyQueueWorker(concurrency=1, max_attempts=1, retry_backoff=0)
+    with requests_mock.Mocker() as m:
+        m.post(re.compile("/api/v1/orders/(1-1-1|2-2-2)/warranty"), json={"decision": "FIXING"})
+        m.post(re.compile("/api/v1/orders/3-3-3/warranty"), status_code=555, text="unavailable")
+        assert worker.drain_batch(queue) == 3
+
+    # последнее сообщение вернулось в очередь, а первые два подтверждены
+    assert not TestQueue.unacked
+    assert queue.depth() == 1
+    assert worker.stats()["drained"] == 2
+    assert worker.stats()["requeued"] == 1
+
+
+def test_memory_queue_rejects_unknown_delivery_tag(queue):
+    queue.publish({"orderUid": "1-1-1"})
+    [(delivery_tag, _)] = queue.get_batch(1)
+    queue.nack(delivery_tag)
+    with pytest.raises(pika.exceptions.ChannelClosedByBroker):
+        queue.ack(delivery_tag, multiple=True)
@@ -0,0 +1,198 @@
+# Легковесная распределенная трассировка (W3C traceparent)
+# Каждый входящий запрос - корневой span (или продолжение трассы из заголовка traceparent),
+# внутри него span'ы для запросов в другие сервисы (CircuitBreaker.external_request),
+# блоков database.Session и операций с очередью. В запросы к другим сервисам передается traceparent,
+# так что одна покупка видна целиком по traceId во всех четырех сервисах.
+#
+# Записывается только TRACE_SAMPLE_RATE доля трасс (решение принимает первый сервис и передает
+# его дальше во флаге traceparent); для остальных span'ы не создаются вовсе.
+# Завершенные span'ы отдаются exporter'у: по умолчанию кольцевой буфер на TRACE_BUFFER_SIZE span'ов
+# (GET /manage/traces?traceId=...), а если задан TRACE_FILE - дописываются в файл json-строками.
+#
+# Использование: tracing.install(app) для flask-приложения, with tracing.span("name", attr=...) внутри
+
+import os
+import json
+import random
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+from time import time, perf_counter
+
+from flask import g, request, jsonify
+
+TRACEPARENT_HEADER = "traceparent"
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.01))
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", 1000))
+TRACE_FILE = os.environ.get("TRACE_FILE", "")
+print(f"Trace sample rate: {TRACE_SAMPLE_RATE} ($TRACE_SAMPLE_RATE), "
+      f"exporter: {TRACE_FILE or f'memory, {TRACE_BUFFER_SIZE} spans'} ($TRACE_FILE)")
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, sampled=True, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes or {}
+        self.error = None
+        self.start = time()
+        self.started = perf_counter()
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, error):
+        self.error = repr(error)
+
+    def end(self):
+        self.duration = perf_counter() - self.started
+        if self.sampled:
+            exporter.export(self)
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_json(self) -> dict:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentId": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "durationMs": None if self.duration is None else round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class RingBufferExporter:
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        self.buffer = deque(maxlen=size)
+
+    def export(self, span: Span):
+        self.buffer.append(span)
+
+    def spans(self, trace_id=None) -> list:
+        return [span.to_json() for span in list(self.buffer) if trace_id is None or span.trace_id == trace_id]
+
+
+class FileExporter:
+    def __init__(self, path):
+        self.file = open(path, "a", buffering=1)
+        self.lock = Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_json())
+        with self.lock:
+            self.file.write(line + "\n")
+
+
+exporter = FileExporter(TRACE_FILE) if TRACE_FILE else RingBufferExporter()
+
+
+def parse_traceparent(value):
+    """
+    (trace_id, parent_id, sampled) из заголовка traceparent или None, если он некорректный
+    """
+    parts = (value or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    if set(parts[1]) == {"0"} or set(parts[2]) == {"0"}:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def start_trace(name, traceparent=None, **attributes) -> Span:
+    """
+    Корневой span запроса: продолжение трассы из traceparent или новая трасса (с сэмплированием).
+    Становится текущим; завершить - finish_trace
+    """
+    parent = parse_traceparent(traceparent)
+    if parent is None:
+        trace_id, parent_id, sampled = "%032x" % random.getrandbits(128), None, random.random() < TRACE_SAMPLE_RATE
+    else:
+        trace_id, parent_id, sampled = parent
+    root = Span(name, trace_id, parent_id, sampled, attributes)
+    current_span.set(root)
+    return root
+
+
+def finish_trace(root: Span):
+    current_span.set(None)
+    root.end()
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Дочерний span текущего. Если трасса не записывается (или ее нет), ничего не создается и yield None
+    """
+    parent = current_span.get()
+    if parent is None or not parent.sampled:
+        yield None
+        return
+    child = Span(name, parent.trace_id, parent.span_id, True, attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.fail(e)
+        raise
+    finally:
+        current_span.reset(token)
+        child.end()
+
+
+def headers() -> dict:
+    """
+    Заголовок traceparent для запроса в другой сервис
+    """
+    current = current_span.get()
+    return {} if current is None else {TRACEPARENT_HEADER: current.traceparent}
+
+
+def traces_response(trace_id=None):
+    if not hasattr(exporter, "spans"):
+        return {"message": f"Spans are written to {TRACE_FILE}"}, 404
+    return jsonify(exporter.spans(trace_id)), 200
+
+
+def install(app):
+    @app.before_request
+    def start_request_trace():
+        g.trace = start_trace(
+            f"{request.method} {request.url_rule.rule if request.url_rule is not None else 'unmatched'}",
+            request.headers.get(TRACEPARENT_HEADER),
+            service=app.import_name,
+        )
+
+    @app.after_request
+    def set_trace_status(response):
+        trace = g.get("trace")
+        if trace is not None:
+            trace.set(status=response.status_code)
+        return response
+
+    @app.teardown_request
+    def finish_request_trace(exc):
+        trace = g.pop("trace", None)
+        if trace is not None:
+            if exc is not None:
+                trace.fail(exc)
+            finish_trace(trace)
+
+    app.add_url_rule("/manage/traces", "traces", lambda: traces_response(request.args.get("traceId")),
+                     methods=["GET"])
@@ -1,22 +1,37 @@
 import os
+import random
+from collections import Counter
 from uuid import uuid4
+from typing import List
 
 from pydantic import BaseModel, ValidationError
-from flask import Flask, request
+from flask import Flask, request, jsonify
 from werkzeug.exceptions import BadRequest
 import sqlalchemy as sa
 
 import database
+import deadline
+import metrics
+import tracing
 import circuit_breaker as cb
 
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
+metrics.install(app)
+tracing.install(app)
+database.install(app)
+deadline.install(app)
 ROOT_PATH = "/api/v1"
 WARRANTY_SERVICE_URL = os.environ.get("WARRANTY_SERVICE_URL", "localhost:8180")
 print(f"Warranty service url: {WARRANTY_SERVICE_URL} ($WARRANTY_SERVICE_URL)")
+# 0 - остаток вещи хранится в item.available_count, иначе делится на столько строк item_stock_shard,
+# чтобы одновременные покупки одной популярной вещи не упирались в блокировку одной строки
+STOCK_SHARDS = int(os.environ.get("STOCK_SHARDS", 0))
+print(f"Stock shards: {STOCK_SHARDS} ($STOCK_SHARDS)")
 
 circuit_breaker = cb.CircuitBreaker()
+circuit_breaker.export_metrics()
 
 # ------------------------------ dto ------------------------------
 
@@ -38,6 +53,26 @@ class OrderItem(database.Base):
     item_id = sa.Column(sa.Integer, sa.ForeignKey(Item.id, ondelete="CASCADE"))
 
 
+class ItemStockShard(database.Base):
+    """
+    Часть остатка вещи (при STOCK_SHARDS > 0): весь остаток - item.available_count плюс сумма по шардам
+    """
+    __tablename__ = 'item_stock_shard'
+    item_id = sa.Column(sa.Integer, sa.ForeignKey(Item.id, ondelete="CASCADE"), primary_key=True)
+    shard = sa.Column(sa.Integer, primary_key=True)
+    available_count = sa.Column(sa.Integer)
+
+
+# индексы под запросы сервиса (применяются при старте через database.migrate)
+MIGRATIONS = [
+    # выбор вещи для заказа по модели и размеру
+    database.Migration(1, "items by model and size",
+                       "CREATE INDEX IF NOT EXISTS ix_item_model_size ON item (model, size)"),
+    database.Migration(2, "order items by order",
+                       "CREATE INDEX IF NOT EXISTS ix_order_item_order_uid ON order_item (order_uid)"),
+]
+
+
 class NewItemRequest(BaseModel):
     orderUid: str
     model: str
@@ -47,20 +82,159 @@ class NewItemRequest(BaseModel):
 class WarrantyRequest(BaseModel):
     reason: str
 
+
+class BatchInfoRequest(BaseModel):
+    itemUids: List[str]
+
+
+class BatchReserveRequest(BaseModel):
+    items: List[NewItemRequest]
+
 # ------------------------------ вспомогательные функции ------------------------------
 
 
 def refresh_items_in_db():
     with database.Session() as s:
+        s.execute(ItemStockShard.__table__.delete())
         s.execute(Item.__table__.delete())
         s.add_all([
             Item(id=1, available_count=10000, model="Lego 8070", size="M"),
             Item(id=2, available_count=10000, model="Lego 42070", size="L"),
             Item(id=3, available_count=10000, model="Lego 8880", size="L"),
         ])
+        if STOCK_SHARDS:
+            s.flush()
+            spread_stock(s)
         print("Initialized default values in Item table")
 
 
+def spread_stock(s):
+    """
+    Переносит остаток каждой вещи из item.available_count поровну в STOCK_SHARDS шардов
+    """
+    shards = {(shard.item_id, shard.shard): shard for shard in s.query(ItemStockShard)}
+    for item in s.query(Item).filter(Item.available_count > 0):
+        per_shard, rest = divmod(item.available_count, STOCK_SHARDS)
+        for number in range(STOCK_SHARDS):
+            shard = shards.get((item.id, number))
+            if shard is None:
+                shard = ItemStockShard(item_id=item.id, shard=number, available_count=0)
+                s.add(shard)
+            shard.available_count += per_shard + (number < rest)
+        item.available_count = 0
+
+
+def take_one(s, table, id_column, *conditions):
+    """
+    Уменьшает available_count на 1 у строки table, если он > 0, и возвращает id_column этой строки
+    (None, если такой строки нет или у нее ничего не осталось).
+    Проверка и уменьшение - один UPDATE, поэтому одновременные резервирования не теряют обновлений
+    и не продают больше, чем есть, а строка заблокирована только до конца транзакции
+    """
+    update = (
+        table.update()
+        .where(sa.and_(*conditions, table.c.available_count > 0))
+        .values(available_count=table.c.available_count - 1)
+    )
+    if s.get_bind().dialect.name == "postgresql":
+        return s.execute(update.returning(id_column)).scalar()
+    # sqlalchemy 1.3 не умеет RETURNING для sqlite: проверяем rowcount и дочитываем id
+    if s.execute(update).rowcount != 1:
+        return None
+    return s.execute(sa.select([id_column]).where(sa.and_(*conditions))).scalar()
+
+
+def reserve_stock(s, model, size):
+    """
+    Забирает со склада одну вещь model/size. Возвращает id вещи или None, если ее нет или она закончилась
+    """
+    item_id = sa.select([Item.id]).where(Item.model == model).where(Item.size == size).limit(1).as_scalar()
+    if STOCK_SHARDS:
+        # начинаем со случайного шарда, чтобы параллельные покупки расходились по разным строкам
+        shards = ItemStockShard.__table__
+        first = random.randrange(STOCK_SHARDS)
+        for number in [*range(first, STOCK_SHARDS), *range(first)]:
+            reserved = take_one(s, shards, shards.c.item_id, shards.c.item_id == item_id, shards.c.shard == number)
+            if reserved is not None:
+                return reserved
+    # остаток, который не разнесен по шардам (или шарды выключены)
+    items = Item.__table__
+    return take_one(s, items, items.c.id, items.c.id == item_id)
+
+
+def reserve_stock_many(s, model, size, count):
+    """
+    Забирает со склада count вещей model/size (для batch/reserve). Возвращает id вещи или None, если столько нет.
+    Шарды обходятся по порядку с нулевого, и к пройденному шарду обход не возвращается: транзакции блокируют
+    строки одной вещи в одной последовательности и не ждут друг друга по кругу (ценой того, что корзины
+    чаще сходятся на первых шардах)
+    """
+    item_id = sa.select([Item.id]).where(Item.model == model).where(Item.size == size).limit(1).as_scalar()
+    stock = []
+    if STOCK_SHARDS:
+        shards = ItemStockShard.__table__
+        stock += [
+            (shards, shards.c.item_id, [shards.c.item_id == item_id, shards.c.shard == number])
+            for number in range(STOCK_SHARDS)
+        ]
+    items = Item.__table__
+    stock.append((items, items.c.id, [items.c.id == item_id]))
+
+    reserved = None
+    for table, id_column, conditions in stock:
+        while count:
+            taken = take_one(s, table, id_column, *conditions)
+            if taken is None:
+                break
+            reserved = taken
+            count -= 1
+        if not count:
+            return reserved
+    return None
+
+
+def not_reserved_response(s, model, size):
+    """
+    Ответ, если reserve_stock не смог зарезервировать вещь: ее нет вовсе или она закончилась
+    """
+    item = s.query(Item.id).filter(Item.model == model).filter(Item.size == size).first()
+    if not item:
+        return {"message": f"requested item not found: {model} ({size})"}, 404
+    return {"message": f"requested item is not available: {model} ({size})"}, 409
+
+
+def release_stock(s, item_id):
+    """
+    Возвращает на склад одну вещь
+    """
+    if STOCK_SHARDS:
+        shards = ItemStockShard.__table__
+        released = s.execute(
+            shards.update()
+            .where(shards.c.item_id == item_id)
+            .where(shards.c.shard == random.randrange(STOCK_SHARDS))
+            .values(available_count=shards.c.available_count + 1)
+        ).rowcount
+        if released:
+            return
+    items = Item.__table__
+    s.execute(items.update().where(items.c.id == item_id).values(available_count=items.c.available_count + 1))
+
+
+def available_stock(s, item) -> int:
+    """
+    Весь остаток вещи с учетом шардов
+    """
+    if not STOCK_SHARDS:
+        return item.available_count
+    sharded = (
+        s.query(sa.func.coalesce(sa.func.sum(ItemStockShard.available_count), 0))
+        .filter(ItemStockShard.item_id == item.id)
+        .scalar()
+    )
+    return item.available_count + sharded
+
+
 @app.errorhandler(Exception)
 def default_error_handler(error):
     return {
@@ -75,13 +249,18 @@ def health_check():
     return "UP", 200
 
 
+@app.route("/manage/circuit-breaker", methods=["GET"])
+def circuit_breaker_stats():
+    return circuit_breaker.stats(), 200
+
+
 @app.route(f"{ROOT_PATH}/warehouse/<string:order_item_id>", methods=["GET"])
 def request_get_info(order_item_id):
     """
     Информация о вещах на складе
     """
-    # просто достаем item'ы из базы
-    with database.Session() as s:
+    # просто достаем item'ы из базы (реплики)
+    with database.ReadSession(order_item_id) as s:
         order_and_item = (
             s.query(OrderItem, Item)
             .join(Item)
@@ -97,6 +276,38 @@ def request_get_info(order_item_id):
         }, 200
 
 
+@app.route(f"{ROOT_PATH}/warehouse/batch", methods=["POST"])
+def request_get_info_batch():
+    """
+    Информация сразу о нескольких вещах на складе (одним запросом в базу)
+    """
+    # парсим входные данные
+    try:
+        batch_request = BatchInfoRequest.parse_obj(request.get_json(force=True))
+    except BadRequest:
+        return {"message": "Bad json"}, 400
+    except ValidationError as e:
+        return {"message": e.errors()}, 400
+
+    if not batch_request.itemUids:
+        return jsonify([]), 200
+
+    # достаем все item'ы одним запросом с IN (...) (с реплики)
+    with database.ReadSession(*batch_request.itemUids) as s:
+        orders_and_items = (
+            s.query(OrderItem, Item)
+            .join(Item)
+            .filter(OrderItem.order_item_uid.in_(batch_request.itemUids))
+            .all()
+        )
+        result = [{
+            "orderItemUid": order_and_item.OrderItem.order_item_uid,
+            "model": order_and_item.Item.model,
+            "size": order_and_item.Item.size,
+        } for order_and_item in orders_and_items]
+        return jsonify(result), 200
+
+
 @app.route(f"{ROOT_PATH}/warehouse", methods=["POST"])
 def request_new_item():
     """
@@ -111,34 +322,98 @@ def request_new_item():
         return {"message": e.errors()}, 400
 
     with database.Session() as s:
-        # достаем item из базы
-        item = (
-            s.query(Item)
-            .filter(Item.model == new_item_request.model)
-            .filter(Item.size == new_item_request.size)
-            .first()
-        )
-        if not item:
-            return {"message": "requested item not found"}, 404
-        elif item.available_count == 0:
-            return {"message": "requested item is not available"}, 409
+        # уменьшаем количество item'ов на 1 одним условным UPDATE
+        item_id = reserve_stock(s, new_item_request.model, new_item_request.size)
+        if item_id is None:
+            return not_reserved_response(s, new_item_request.model, new_item_request.size)
 
-        # уменьшаем количество item'ов на 1 и сохраняем
-        item.available_count -= 1
+        # сохраняем заказ в той же транзакции
         order = OrderItem(
             canceled=False,
             order_item_uid=str(uuid4()),
             order_uid=new_item_request.orderUid,
-            item_id=item.id,
+            item_id=item_id,
         )
         s.add(order)
         s.commit()
+        database.mark_write(order.order_item_uid)
         return {
             "orderItemUid": order.order_item_uid,
             "orderUid": new_item_request.orderUid,
+            "model": new_item_request.model,
+            "size": new_item_request.size,
+        }, 200
+
+
+@app.route(f"{ROOT_PATH}/warehouse/batch/reserve", methods=["POST"])
+def request_new_items_batch():
+    """
+    Запрос на получение сразу нескольких вещей со склада одной транзакцией: все или ничего
+    """
+    # парсим входные данные
+    try:
+        batch_request = BatchReserveRequest.parse_obj(request.get_json(force=True))
+    except BadRequest:
+        return {"message": "Bad json"}, 400
+    except ValidationError as e:
+        return {"message": e.errors()}, 400
+
+    with database.Session() as s:
+        # резервируем в одном порядке (по модели и размеру, каждую вещь сразу всем количеством),
+        # чтобы параллельные корзины блокировали строки в одной последовательности и не ждали друг друга по кругу
+        wanted = Counter((item.model, item.size) for item in batch_request.items)
+        reserved = {}
+        for model, size in sorted(wanted):
+            item_id = reserve_stock_many(s, model, size, wanted[model, size])
+            if item_id is None:
+                s.rollback()
+                return not_reserved_response(s, model, size)
+            reserved[model, size] = item_id
+
+        orders = [OrderItem(
+            canceled=False,
+            order_item_uid=str(uuid4()),
+            order_uid=item.orderUid,
+            item_id=reserved[item.model, item.size],
+        ) for item in batch_request.items]
+        s.add_all(orders)
+        s.commit()
+        database.mark_write(*[order.order_item_uid for order in orders])
+        return jsonify([{
+            "orderItemUid": order.order_item_uid,
+            "orderUid": item.orderUid,
             "model": item.model,
             "size": item.size,
-        }, 200
+        } for order, item in zip(orders, batch_request.items)]), 200
+
+
+@app.route(f"{ROOT_PATH}/warehouse/batch/release", methods=["POST"])
+def request_remove_items_batch():
+    """
+    Вернуть на склад сразу несколько вещей (откат batch/reserve)
+    """
+    # парсим входные данные
+    try:
+        batch_request = BatchInfoRequest.parse_obj(request.get_json(force=True))
+    except BadRequest:
+        return {"message": "Bad json"}, 400
+    except ValidationError as e:
+        return {"message": e.errors()}, 400
+
+    # уже отмененные не возвращаем второй раз
+    with database.Session() as s:
+        orders = (
+            s.query(OrderItem)
+            .filter(OrderItem.order_item_uid.in_(batch_request.itemUids))
+            .filter(OrderItem.canceled.is_(False))
+            .all()
+        )
+        for order in orders:
+            release_stock(s, order.item_id)
+            order.canceled = True
+        s.commit()
+    database.mark_write(*batch_request.itemUids)
+    return '', 204
 
 
 @app.route(f"{ROOT_PATH}/warehouse/<string:order_item_id>/warranty", methods=["POST"])
@@ -165,7 +440,7 @@ def request_warranty(order_item_id):
         )
         if not order_and_item:
             return {"message": "Order not found"}, 404
-        available_count = order_and_item.Item.available_count
+        available_count = available_stock(s, order_and_item.Item)
 
     # перенаправляем запрос на warranty
     warranty_service_response = circuit_breaker.external_request(
@@ -184,19 +459,15 @@ def request_remove_item(order_item_id):
     """
     Вернуть заказ на склад
     """
-    # ставим order'у canceled=True, а количество item'ов увеличиваем на 1
+    # ставим order'у canceled=True, а количество item'ов увеличиваем на 1 (атомарно, в базе)
     with database.Session() as s:
-        order_and_item = (
-            s.query(OrderItem, Item)
-            .join(Item)
-            .filter(OrderItem.order_item_uid == order_item_id)
-            .one_or_none()
-        )
-        if not order_and_item:
+        order = s.query(OrderItem).filter(OrderItem.order_item_uid == order_item_id).one_or_none()
+        if not order:
             return {"message": "Not found"}, 404
-        order_and_item.Item.available_count += 1
-        order_and_item.OrderItem.canceled = True
+        release_stock(s, order.item_id)
+        order.canceled = True
         s.commit()
+    database.mark_write(order_item_id)
     return '', 204
 
 
@@ -205,5 +476,6 @@ if __name__ == '__main__':
     PORT = os.environ.get("PORT", 8280)
     print("LISTENING ON PORT:", PORT, "($PORT)")
     database.create_schema()
+    database.migrate("warehouse_service", MIGRATIONS)
     refresh_items_in_db()
     app.run("0.0.0.0", PORT)
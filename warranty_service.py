@@ -1,18 +1,34 @@
 import os
 from datetime import date
 from enum import Enum
+from typing import List
 
 from pydantic import BaseModel, ValidationError
-from flask import Flask, request
+from flask import Flask, request, jsonify
 from werkzeug.exceptions import BadRequest
 import sqlalchemy as sa
 
 import database
+import deadline
+import metrics
+import tracing
+from group_commit import GroupCommitter
 
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
+metrics.install(app)
+tracing.install(app)
+database.install(app)
+deadline.install(app)
 ROOT_PATH = "/api/v1"
+# group commit: одновременные POST /warranty/<item_uid> пишутся в базу одной пачкой и одним commit'ом
+# (до GROUP_COMMIT_MAX_BATCH строк, окно GROUP_COMMIT_MAX_WAIT_MS от первой строки пачки)
+GROUP_COMMIT = os.environ.get("GROUP_COMMIT", "0") == "1"
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get("GROUP_COMMIT_MAX_BATCH", 100))
+GROUP_COMMIT_MAX_WAIT_MS = float(os.environ.get("GROUP_COMMIT_MAX_WAIT_MS", 5))
+print(f"Group commit: {GROUP_COMMIT} ($GROUP_COMMIT), max batch: {GROUP_COMMIT_MAX_BATCH} ($GROUP_COMMIT_MAX_BATCH), "
+      f"max wait: {GROUP_COMMIT_MAX_WAIT_MS} ms ($GROUP_COMMIT_MAX_WAIT_MS)")
 
 # ------------------------------ dto ------------------------------
 
@@ -36,9 +52,29 @@ class WarrantyRequest(BaseModel):
     reason: str
     availableCount: int
 
+
+class BatchStatusRequest(BaseModel):
+    itemUids: List[str]
+
 # ------------------------------ вспомогательные функции ------------------------------
 
 
+def insert_warranties(item_uids):
+    """
+    Новые warranty одним многострочным INSERT ... VALUES (...), (...) и одним commit'ом
+    """
+    with database.Session() as s:
+        s.execute(Warranty.__table__.insert().values([{
+            "item_uid": item_uid,
+            "status": Status.on,
+            "warranty_date": date.today(),
+        } for item_uid in item_uids]))
+
+
+warranty_committer = GroupCommitter(
+    "warranty", insert_warranties, GROUP_COMMIT_MAX_BATCH, GROUP_COMMIT_MAX_WAIT_MS / 1000)
+
+
 @app.errorhandler(Exception)
 def default_error_handler(error):
     return {
@@ -58,8 +94,8 @@ def request_warranty_status(item_uid):
     """
     Информация о статусе гарантии
     """
-    # просто достаем warranty из базы
-    with database.Session() as s:
+    # просто достаем warranty из базы (реплики)
+    with database.ReadSession(item_uid) as s:
         warranty = s.query(Warranty).filter(Warranty.item_uid == item_uid).one_or_none()
         if not warranty:
             return {"message": "Not found"}, 404
@@ -70,6 +106,76 @@ def request_warranty_status(item_uid):
                }, 200
 
 
+@app.route(f"{ROOT_PATH}/warranty/batch", methods=["POST"])
+def request_warranty_status_batch():
+    """
+    Информация о статусе гарантии сразу для нескольких вещей (одним запросом в базу)
+    """
+    # парсим входные данные
+    try:
+        batch_request = BatchStatusRequest.parse_obj(request.get_json(force=True))
+    except BadRequest:
+        return {"message": "Bad json"}, 400
+    except ValidationError as e:
+        return {"message": e.errors()}, 400
+
+    if not batch_request.itemUids:
+        return jsonify([]), 200
+
+    # достаем все warranty одним запросом с IN (...) (с реплики)
+    with database.ReadSession(*batch_request.itemUids) as s:
+        warranties = s.query(Warranty).filter(Warranty.item_uid.in_(batch_request.itemUids)).all()
+        result = [{
+            "itemUid": warranty.item_uid,
+            "warrantyDate": warranty.warranty_date.isoformat(),
+            "status": warranty.status
+        } for warranty in warranties]
+        return jsonify(result), 200
+
+
+@app.route(f"{ROOT_PATH}/warranty/batch/start", methods=["POST"])
+def request_start_warranty_batch():
+    """
+    Запрос на начало гарантийного периода сразу для нескольких вещей (одним INSERT)
+    """
+    # парсим входные данные
+    try:
+        batch_request = BatchStatusRequest.parse_obj(request.get_json(force=True))
+    except BadRequest:
+        return {"message": "Bad json"}, 400
+    except ValidationError as e:
+        return {"message": e.errors()}, 400
+
+    if not batch_request.itemUids:
+        return '', 204
+
+    # добавляем все warranty одним многострочным INSERT
+    insert_warranties(batch_request.itemUids)
+    database.mark_write(*batch_request.itemUids)
+    return '', 204
+
+
+@app.route(f"{ROOT_PATH}/warranty/batch/stop", methods=["POST"])
+def request_stop_warranty_batch():
+    """
+    Запрос на закрытие гарантии сразу для нескольких вещей (откат batch/start)
+    """
+    # парсим входные данные
+    try:
+        batch_request = BatchStatusRequest.parse_obj(request.get_json(force=True))
+    except BadRequest:
+        return {"message": "Bad json"}, 400
+    except ValidationError as e:
+        return {"message": e.errors()}, 400
+
+    # ставим status=REMOVED на все warranty одним UPDATE
+    with database.Session() as s:
+        s.query(Warranty).filter(Warranty.item_uid.in_(batch_request.itemUids)).update(
+            {Warranty.status: Status.removed}, synchronize_session=False)
+    database.mark_write(*batch_request.itemUids)
+    return '', 204
+
+
 @app.route(f"{ROOT_PATH}/warranty/<string:item_uid>/warranty", methods=["POST"])
 def request_warranty_result(item_uid):
     """
@@ -106,13 +212,17 @@ def request_start_warranty(item_uid):
     """
     Запрос на начало гарантийного периода
     """
-    # добавляем warranty в базу
-    with database.Session() as s:
-        s.add(Warranty(
-            item_uid=item_uid,
-            status=Status.on,
-            warranty_date=date.today(),
-        ))
+    # добавляем warranty в базу (в group commit - вместе с одновременными запросами, ответ после commit'а)
+    if GROUP_COMMIT:
+        warranty_committer.submit(item_uid)
+    else:
+        with database.Session() as s:
+            s.add(Warranty(
+                item_uid=item_uid,
+                status=Status.on,
+                warranty_date=date.today(),
+            ))
+    database.mark_write(item_uid)
     return '', 204
 
 
@@ -128,6 +238,7 @@ def request_stop_warranty(item_uid):
             warranty.status = Status.removed
         else:
             return {"message": "Not found"}, 404
+    database.mark_write(item_uid)
     return '', 204
 
 
@@ -0,0 +1,141 @@
+# Фоновый разбор очереди запросов гарантии (ЛР3 4c)
+# Когда order_service был недоступен, store_service кладет запрос гарантии в очередь rabbitmq.
+# Этот процесс забирает сообщения пачками (не больше WORKER_PREFETCH неподтвержденных),
+# параллельно отправляет их в order_service, повторяет неудачные с экспоненциальной задержкой
+# и подтверждает пачку одним ack. Если повторы не помогли, сообщение возвращается в очередь.
+# Раз в WORKER_REPORT_INTERVAL секунд печатает размер очереди и скорость разбора.
+#
+# Запуск: python warranty_worker.py
+
+import os
+from time import sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor
+
+import pika
+
+import circuit_breaker as cb
+import rabbitmq as mq
+
+ROOT_PATH = "/api/v1"
+ORDER_SERVICE_URL = os.environ.get("ORDER_SERVICE_URL", "localhost:8380")
+print(f"Order service url: {ORDER_SERVICE_URL} ($ORDER_SERVICE_URL)")
+WORKER_PREFETCH = int(os.environ.get("WORKER_PREFETCH", 50))
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 8))
+WORKER_MAX_ATTEMPTS = int(os.environ.get("WORKER_MAX_ATTEMPTS", 3))
+WORKER_RETRY_BACKOFF = float(os.environ.get("WORKER_RETRY_BACKOFF", 0.5))
+WORKER_IDLE_INTERVAL = float(os.environ.get("WORKER_IDLE_INTERVAL", 1))
+WORKER_REPORT_INTERVAL = float(os.environ.get("WORKER_REPORT_INTERVAL", 10))
+print(f"Worker prefetch: {WORKER_PREFETCH} ($WORKER_PREFETCH), "
+      f"concurrency: {WORKER_CONCURRENCY} ($WORKER_CONCURRENCY), "
+      f"max attempts: {WORKER_MAX_ATTEMPTS} ($WORKER_MAX_ATTEMPTS)")
+
+# результаты обработки сообщения
+DONE = "done"
+DROPPED = "dropped"
+RETRY = "retry"
+
+
+class WarrantyQueueWorker:
+    def __init__(self, prefetch=WORKER_PREFETCH, concurrency=WORKER_CONCURRENCY,
+                 max_attempts=WORKER_MAX_ATTEMPTS, retry_backoff=WORKER_RETRY_BACKOFF):
+        self.prefetch = prefetch
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="warranty-worker")
+        self.circuit_breaker = cb.CircuitBreaker()
+        self.drained = 0
+        self.dropped = 0
+        self.requeued = 0
+        self.depth = 0
+        self.rate = 0.0
+        self.reported_at = monotonic()
+        self.reported_drained = 0
+
+    def send(self, message) -> str:
+        """
+        Отправляет запрос гарантии в order_service, повторяя с экспоненциальной задержкой.
+        DONE - выполнено, DROPPED - повторять бессмысленно, RETRY - вернуть в очередь
+        """
+        if "orderUid" not in message:
+            # сообщения старого формата без заказа выполнить нельзя
+            print(f"Dropping queued warranty request without orderUid: {message}")
+            return DROPPED
+
+        for attempt in range(self.max_attempts):
+            try:
+                resp = self.circuit_breaker.external_request(
+                    "POST",
+                    f"http://{ORDER_SERVICE_URL}{ROOT_PATH}/orders/{message['orderUid']}/warranty",
+                    json={"reason": message["reason"]}
+                )
+                if not resp.ok:
+                    print(f"Queued warranty request for order '{message['orderUid']}' "
+                          f"failed with {resp.status_code}, dropping")
+                    return DROPPED
+                return DONE
+            except cb.CircuitBreakerException:
+                if attempt < self.max_attempts - 1:
+                    sleep(self.retry_backoff * 2 ** attempt)
+        return RETRY
+
+    def drain_batch(self, q) -> int:
+        """
+        Обрабатывает одну пачку сообщений. Возвращает размер пачки
+        """
+        batch = q.get_batch(self.prefetch, timeout=WORKER_IDLE_INTERVAL)
+        if not batch:
+            return 0
+
+        results = list(self.executor.map(self.send, [message for _, message in batch]))
+
+        # неудачные возвращаем в очередь, а все остальные подтверждаем одним ack по последнему
+        # подтверждаемому тегу: тег уже возвращенного сообщения брокер не знает и закрыл бы канал
+        for (delivery_tag, _), result in zip(batch, results):
+            if result == RETRY:
+                q.nack(delivery_tag, requeue=True)
+        acked_tags = [delivery_tag for (delivery_tag, _), result in zip(batch, results) if result != RETRY]
+        if acked_tags:
+            q.ack(acked_tags[-1], multiple=True)
+        self.drained += results.count(DONE) + results.count(DROPPED)
+        self.dropped += results.count(DROPPED)
+        self.requeued += results.count(RETRY)
+        return len(batch)
+
+    def report(self, q):
+        now = monotonic()
+        if now - self.reported_at < WORKER_REPORT_INTERVAL:
+            return
+        self.depth = q.depth()
+        self.rate = (self.drained - self.reported_drained) / (now - self.reported_at)
+        self.reported_at, self.reported_drained = now, self.drained
+        print(f"Warranty queue depth: {self.depth}, drain rate: {self.rate:.1f} msg/s, "
+              f"drained: {self.drained}, dropped: {self.dropped}, requeued: {self.requeued}")
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "rate": self.rate,
+            "drained": self.drained,
+            "dropped": self.dropped,
+            "requeued": self.requeued,
+        }
+
+    def run(self):
+        while True:
+            try:
+                with mq.Queue() as q:
+                    q.set_prefetch(self.prefetch)
+                    while True:
+                        requeued = self.requeued
+                        self.drain_batch(q)
+                        if self.requeued > requeued:
+                            # order_service все еще недоступен - не крутим одни и те же сообщения
+                            sleep(self.retry_backoff * 2 ** self.max_attempts)
+                        self.report(q)
+            except pika.exceptions.AMQPError as e:
+                print(f"RabbitMQ connection problem: {repr(e)}, reconnecting")
+                sleep(WORKER_IDLE_INTERVAL)
+
+
+if __name__ == '__main__':
+    WarrantyQueueWorker().run()